@@ -0,0 +1,259 @@
+import asyncio
+import logging
+import time
+from bisect import bisect_left, bisect_right, insort
+
+import database as db
+from trade_logic import TARGET_STOP_EXIT_FEE
+
+LOAD_BATCH = 5000              # строк открытых сделок за одно чтение при загрузке
+
+log = logging.getLogger("alerts")
+
+
+def _parse_level(value) -> float | None:
+    try:
+        level = float(str(value).replace(",", ".").strip())
+    except (TypeError, ValueError):
+        return None
+    return level if level > 0 else None
+
+
+# Цели хранятся строкой "2500 / 2700": номер цели -> уровень
+def parse_targets(targets) -> list[tuple[int, float]]:
+    if not targets:
+        return []
+    levels = []
+    for number, part in enumerate(str(targets).split("/"), start=1):
+        level = _parse_level(part)
+        if level is not None:
+            levels.append((number, level))
+    return levels
+
+
+def _remove(levels: list, key: tuple):
+    i = bisect_left(levels, key)
+    if i < len(levels) and levels[i] == key:
+        del levels[i]
+
+
+# Уровни одной монеты, отсортированные по цене. Сделки считаются длинными:
+# стоп срабатывает, когда цена опустилась до уровня, цель — когда поднялась до уровня
+class CoinLevels:
+    __slots__ = ("stops", "targets")
+
+    def __init__(self):
+        self.stops = []             # (уровень, id сделки)
+        self.targets = []           # (уровень, id сделки, номер цели)
+
+    # Все пересечённые ценой уровни: бинарный поиск границы и срез хвоста (стопы)
+    # или начала (цели) списка. Сработавшие уровни удаляются, повторно не срабатывают
+    def cross(self, price: float) -> tuple[list, list]:
+        stops = targets = ()
+        i = bisect_left(self.stops, (price,))
+        if i < len(self.stops):
+            stops = self.stops[i:]
+            del self.stops[i:]
+        j = bisect_right(self.targets, (price, float("inf")))
+        if j:
+            targets = self.targets[:j]
+            del self.targets[:j]
+        return stops, targets
+
+    def __len__(self):
+        return len(self.stops) + len(self.targets)
+
+
+# Ценовые уведомления по стопам и целям всех открытых сделок. Уровни загружаются из базы
+# один раз при старте, дальше поддерживаются подписками на открытие и закрытие сделок
+# (database.trade_listeners). На каждую пачку цен (PriceFeed.listeners) для каждой монеты
+# находятся пересечённые уровни и в чат сделки отправляется одно сообщение на все сработавшие.
+# Сработавшие уровни не сохраняются в базе: после перезапуска пересечённый уровень ещё
+# открытой сделки сработает снова.
+# С auto_close сделка, цена которой дошла до стопа или первой цели, закрывается по этому
+# уровню с комиссией выхода exit_fee: все такие сделки одной пачки цен закрываются одной
+# транзакцией (database.close_trades_at), уже закрытые вручную пропускаются. Если запись
+# не удалась, приходят обычные уведомления, а уровни сделок возвращаются — следующая
+# пачка цен повторит закрытие
+class AlertEngine:
+    def __init__(self, send, auto_close: bool = False, exit_fee: float = TARGET_STOP_EXIT_FEE):
+        self.send = send            # корутина send(chat_id, text), например OutboundQueue.send_message
+        self.auto_close = auto_close
+        self.exit_fee = exit_fee
+        self._coins = {}            # символ монеты -> CoinLevels
+        self._trades = {}           # id сделки -> (chat_id, монета, стоп, [(номер цели, уровень)])
+        self._closing = {}          # то же для сделок, которые сейчас закрываются по auto_close
+        self._loading = False
+        self._closed_while_loading = set()
+        self._tasks = set()
+        self.ticks = 0
+        self.tick_time_total = 0.0
+        self.alerts = 0
+        self.closed = 0
+        self.close_errors = 0
+        self.sent = 0
+        self.send_errors = 0
+
+    async def load(self, batch_size: int = LOAD_BATCH):
+        self._loading = True
+        try:
+            async for rows in db.iter_open_trade_levels(batch_size):
+                for trade_id, chat_id, coin, stop, targets in rows:
+                    # Сделка могла закрыться, пока шла загрузка, а строка прочитана до этого
+                    if trade_id not in self._closed_while_loading:
+                        self.trade_opened(trade_id, chat_id, coin, stop, targets)
+        finally:
+            self._loading = False
+            self._closed_while_loading.clear()
+        log.info("Ценовые уведомления: %d открытых сделок", len(self._trades))
+
+    def trade_opened(self, trade_id: int, chat_id: int, coin: str, stop, targets):
+        if not coin or not chat_id or trade_id in self._trades:
+            return
+        stop = _parse_level(stop) if stop is not None else None
+        target_levels = parse_targets(targets)
+        if stop is None and not target_levels:
+            return
+        self._add(trade_id, chat_id, coin, stop, target_levels)
+
+    def _add(self, trade_id: int, chat_id: int, coin: str, stop, target_levels: list):
+        levels = self._coins.get(coin)
+        if levels is None:
+            levels = self._coins[coin] = CoinLevels()
+        if stop is not None:
+            insort(levels.stops, (stop, trade_id))
+        for number, level in target_levels:
+            insort(levels.targets, (level, trade_id, number))
+        self._trades[trade_id] = (chat_id, coin, stop, target_levels)
+
+    def trade_closed(self, trade_id: int, user_id: int = None, coin: str = None):
+        if self._loading:
+            self._closed_while_loading.add(trade_id)
+        # Закрытая вручную во время auto_close сделка не вернётся, если запись не удастся
+        self._closing.pop(trade_id, None)
+        trade = self._trades.pop(trade_id, None)
+        if trade is None:
+            return
+        _, coin, stop, target_levels = trade
+        # Все уровни монеты могли уже сработать — тогда её запись удалена в tick()
+        levels = self._coins.get(coin)
+        if levels is None:
+            return
+        if stop is not None:
+            _remove(levels.stops, (stop, trade_id))
+        for number, level in target_levels:
+            _remove(levels.targets, (level, trade_id, number))
+        if not len(levels):
+            del self._coins[coin]
+
+    # Сработавшие уровни по новой цене монеты:
+    # [(id сделки, chat_id, монета, "stop" | "target", номер цели, уровень)]
+    def tick(self, coin: str, price: float) -> list[tuple]:
+        levels = self._coins.get(coin)
+        if levels is None:
+            return []
+        stops, targets = levels.cross(price)
+        alerts = []
+        for level, trade_id in stops:
+            alerts.append((trade_id, self._trades[trade_id][0], coin, "stop", None, level))
+        for level, trade_id, number in targets:
+            alerts.append((trade_id, self._trades[trade_id][0], coin, "target", number, level))
+        if not len(levels):
+            del self._coins[coin]
+        return alerts
+
+    # Подписчик PriceFeed: проверка пачки цен {символ: цена} и отправка уведомлений в фоне
+    def on_prices(self, prices: dict):
+        started = time.perf_counter()
+        alerts = []
+        for coin, price in prices.items():
+            if coin in self._coins:
+                alerts.extend(self.tick(coin, price))
+        self.ticks += 1
+        self.tick_time_total += time.perf_counter() - started
+        if alerts:
+            self.alerts += len(alerts)
+            closes = {}
+            if self.auto_close:
+                for trade_id, _, _, kind, number, level in alerts:
+                    if trade_id not in closes and (kind == "stop" or number == 1):
+                        closes[trade_id] = level
+                # Остальные уровни закрываемых сделок снимаются сразу, чтобы следующие
+                # пачки цен не сработали по ним, пока идёт запись
+                for trade_id in closes:
+                    trade = self._trades[trade_id]
+                    self.trade_closed(trade_id)
+                    self._closing[trade_id] = trade
+            task = asyncio.create_task(self._notify(alerts, prices, closes))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    # Закрытые строки по id сделки; None — запись не удалась
+    async def _close(self, closes: dict) -> dict | None:
+        try:
+            rows = await db.close_trades_at(list(closes.items()), self.exit_fee)
+        except Exception:
+            self.close_errors += 1
+            log.exception("Не удалось закрыть сделки %s", ", ".join(map(str, closes)))
+            # Сделки остались открытыми: их уровни возвращаются, закрытие повторит следующая пачка цен
+            for trade_id in closes:
+                trade = self._closing.pop(trade_id, None)
+                if trade is not None:
+                    self._add(trade_id, *trade)
+            return None
+        for trade_id in closes:
+            self._closing.pop(trade_id, None)
+        self.closed += len(rows)
+        return {row[0]: row for row in rows}
+
+    async def _notify(self, alerts: list, prices: dict, closes: dict):
+        closed = await self._close(closes) if closes else {}
+        if closed is None:
+            # Закрыть не удалось — о сработавших уровнях сообщаем обычными уведомлениями
+            closes = closed = {}
+        by_chat = {}
+        for trade_id, chat_id, coin, kind, number, level in alerts:
+            if trade_id in closes:
+                # Одна строка на закрытую сделку; закрытую раньше вручную не упоминаем
+                row = closed.pop(trade_id, None)
+                if row is None:
+                    continue
+                reason = "по стопу" if kind == "stop" else "по цели 1"
+                line = (f"✅ #{trade_id} {coin} закрыта {reason} по ${level}: "
+                        f"PnL {row[6]}%, профит {row[5]} USDT")
+            elif kind == "stop":
+                line = f"🛑 #{trade_id} {coin}: цена ${prices[coin]:.2f} дошла до стопа ${level}"
+            else:
+                line = f"🎯 #{trade_id} {coin}: цена ${prices[coin]:.2f} дошла до цели {number} (${level})"
+            by_chat.setdefault(chat_id, []).append(line)
+
+        chats = list(by_chat)
+        results = await asyncio.gather(
+            *(self.send(chat_id, "\n".join(by_chat[chat_id])) for chat_id in chats),
+            return_exceptions=True
+        )
+        for chat_id, result in zip(chats, results):
+            if isinstance(result, Exception):
+                self.send_errors += 1
+                log.warning("Не удалось отправить уведомление в чат %s: %r", chat_id, result)
+            else:
+                self.sent += 1
+
+    async def close(self):
+        for task in list(self._tasks):
+            task.cancel()
+
+    def metrics(self) -> dict:
+        return {
+            "trades": len(self._trades),
+            "coins": len(self._coins),
+            "stops": sum(len(levels.stops) for levels in self._coins.values()),
+            "targets": sum(len(levels.targets) for levels in self._coins.values()),
+            "ticks": self.ticks,
+            "tick_avg_us": self.tick_time_total / self.ticks * 1e6 if self.ticks else 0.0,
+            "alerts": self.alerts,
+            "closed": self.closed,
+            "close_errors": self.close_errors,
+            "sent": self.sent,
+            "send_errors": self.send_errors,
+        }
@@ -0,0 +1,109 @@
+import asyncio
+
+import numpy as np
+
+import database as db
+from cache import cached
+
+SECONDS_PER_DAY = 86400
+MIN_RATIO_TRADES = 5           # меньше сделок — Sharpe и Sortino не считаются (None, "—")
+
+
+# Самая длинная серия подряд идущих True и False в булевом массиве и текущая (последняя) серия
+def _streaks(flags: np.ndarray) -> tuple[int, int, int]:
+    if not flags.size:
+        return 0, 0, 0
+    changes = np.flatnonzero(flags[1:] != flags[:-1]) + 1
+    starts = np.concatenate(([0], changes))
+    lengths = np.diff(np.concatenate((starts, [flags.size])))
+    values = flags[starts]
+    longest_true = int(lengths[values].max(initial=0))
+    longest_false = int(lengths[~values].max(initial=0))
+    current = int(lengths[-1]) if values[-1] else -int(lengths[-1])
+    return longest_true, longest_false, current
+
+
+# Метрики по колонкам закрытых сделок (в порядке закрытия). Всё считается операциями
+# над массивами, без циклов по сделкам; доходность сделки — её pnl в долях
+def compute_analytics(closed_at: np.ndarray, pnl: np.ndarray, profit: np.ndarray, amount: np.ndarray) -> dict | None:
+    count = profit.size
+    if not count:
+        return None
+
+    # Кривая капитала и просадка от предыдущего максимума (отсчёт от нуля до первой сделки)
+    equity = np.cumsum(profit)
+    peaks = np.maximum.accumulate(np.concatenate(([0.0], equity)))[1:]
+    drawdown = equity - peaks
+    max_drawdown = float(-drawdown.min())
+
+    # Длительность просадки: время между соседними обновлениями максимума, между которыми
+    # капитал был ниже него, и время от последнего максимума, если просадка не закрыта
+    at_peak = np.flatnonzero(drawdown >= 0)
+    peak_times = np.concatenate(([closed_at[0]], closed_at[at_peak]))
+    peak_index = np.concatenate(([-1], at_peak))
+    underwater = np.diff(peak_index) > 1
+    durations = np.diff(peak_times)[underwater]
+    if peak_index[-1] != count - 1:
+        durations = np.append(durations, closed_at[-1] - peak_times[-1])
+    max_drawdown_days = float(durations.max(initial=0)) / SECONDS_PER_DAY
+
+    returns = pnl / 100
+    mean_return = float(returns.mean())
+    std = float(returns.std(ddof=1)) if count > 1 else 0.0
+    downside = float(np.sqrt(np.mean(np.minimum(returns, 0) ** 2)))
+
+    # Отношения: None — не определено (мало сделок или нечего делить), inf — делитель
+    # действительно нулевой при положительном числителе (нет убыточных сделок)
+    if count < MIN_RATIO_TRADES:
+        sharpe = sortino = None
+    else:
+        # Одинаковые доходности дают std из ошибок округления, а не ноль
+        sharpe = mean_return / std if np.ptp(returns) else None
+        if downside:
+            sortino = mean_return / downside
+        else:
+            sortino = float("inf") if mean_return > 0 else None
+
+    gross_profit = float(profit[profit > 0].sum())
+    gross_loss = float(-profit[profit < 0].sum())
+    if gross_loss:
+        profit_factor = gross_profit / gross_loss
+    else:
+        profit_factor = float("inf") if gross_profit else None
+
+    wins = pnl > 0
+    win_streak, loss_streak, current_streak = _streaks(wins)
+
+    return {
+        "total_trades": count,
+        "first_trade_at": int(closed_at[0]),
+        "total_profit": float(equity[-1]),
+        "total_volume": float(amount.sum()),
+        "max_drawdown": max_drawdown,
+        "max_drawdown_days": max_drawdown_days,
+        "sharpe": sharpe,
+        "sortino": sortino,
+        "profit_factor": profit_factor,
+        "expectancy": float(profit.mean()),
+        "expectancy_pnl": float(pnl.mean()),
+        "winrate": float(wins.mean() * 100),
+        "win_streak": win_streak,
+        "loss_streak": loss_streak,
+        "current_streak": current_streak,
+    }
+
+
+def _analyze_rows(rows) -> dict | None:
+    if not rows:
+        return None
+    columns = np.array(rows, dtype=np.float64).reshape(-1, 4).T
+    return compute_analytics(*columns)
+
+
+# Расширенная статистика пользователя. Сделки читаются одним запросом, разбор в массивы
+# и расчёт идут в отдельном потоке, чтобы десятки тысяч сделок не держали цикл событий.
+# Результат кэшируется до следующей записи сделки пользователя
+@cached
+async def get_advanced_statistics(user_id: int) -> dict | None:
+    rows = await db.get_closed_trade_series(user_id)
+    return await asyncio.to_thread(_analyze_rows, rows)
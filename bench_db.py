@@ -0,0 +1,287 @@
+import argparse
+import asyncio
+import json
+import os
+import random
+import sqlite3
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+import database as db
+from cache import stats_cache
+
+SIZES = [10_000, 100_000, 1_000_000]
+REPEAT = 50
+INSERT_CHUNK = 10_000
+VM_STEP = 10             # шаг счётчика инструкций VM SQLite
+
+# Монеты и их доля в журнале; цены — порядок величины для цены входа
+COIN_WEIGHTS = {
+    "BTC/USDT": (30, 60000), "ETH/USDT": (20, 3000), "SOL/USDT": (12, 150), "TON/USDT": (8, 5),
+    "DOGE/USDT": (8, 0.15), "XRP/USDT": (7, 0.6), "BNB/USDT": (5, 550), "ADA/USDT": (4, 0.45),
+    "LINK/USDT": (3, 15), "AVAX/USDT": (3, 35),
+}
+OPEN_SHARE = 0.1         # доля открытых сделок
+HISTORY_DAYS = 365
+
+# Допустимый p95 в миллисекундах; переопределяется через --budget name=ms
+BUDGETS_MS = {
+    "get_open_trades": 10.0,
+    "get_closed_trades_in_period": 20.0,
+    "get_active_coins": 10.0,
+    "get_coin_statistics": 10.0,
+    "insert_trade": 50.0,
+    "close_trade": 50.0,
+}
+
+
+# Синтетический журнал: у немногих пользователей много сделок, у большинства — мало;
+# популярные монеты встречаются чаще; сделки закрываются в среднем через 3 дня
+def generate_trades(path: str, rows: int, seed: int = 1) -> int:
+    rnd = random.Random(seed)
+    users = max(10, rows // 200)
+    coins = list(COIN_WEIGHTS)
+    weights = [COIN_WEIGHTS[coin][0] for coin in coins]
+    now = datetime.now().replace(microsecond=0)
+
+    conn = sqlite3.connect(path)
+    conn.executemany("INSERT OR IGNORE INTO coins (symbol) VALUES (?)", ((coin,) for coin in coins))
+    coin_ids = dict(conn.execute("SELECT symbol, id FROM coins"))
+
+    def trade():
+        user_id = 1 + min(users - 1, int(rnd.expovariate(5 / users)))
+        coin = rnd.choices(coins, weights)[0]
+        entry = round(COIN_WEIGHTS[coin][1] * rnd.uniform(0.7, 1.3), 6)
+        usdt_amount = rnd.choice([10, 25, 50, 100, 250, 500])
+        fee = rnd.choice([0.1, 0.18])
+        created_at = now - timedelta(seconds=rnd.uniform(0, HISTORY_DAYS * 86400))
+        if rnd.random() < OPEN_SHARE:
+            return (user_id, user_id, coin_ids[coin], entry, usdt_amount, fee, None, "открыта",
+                    None, None, None, created_at.strftime("%Y-%m-%d %H:%M:%S"), None)
+        closed_at = min(now, created_at + timedelta(seconds=rnd.expovariate(1 / (3 * 86400))))
+        pnl = round(rnd.gauss(0.5, 5), 2)
+        return (user_id, user_id, coin_ids[coin], entry, usdt_amount, fee, fee, "закрыта",
+                round(entry * (1 + pnl / 100), 6), pnl, round(usdt_amount * pnl / 100, 2),
+                created_at.strftime("%Y-%m-%d %H:%M:%S"), closed_at.strftime("%Y-%m-%d %H:%M:%S"))
+
+    try:
+        for start in range(0, rows, INSERT_CHUNK):
+            conn.executemany('''
+                INSERT INTO trades (
+                    user_id, chat_id, coin_id, entry, usdt_amount, fee_entry_percent, fee_exit_percent,
+                    status, close_price, pnl, profit_usdt, created_at, closed_at
+                ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ''', (trade() for _ in range(min(INSERT_CHUNK, rows - start))))
+            conn.commit()
+        conn.execute("ANALYZE")
+        conn.commit()
+    finally:
+        conn.close()
+    return users
+
+
+# Самый активный пользователь — худший случай для запросов по пользователю
+def heaviest_user(path: str) -> int:
+    conn = sqlite3.connect(path)
+    try:
+        return conn.execute(
+            "SELECT user_id FROM trades GROUP BY user_id ORDER BY COUNT(*) DESC LIMIT 1"
+        ).fetchone()[0]
+    finally:
+        conn.close()
+
+
+def open_trade_ids(path: str, count: int, seed: int) -> list[int]:
+    conn = sqlite3.connect(path)
+    try:
+        ids = [row[0] for row in conn.execute("SELECT id FROM trades WHERE status = 'открыта'")]
+    finally:
+        conn.close()
+    random.Random(seed).shuffle(ids)
+    return ids[:count]
+
+
+# Счётчик шагов виртуальной машины SQLite на всех соединениях пула.
+# Прямого счётчика просмотренных строк в sqlite3 нет; число шагов VM растёт
+# пропорционально прочитанным строкам индекса и таблицы и годится как его оценка
+class VMCounter:
+    def __init__(self):
+        self.steps = 0
+
+    def _tick(self) -> int:
+        self.steps += VM_STEP
+        return 0
+
+    async def __aenter__(self):
+        self.steps = 0
+        for conn in db.pool._connections + [db.writer._conn]:
+            await conn.set_progress_handler(self._tick, VM_STEP)
+        return self
+
+    async def __aexit__(self, *exc):
+        for conn in db.pool._connections + [db.writer._conn]:
+            await conn.set_progress_handler(None, VM_STEP)
+
+
+def returned_rows(result) -> int:
+    if isinstance(result, list):
+        return len(result)
+    return 0 if result is None or result is False else 1
+
+
+def percentile(values: list, p: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(p * len(values)))] if values else 0.0
+
+
+# Каждый сценарий — корутина от номера повтора; кэш статистики сбрасывается,
+# чтобы мерить запрос к базе, а не попадание в кэш
+def make_cases(user_id: int, close_ids: list[int]) -> dict:
+    today = datetime.now().strftime("%Y-%m-%d")
+    month_ago = (datetime.now() - timedelta(days=30)).strftime("%Y-%m-%d")
+    close_data = {"status": "закрыта", "close_price": 1.0, "fee_exit_percent": 0.1, "profit_usdt": 0.0, "pnl": 0.0}
+
+    def insert(i):
+        return db.insert_trade(user_id, user_id, {
+            "coin": "BTC/USDT", "entry": 60000.0, "usdt_amount": 100, "fee_entry_percent": 0.1, "status": "открыта"
+        })
+
+    return {
+        "get_open_trades": lambda i: db.get_open_trades(user_id),
+        "get_closed_trades_in_period": lambda i: db.get_closed_trades_in_period(user_id, month_ago, today),
+        "get_active_coins": lambda i: db.get_active_coins(user_id),
+        "get_coin_statistics": lambda i: db.get_coin_statistics(user_id, "BTC/USDT"),
+        "insert_trade": insert,
+        "close_trade": lambda i: db.close_trade(close_ids[i % len(close_ids)], close_data),
+    }
+
+
+async def bench_size(path: str, rows: int, repeat: int, seed: int) -> dict:
+    user_id = heaviest_user(path)
+    close_ids = open_trade_ids(path, repeat + 1, seed)
+    cases = make_cases(user_id, close_ids)
+
+    await db.init_pool(path=path)
+    async with db.pool.acquire() as conn:
+        await db.load_coins(conn)
+    await db.start_writer()
+    results = {}
+    try:
+        for name, case in cases.items():
+            # Первый вызов — отдельно: считает шаги VM и прогревает кэш страниц
+            stats_cache.clear()
+            async with VMCounter() as counter:
+                returned = returned_rows(await case(repeat))
+
+            timings = []
+            for i in range(repeat):
+                stats_cache.clear()
+                started = time.perf_counter()
+                await case(i)
+                timings.append(time.perf_counter() - started)
+
+            results[name] = {
+                "rows_returned": returned,
+                "vm_steps": counter.steps,
+                "p50_ms": percentile(timings, 0.50) * 1000,
+                "p95_ms": percentile(timings, 0.95) * 1000,
+                "max_ms": max(timings) * 1000,
+            }
+    finally:
+        await db.stop_writer()
+        await db.close_pool()
+    return {"rows": rows, "user_id": user_id, "queries": results}
+
+
+async def prepare(path: str, rows: int, seed: int):
+    if os.path.exists(path):
+        return
+    await db.init_pool(path=path, size=1)
+    try:
+        await db.init_db()
+    finally:
+        await db.close_pool()
+    generate_trades(path, rows, seed)
+    await db.init_pool(path=path, size=1)
+    try:
+        await db.rebuild_daily_stats()
+    finally:
+        await db.close_pool()
+
+
+async def run(args) -> list[dict]:
+    workdir = args.workdir or tempfile.mkdtemp(prefix="bench_db_")
+    os.makedirs(workdir, exist_ok=True)
+    reports = []
+    try:
+        for rows in args.sizes:
+            path = os.path.join(workdir, f"trades_{rows}.db")
+            started = time.perf_counter()
+            await prepare(path, rows, args.seed)
+            print(f"\n{rows} сделок (подготовка {time.perf_counter() - started:.1f} с)")
+            report = await bench_size(path, rows, args.repeat, args.seed)
+            print_report(report)
+            reports.append(report)
+    finally:
+        if not args.workdir:
+            for name in os.listdir(workdir):
+                os.remove(os.path.join(workdir, name))
+            os.rmdir(workdir)
+    return reports
+
+
+def print_report(report: dict):
+    print(f"{'запрос':<30}{'строк':>8}{'шагов VM':>12}{'шагов/строку':>14}{'p50 мс':>10}{'p95 мс':>10}")
+    for name, row in report["queries"].items():
+        per_row = row["vm_steps"] / row["rows_returned"] if row["rows_returned"] else row["vm_steps"]
+        print(f"{name:<30}{row['rows_returned']:>8}{row['vm_steps']:>12}{per_row:>14.0f}"
+              f"{row['p50_ms']:>10.2f}{row['p95_ms']:>10.2f}")
+
+
+# Проверка p95 каждого запроса на каждом объёме против бюджета
+def check_budgets(reports: list[dict], budgets: dict) -> list[str]:
+    exceeded = []
+    for report in reports:
+        for name, row in report["queries"].items():
+            budget = budgets.get(name)
+            if budget is not None and row["p95_ms"] > budget:
+                exceeded.append(f"{name} @ {report['rows']}: p95 {row['p95_ms']:.2f} мс > {budget} мс")
+    return exceeded
+
+
+def parse_budget(value: str) -> tuple[str, float]:
+    name, _, ms = value.partition("=")
+    if name not in BUDGETS_MS or not ms:
+        raise argparse.ArgumentTypeError(f"ожидается name=ms, name из: {', '.join(BUDGETS_MS)}")
+    return name, float(ms)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Микробенчмарки запросов database.py на синтетическом журнале")
+    parser.add_argument("--sizes", type=lambda s: [int(x) for x in s.split(",")], default=SIZES,
+                        help="объёмы таблицы trades через запятую")
+    parser.add_argument("--repeat", type=int, default=REPEAT, help="повторов каждого запроса")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--workdir", default=None, help="каталог для сгенерированных баз (переиспользуются)")
+    parser.add_argument("--budget", type=parse_budget, action="append", default=[],
+                        help="бюджет p95, например get_open_trades=5")
+    parser.add_argument("--output", default=None, help="куда сохранить результаты в JSON")
+    args = parser.parse_args()
+
+    reports = asyncio.run(run(args))
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(reports, f, ensure_ascii=False, indent=2)
+
+    exceeded = check_budgets(reports, {**BUDGETS_MS, **dict(args.budget)})
+    if exceeded:
+        print("\n❌ Превышен бюджет задержки:")
+        for line in exceeded:
+            print(f"  {line}")
+        raise SystemExit(1)
+    print("\n✅ Все запросы укладываются в бюджет")
+
+
+if __name__ == "__main__":
+    main()
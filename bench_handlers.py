@@ -0,0 +1,392 @@
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+import types
+from collections import Counter
+from datetime import datetime
+
+from aiogram.client.session.base import BaseSession
+from aiogram.methods import EditMessageText, SendMessage
+from aiogram.types import Chat, Message, Update
+
+# Стенду не нужен настоящий токен: все запросы к Bot API перехватывает FakeSession
+try:
+    import config
+except ImportError:
+    config = types.ModuleType("config")
+    config.BOT_TOKEN = "123456789:BENCHMARK"
+    sys.modules["config"] = config
+
+import bot as app
+import database as db
+import metrics
+import prices
+from cache import stats_cache
+from outbound import OutboundQueue
+
+COINS = ["BTC/USDT", "ETH/USDT", "SOL/USDT", "TON/USDT", "DOGE/USDT", "XRP/USDT"]
+UNLIMITED_RATE = 1e9       # лимит отправки по умолчанию: меряем хэндлеры, а не флуд-контроль Telegram
+
+
+# Сессия Bot API без сети: на отправку и правку отвечает готовым Message, на остальное — True
+class FakeSession(BaseSession):
+    def __init__(self):
+        super().__init__()
+        self._message_ids = itertools.count(1000)
+        self.calls = Counter()
+
+    async def make_request(self, bot, method, timeout=None):
+        self.calls[type(method).__name__] += 1
+        if isinstance(method, (SendMessage, EditMessageText)):
+            return Message(
+                message_id=getattr(method, "message_id", None) or next(self._message_ids),
+                date=datetime.now(),
+                chat=Chat(id=method.chat_id, type="private"),
+                text=method.text
+            )
+        return True
+
+    async def stream_content(self, url, headers=None, timeout=30, chunk_size=65536, raise_for_status=True):
+        yield b""
+
+    async def close(self):
+        pass
+
+
+# Смоделированный пользователь: собирает апдейты так, как их прислал бы Telegram.
+# Все нажатия кнопок приходят с одного сообщения бота, которое и редактируется
+class SimulatedUser:
+    update_ids = itertools.count(1)
+
+    def __init__(self, user_id: int):
+        self.user_id = user_id
+        self.sender = {"id": user_id, "is_bot": False, "first_name": f"user{user_id}"}
+        self.chat = {"id": user_id, "type": "private"}
+        self._message_ids = itertools.count(1)
+
+    def message(self, text: str) -> Update:
+        return self._update({
+            "message": {
+                "message_id": next(self._message_ids),
+                "date": int(time.time()),
+                "chat": self.chat,
+                "from": self.sender,
+                "text": text,
+            }
+        })
+
+    def callback(self, data: str) -> Update:
+        return self._update({
+            "callback_query": {
+                "id": str(next(self.update_ids)),
+                "from": self.sender,
+                "chat_instance": str(self.user_id),
+                "data": data,
+                "message": {
+                    "message_id": 1,
+                    "date": int(time.time()),
+                    "chat": self.chat,
+                    "from": {"id": app.bot.id, "is_bot": True, "first_name": "bot"},
+                    "text": "…",
+                },
+            }
+        })
+
+    def _update(self, payload: dict) -> Update:
+        payload["update_id"] = next(self.update_ids)
+        return Update.model_validate(payload, context={"bot": app.bot})
+
+
+# Сценарии: список шагов ("message" | "callback", текст или callback_data)
+def create_trade_journey(user: SimulatedUser, rnd: random.Random) -> list:
+    entry = round(rnd.uniform(1, 1000), 2)
+    return [
+        ("message", "➕ Добавить сделку"),
+        ("callback", "set_coin"),
+        ("callback", f"coin:{rnd.choice(COINS)}"),
+        ("callback", "set_entry"),
+        ("message", str(entry)),
+        ("callback", "set_usdt"),
+        ("message", str(rnd.choice([25, 50, 100, 250]))),
+        ("callback", "set_fee"),
+        ("callback", "fee:0.1"),
+        ("callback", "set_targets"),
+        ("message", f"{entry * 1.05:.2f} / {entry * 1.1:.2f}"),
+        ("callback", "set_stop"),
+        ("message", f"{entry * 0.95:.2f}"),
+        ("callback", "set_status"),
+        ("callback", "status:В позиции"),
+        ("callback", "save_trade"),
+        ("callback", "comment:no"),
+    ]
+
+
+async def close_trade_journey(user: SimulatedUser, rnd: random.Random) -> list:
+    trades = await db.get_open_trades(user.user_id, limit=1)
+    if not trades:
+        return []
+    trade_id = trades[0][0]
+    return [
+        ("message", "📂 Открытые сделки"),
+        ("callback", f"openinfo:{trade_id}"),
+        ("callback", f"start_close:{trade_id}"),
+        ("callback", "set_close_price"),
+        ("message", f"{rnd.uniform(1, 1000):.2f}"),
+        ("callback", "set_close_fee"),
+        ("callback", "close_fee:0.1"),
+        ("callback", "confirm_close_trade"),
+        ("callback", "final_close_trade"),
+    ]
+
+
+def stats_journey(user: SimulatedUser, rnd: random.Random) -> list:
+    coin = rnd.choice(COINS)
+    steps = [
+        ("message", "📊 Статистика"),
+        ("callback", "stat_period"),
+        ("callback", "period:7"),
+        ("callback", "period:30"),
+        ("callback", "back_to_main_stats"),
+        ("callback", "stat_coin"),
+        ("callback", f"coin_stat:{coin}"),
+    ]
+    # Кнопки периода и истории передают id монеты; монета без сделок ещё не попала в справочник
+    coin_id = db.get_coin_id(coin)
+    if coin_id is not None:
+        steps += [
+            ("callback", f"coin_stat_period:{coin_id}"),
+            ("callback", f"coin_period:{coin_id}:30"),
+            ("callback", f"coin_trade_history:{coin_id}"),
+        ]
+    return steps + [
+        ("callback", "back_to_main_stats"),
+        ("callback", "stat_advanced"),
+    ]
+
+
+JOURNEYS = {
+    "create_trade": create_trade_journey,
+    "close_trade": close_trade_journey,
+    "stats": stats_journey,
+}
+
+
+class Recorder:
+    def __init__(self):
+        self.steps = {name: [] for name in JOURNEYS}      # задержки отдельных апдейтов
+        self.journeys = {name: [] for name in JOURNEYS}   # (длительность сценария, время в базе)
+        self.errors = Counter()
+        self.updates = 0
+
+
+async def run_journey(name: str, user: SimulatedUser, rnd: random.Random, recorder: Recorder):
+    spent = [0.0]
+    token = db.db_time.set(spent)
+    try:
+        steps = JOURNEYS[name](user, rnd)
+        if asyncio.iscoroutine(steps):
+            steps = await steps
+        if not steps:
+            return
+        spent[0] = 0.0
+
+        started = time.perf_counter()
+        for kind, value in steps:
+            update = user.message(value) if kind == "message" else user.callback(value)
+            step_started = time.perf_counter()
+            try:
+                await app.dp.feed_update(app.bot, update)
+            except Exception as e:
+                recorder.errors[f"{name}: {type(e).__name__}: {e}"] += 1
+            recorder.steps[name].append(time.perf_counter() - step_started)
+            recorder.updates += 1
+        recorder.journeys[name].append((time.perf_counter() - started, spent[0]))
+    finally:
+        db.db_time.reset(token)
+
+
+async def simulate_user(user: SimulatedUser, iterations: int, seed: int, recorder: Recorder):
+    rnd = random.Random(seed)
+    for _ in range(iterations):
+        for name in JOURNEYS:
+            await run_journey(name, user, rnd, recorder)
+
+
+def percentile(values: list, p: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(p * len(values)))] if values else 0.0
+
+
+def summarize(recorder: Recorder) -> dict:
+    summary = {}
+    for name in JOURNEYS:
+        steps = recorder.steps[name]
+        journeys = recorder.journeys[name]
+        count = len(journeys)
+        summary[name] = {
+            "journeys": count,
+            "updates": len(steps),
+            "p50_ms": percentile(steps, 0.50) * 1000,
+            "p95_ms": percentile(steps, 0.95) * 1000,
+            "p99_ms": percentile(steps, 0.99) * 1000,
+            "max_ms": max(steps, default=0.0) * 1000,
+            "journey_avg_ms": sum(d for d, _ in journeys) / count * 1000 if count else 0.0,
+            "db_avg_ms": sum(t for _, t in journeys) / count * 1000 if count else 0.0,
+        }
+    return summary
+
+
+async def run(args) -> dict:
+    workdir = None
+    path = args.db
+    if path is None:
+        workdir = tempfile.mkdtemp(prefix="bench_handlers_")
+        path = os.path.join(workdir, "trades.db")
+
+    session = FakeSession()
+    session.middleware(metrics.ApiTimingMiddleware())
+    app.bot.session = session
+    app.outbound = OutboundQueue(
+        app.bot,
+        global_rate=args.send_rate, chat_rate=args.send_rate,
+        global_burst=int(min(args.send_rate, UNLIMITED_RATE)), chat_burst=int(min(args.send_rate, UNLIMITED_RATE))
+    )
+
+    # Цены из временного файла вместо биржи: список и карточки сделок считают нереализованный PnL
+    price_file = None
+    if args.prices:
+        fd, price_file = tempfile.mkstemp(prefix="bench_prices_", suffix=".json")
+        with os.fdopen(fd, "w") as f:
+            json.dump({coin: 100.0 * (i + 1) for i, coin in enumerate(COINS)}, f)
+        app.price_feed = prices.PriceFeed(prices.FilePriceSource(price_file))
+
+    await db.init_pool(path=path, size=args.pool_size)
+    await db.init_db()
+    await db.start_writer()
+    await app.storage.start()
+    try:
+        recorder = Recorder()
+        users = [SimulatedUser(100000 + i) for i in range(args.users)]
+        started = time.perf_counter()
+        await asyncio.gather(*(
+            simulate_user(user, args.iterations, args.seed + i, recorder) for i, user in enumerate(users)
+        ))
+        elapsed = time.perf_counter() - started
+    finally:
+        await app.storage.close()
+        await db.stop_writer()
+        await db.close_pool()
+        if price_file is not None:
+            await app.price_feed.close()
+            os.remove(price_file)
+        if workdir is not None:
+            for name in os.listdir(workdir):
+                os.remove(os.path.join(workdir, name))
+            os.rmdir(workdir)
+
+    return {
+        "started_at": datetime.now().isoformat(timespec="seconds"),
+        "users": args.users,
+        "iterations": args.iterations,
+        "seed": args.seed,
+        "send_rate": args.send_rate,
+        "elapsed_s": elapsed,
+        "updates": recorder.updates,
+        "throughput_updates_s": recorder.updates / elapsed if elapsed else 0.0,
+        "journeys": summarize(recorder),
+        "errors": dict(recorder.errors),
+        "api_calls": dict(session.calls),
+        "pool": db.get_pool_metrics(),
+        "writer": db.get_writer_metrics(),
+        "cache": stats_cache.stats(),
+        "outbound": app.outbound.metrics(),
+        "storage": app.storage.metrics(),
+        "prices": app.price_feed.metrics() if app.price_feed is not None else None,
+    }
+
+
+def print_report(result: dict):
+    print(f"Пользователей: {result['users']}, повторов: {result['iterations']}, "
+          f"апдейтов: {result['updates']} за {result['elapsed_s']:.2f} с "
+          f"({result['throughput_updates_s']:.1f} апдейтов/с)")
+    print(f"{'сценарий':<14}{'кол-во':>8}{'p50 мс':>10}{'p95 мс':>10}{'p99 мс':>10}"
+          f"{'max мс':>10}{'сценарий мс':>13}{'база мс':>10}")
+    for name, row in result["journeys"].items():
+        print(f"{name:<14}{row['journeys']:>8}{row['p50_ms']:>10.2f}{row['p95_ms']:>10.2f}"
+              f"{row['p99_ms']:>10.2f}{row['max_ms']:>10.2f}{row['journey_avg_ms']:>13.2f}{row['db_avg_ms']:>10.2f}")
+    writer = result["writer"]
+    print(f"Запись: {writer['writes']} операций в {writer['batches']} пачках "
+          f"(в среднем {writer['avg_batch_size']:.1f}), COMMIT {writer['commit_time_avg'] * 1000:.2f} мс")
+    cache = result["cache"]
+    print(f"Кэш: попаданий {cache['hits']}, промахов {cache['misses']}")
+    if result.get("prices"):
+        feed = result["prices"]
+        print(f"Цены: запросов к источнику {feed['fetches']}, попаданий {feed['hits']}, "
+              f"промахов {feed['misses']}, объединено {feed['coalesced']}")
+    if result["errors"]:
+        print("Ошибки хэндлеров:")
+        for error, count in result["errors"].items():
+            print(f"  {count} × {error}")
+
+
+# Сравнение с прошлым прогоном: код возврата 1, если p95 какого-то сценария вырос больше threshold процентов
+def compare(result: dict, baseline: dict, threshold: float | None) -> int:
+    regressed = []
+    print(f"\nСравнение с прогоном от {baseline.get('started_at', '?')}:")
+    for name, row in result["journeys"].items():
+        old = baseline.get("journeys", {}).get(name)
+        if not old:
+            continue
+        parts = []
+        for metric in ("p50_ms", "p95_ms", "p99_ms", "db_avg_ms"):
+            change = (row[metric] - old[metric]) / old[metric] * 100 if old[metric] else 0.0
+            parts.append(f"{metric} {old[metric]:.2f} → {row[metric]:.2f} ({change:+.1f}%)")
+            if metric == "p95_ms" and threshold is not None and change > threshold:
+                regressed.append(name)
+        print(f"  {name}: " + ", ".join(parts))
+
+    if regressed:
+        print(f"\n❌ p95 вырос больше чем на {threshold}%: {', '.join(regressed)}")
+        return 1
+    return 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Нагрузочный прогон хэндлеров бота без сети")
+    parser.add_argument("--users", type=int, default=50, help="сколько пользователей работают одновременно")
+    parser.add_argument("--iterations", type=int, default=5, help="сколько раз каждый проходит все сценарии")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--db", default=None, help="файл базы (по умолчанию временный)")
+    parser.add_argument("--pool-size", type=int, default=db.POOL_SIZE)
+    parser.add_argument("--send-rate", type=float, default=UNLIMITED_RATE,
+                        help="лимит отправки сообщений в секунду (общий и на чат)")
+    parser.add_argument("--prices", action="store_true",
+                        help="показывать нереализованный PnL по ценам из временного файла")
+    parser.add_argument("--output", default=None, help="куда сохранить результаты в JSON")
+    parser.add_argument("--compare", default=None, help="JSON прошлого прогона для сравнения")
+    parser.add_argument("--threshold", type=float, default=None,
+                        help="допустимый рост p95 в процентах при --compare")
+    args = parser.parse_args()
+
+    result = asyncio.run(run(args))
+    print_report(result)
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+
+    code = 1 if result["errors"] else 0
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            code = max(code, compare(result, json.load(f), args.threshold))
+    raise SystemExit(code)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,13 +1,30 @@
+import argparse
 import asyncio
-import aiosqlite
+import csv
+import logging
+import os
+import sys
+import tempfile
 from aiogram import Bot, Dispatcher, types, F
 from aiogram.fsm.context import FSMContext
-from aiogram.fsm.storage.memory import MemoryStorage
-from aiogram.types import Message
+from aiogram.types import Message, FSInputFile
+import config
 from config import BOT_TOKEN
 from states import TradeForm, CloseDealForm, PeriodStates, CoinStatStates
 from aiogram.types import ReplyKeyboardMarkup, KeyboardButton, ReplyKeyboardRemove
 import database as db
+import analytics
+import importer
+import exporter
+from trade_logic import validate_trade_data, settle_trade, close_result, unrealized_result, TARGET_STOP_EXIT_FEE
+import prices
+from alerts import AlertEngine
+from cache import stats_cache, trade_cache
+import metrics
+from storage import SQLiteStorage
+from outbound import OutboundQueue, GLOBAL_RATE, GLOBAL_BURST, CHAT_RATE
+from webhook import run_webhook, WEBHOOK_PATH, WEBAPP_HOST, WEBAPP_PORT, MAX_INFLIGHT
+import workers
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton, CallbackQuery
 from datetime import datetime, timedelta
 from aiogram_calendar import SimpleCalendar, SimpleCalendarCallback
@@ -15,7 +32,32 @@ from aiogram.utils.keyboard import InlineKeyboardBuilder
 
 
 bot = Bot(token=BOT_TOKEN)
-dp = Dispatcher(storage=MemoryStorage())
+storage = SQLiteStorage(
+    ttl=getattr(config, "FSM_TTL", 7 * 24 * 3600),
+    max_resident=getattr(config, "FSM_MAX_RESIDENT", 10000)
+)
+dp = Dispatcher(storage=storage)
+outbound = OutboundQueue(
+    bot,
+    global_rate=getattr(config, "SEND_RATE_GLOBAL", GLOBAL_RATE),
+    chat_rate=getattr(config, "SEND_RATE_CHAT", CHAT_RATE)
+)
+metrics.setup(dp, bot)
+
+# Общий кэш текущих цен (если задан источник PRICE_SOURCE) для нереализованного PnL
+price_feed = None
+if getattr(config, "PRICE_SOURCE", None):
+    price_feed = prices.PriceFeed(
+        prices.make_source(config.PRICE_SOURCE),
+        ttl=getattr(config, "PRICE_TTL", prices.PRICE_TTL)
+    )
+
+
+# Текущие цены монет; без источника цен — пустой словарь
+async def current_prices(coins) -> dict:
+    if price_feed is None:
+        return {}
+    return await price_feed.get_many(coins, timeout=getattr(config, "PRICE_WAIT", prices.PRICE_WAIT))
 
 # Главное меню
 main_menu = ReplyKeyboardMarkup(
@@ -23,6 +65,7 @@ main_menu = ReplyKeyboardMarkup(
         [KeyboardButton(text="➕ Добавить сделку")],
         [KeyboardButton(text="📂 Открытые сделки")],
         [KeyboardButton(text="📊 Статистика")],
+        [KeyboardButton(text="📤 Экспорт")],
         [KeyboardButton(text="ℹ️ Помощь")]
     ],
     resize_keyboard=True
@@ -50,20 +93,15 @@ def render_trade_template(data: dict) -> str:
 
 # Черновик-шаблон для закрытия сделки
 
-async def render_trade_info_message(callback_or_message, trade_id: int):
-    async with aiosqlite.connect("trades.db") as db:
-        cursor = await db.execute('''
-            SELECT coin, timeframe, entry, targets, stop, usdt_amount, fee_entry_percent, reason, created_at
-            FROM trades
-            WHERE id = ?
-        ''', (trade_id,))
-        trade = await cursor.fetchone()
+async def render_trade_info_message(callback_or_message, trade_id: int, back_callback: str = "back_to_open_trades"):
+    trade = await db.get_trade(callback_or_message.from_user.id, trade_id)
 
     if not trade:
         await callback_or_message.answer("❌ Сделка не найдена.")
         return
 
-    coin, tf, entry, targets, stop, amount, fee, reason, created = trade
+    (_, _, coin, tf, entry, targets, stop, amount, fee, reason, created, status,
+     close_price, pnl, profit, closed) = trade
     text = (
         f"🧾 Сделка #{trade_id}\n\n"
         f"🪙 Монета: #{coin}\n"
@@ -76,14 +114,29 @@ async def render_trade_info_message(callback_or_message, trade_id: int):
         f"📚 Причина: {reason or '-'}\n"
         f"📅 Дата: {created.split()[0]}"
     )
+    if status == "открыта" and entry:
+        price = (await current_prices((coin,))).get(coin)
+        if price is not None:
+            profit, pnl = unrealized_result(entry, amount, fee, price)
+            text += (
+                f"\n\n💹 Текущая цена: ${price:.2f}\n"
+                f"📈 Нереализованный PnL: {pnl:+.2f}% ({profit:+.2f} USDT)"
+            )
+    if status == "закрыта":
+        text += (
+            f"\n\n📤 Закрыта: {(closed or created).split()[0]} по ${close_price or 0:.2f}\n"
+            f"📈 PnL: {pnl or 0:.2f}%\n"
+            f"💰 Профит: {profit or 0:.2f} USDT"
+        )
 
-    markup = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="🔒 Закрыть сделку", callback_data=f"start_close:{trade_id}")],
-        [InlineKeyboardButton(text="🔙 Назад к списку", callback_data="back_to_open_trades")]
-    ])
+    buttons = []
+    if status == "открыта":
+        buttons.append([InlineKeyboardButton(text="🔒 Закрыть сделку", callback_data=f"start_close:{trade_id}")])
+    buttons.append([InlineKeyboardButton(text="🔙 Назад к списку", callback_data=back_callback)])
+    markup = InlineKeyboardMarkup(inline_keyboard=buttons)
 
     if isinstance(callback_or_message, CallbackQuery):
-        await callback_or_message.message.edit_text(text, reply_markup=markup)
+        await outbound.edit_text(callback_or_message.message, text, reply_markup=markup)
     else:
         await callback_or_message.answer(text, reply_markup=markup)
 
@@ -108,7 +161,7 @@ async def show_trade_draft(message_or_callback, state: FSMContext):
 
     # Автоматически различаем callback и обычное сообщение
     if isinstance(message_or_callback, CallbackQuery):
-        await message_or_callback.message.edit_text(text, reply_markup=markup)
+        await outbound.edit_text(message_or_callback.message, text, reply_markup=markup)
     else:
         await message_or_callback.answer(text, reply_markup=markup)
 
@@ -137,7 +190,7 @@ async def set_coin_callback(callback: CallbackQuery, state: FSMContext):
     keyboard = InlineKeyboardMarkup(inline_keyboard=[
         [InlineKeyboardButton(text=coin, callback_data=f"coin:{coin}")] for coin in coins
     ])
-    await callback.message.edit_text("Выбери монету:", reply_markup=keyboard)
+    await outbound.edit_text(callback.message, "Выбери монету:", reply_markup=keyboard)
 
 #Обработчик нажатия на одну из монет
 @dp.callback_query(F.data.startswith("coin:"))
@@ -145,7 +198,7 @@ async def coin_chosen(callback: CallbackQuery, state: FSMContext):
     coin = callback.data.split(":")[1]
     if coin == "Другая монета":
         await state.set_state(TradeForm.coin_manual)
-        await callback.message.edit_text("Введи монету вручную (например, BTC/USDT):")
+        await outbound.edit_text(callback.message, "Введи монету вручную (например, BTC/USDT):")
     else:
         await state.update_data(coin=coin)
         await state.set_state(TradeForm.creating_trade)
@@ -157,7 +210,11 @@ async def coin_chosen(callback: CallbackQuery, state: FSMContext):
 #Обработчик тектового ввода монеты
 @dp.message(TradeForm.coin_manual)
 async def trade_coin_manual(message: Message, state: FSMContext):
-    await state.update_data(coin=message.text)
+    coin = db.normalize_coin(message.text)
+    if not coin:
+        await message.answer("❌ Введи монету, например BTC/USDT.")
+        return
+    await state.update_data(coin=coin)
     await state.set_state(TradeForm.creating_trade)
 
     # Возвращаемся в меню с обновлённым шаблоном
@@ -170,7 +227,7 @@ async def set_timeframe_callback(callback: CallbackQuery, state: FSMContext):
         [InlineKeyboardButton(text="1H", callback_data="tf:1H"), InlineKeyboardButton(text="4H", callback_data="tf:4H")],
         [InlineKeyboardButton(text="1D", callback_data="tf:1D"), InlineKeyboardButton(text="1W", callback_data="tf:1W")]
     ])
-    await callback.message.edit_text("Выбери таймфрейм:", reply_markup=keyboard)
+    await outbound.edit_text(callback.message, "Выбери таймфрейм:", reply_markup=keyboard)
 
 #Обработка таймфрейма
 @dp.callback_query(F.data.startswith("tf:"))
@@ -186,7 +243,7 @@ async def timeframe_chosen(callback: CallbackQuery, state: FSMContext):
 @dp.callback_query(F.data == "set_entry")
 async def set_entry_callback(callback: CallbackQuery, state: FSMContext):
     await state.set_state(TradeForm.entry)
-    await callback.message.edit_text("Введи цену входа ($):")
+    await outbound.edit_text(callback.message, "Введи цену входа ($):")
 
 # Пользователь вручную вводит цену входа
 @dp.message(TradeForm.entry)
@@ -207,7 +264,7 @@ async def trade_entry(message: Message, state: FSMContext):
 @dp.callback_query(F.data == "set_usdt")
 async def set_usdt_callback(callback: CallbackQuery, state: FSMContext):
     await state.set_state(TradeForm.usdt_amount)
-    await callback.message.edit_text("Введи сумму сделки в USDT:")
+    await outbound.edit_text(callback.message, "Введи сумму сделки в USDT:")
 
 # Пользователь вручную вводит сумму сделки
 @dp.message(TradeForm.usdt_amount)
@@ -232,7 +289,7 @@ async def set_fee_callback(callback: CallbackQuery, state: FSMContext):
         [InlineKeyboardButton(text="0.1%", callback_data="fee:0.1"), InlineKeyboardButton(text="0.18%", callback_data="fee:0.18")],
         [InlineKeyboardButton(text="Другой процент", callback_data="fee:custom")]
     ])
-    await callback.message.edit_text("Выбери комиссию при входе:", reply_markup=keyboard)
+    await outbound.edit_text(callback.message, "Выбери комиссию при входе:", reply_markup=keyboard)
 
 # Обработка выбранной комиссии
 # Пользователь нажал одну из кнопок с комиссией
@@ -242,7 +299,7 @@ async def fee_chosen(callback: CallbackQuery, state: FSMContext):
 
     if fee_value == "custom":
         await state.set_state(TradeForm.fee_entry_custom)
-        await callback.message.edit_text("Введи комиссию вручную (%):")
+        await outbound.edit_text(callback.message, "Введи комиссию вручную (%):")
     else:
         await state.update_data(fee_entry_percent=float(fee_value))
         await state.set_state(TradeForm.creating_trade)
@@ -270,7 +327,7 @@ async def fee_entry_custom_manual(message: Message, state: FSMContext):
 @dp.callback_query(F.data == "set_targets")
 async def set_targets_callback(callback: CallbackQuery, state: FSMContext):
     await state.set_state(TradeForm.targets)
-    await callback.message.edit_text("Введи цели (например: 2500 / 2700):")
+    await outbound.edit_text(callback.message, "Введи цели (например: 2500 / 2700):")
 
 # Обработчик ввода цели
 @dp.message(TradeForm.targets)
@@ -285,7 +342,7 @@ async def trade_targets(message: Message, state: FSMContext):
 @dp.callback_query(F.data == "set_stop")
 async def set_stop_callback(callback: CallbackQuery, state: FSMContext):
     await state.set_state(TradeForm.stop)
-    await callback.message.edit_text("Введи стоп ($):")
+    await outbound.edit_text(callback.message, "Введи стоп ($):")
 
 # Обработчик ввода стопа
 @dp.message(TradeForm.stop)
@@ -305,7 +362,7 @@ async def trade_stop(message: Message, state: FSMContext):
 @dp.callback_query(F.data == "set_reason")
 async def set_reason_callback(callback: CallbackQuery, state: FSMContext):
     await state.set_state(TradeForm.reason)
-    await callback.message.edit_text("Напиши причину входа:")
+    await outbound.edit_text(callback.message, "Напиши причину входа:")
 
 # Обработчик ввод причины входа
 @dp.message(TradeForm.reason)
@@ -324,7 +381,7 @@ async def set_status_callback(callback: CallbackQuery, state: FSMContext):
         [InlineKeyboardButton(text="🛑 Закрыто по стопу", callback_data="status:Закрыто по стопу")],
         [InlineKeyboardButton(text="✋ Закрыто вручную", callback_data="status:manual_close")]
     ])
-    await callback.message.edit_text("Выбери статус сделки:", reply_markup=keyboard)
+    await outbound.edit_text(callback.message, "Выбери статус сделки:", reply_markup=keyboard)
 
 
 # Обработка выбора статуса
@@ -334,7 +391,7 @@ async def status_chosen(callback: CallbackQuery, state: FSMContext):
 
     if status_value == "manual_close":
         await state.set_state(TradeForm.manual_close_price)
-        await callback.message.edit_text("🔒 Введи цену закрытия ($) для ручного закрытия:")
+        await outbound.edit_text(callback.message, "🔒 Введи цену закрытия ($) для ручного закрытия:")
     else:
         await state.update_data(status=status_value)
         await state.set_state(TradeForm.creating_trade)
@@ -370,7 +427,7 @@ async def manual_close_fee_handler(callback: CallbackQuery, state: FSMContext):
 
     if fee_value == "custom":
         await state.set_state(TradeForm.manual_close_fee_custom)
-        await callback.message.edit_text("📉 Введи комиссию при ручном закрытии (%):")
+        await outbound.edit_text(callback.message, "📉 Введи комиссию при ручном закрытии (%):")
     else:
         price = (await state.get_data()).get("manual_close_price")
         await state.update_data(
@@ -409,7 +466,7 @@ async def ask_comment_choice(callback: CallbackQuery, state: FSMContext):
         ],
         [InlineKeyboardButton(text="🔙 Назад", callback_data="comment:back")]
     ])
-    await callback.message.edit_text("Хочешь добавить комментарий к сделке?", reply_markup=keyboard)
+    await outbound.edit_text(callback.message, "Хочешь добавить комментарий к сделке?", reply_markup=keyboard)
 
 
 # Обработка выбора комментария (да/нет)
@@ -419,7 +476,7 @@ async def comment_choice(callback: CallbackQuery, state: FSMContext):
 
     if choice == "yes":
         await state.set_state(TradeForm.comment)
-        await callback.message.edit_text("✍️ Напиши комментарий к сделке:")
+        await outbound.edit_text(callback.message, "✍️ Напиши комментарий к сделке:")
     elif choice == "no":
         await state.update_data(comment=None)
         await finalize_trade(callback, state)
@@ -427,32 +484,6 @@ async def comment_choice(callback: CallbackQuery, state: FSMContext):
         await state.set_state(TradeForm.creating_trade)
         await show_trade_draft(callback, state)
 
-# Функция проверки заполненности полей
-def validate_trade_data(data: dict) -> tuple[bool, list[str]]:
-    missing_fields = []
-
-    # Обязательные поля для всех сделок
-    if not data.get('coin'):
-        missing_fields.append("монета")
-    if not data.get('entry'):
-        missing_fields.append("цена входа")
-    if not data.get('usdt_amount'):
-        missing_fields.append("сумма сделки (USDT)")
-    if not data.get('fee_entry_percent'):
-        missing_fields.append("комиссия на входе")
-    if not data.get('status'):
-        missing_fields.append("статус")
-
-    # Дополнительные условия по статусу
-    status = data.get('status')
-    if status == "Закрыто с прибылью" and not data.get('targets'):
-        missing_fields.append("цель")
-    if status == "Закрыто по стопу" and not data.get('stop'):
-        missing_fields.append("стоп")
-
-    return len(missing_fields) == 0, missing_fields
-
-
 # Кнопка возврата к черновику
 @dp.callback_query(F.data == "back_to_draft")
 async def back_to_draft(callback: CallbackQuery, state: FSMContext):
@@ -474,7 +505,7 @@ async def finalize_trade(source: Message | CallbackQuery, state: FSMContext):
         ])
 
         if isinstance(source, CallbackQuery):
-            await source.message.edit_text(warning, reply_markup=markup)
+            await outbound.edit_text(source.message, warning, reply_markup=markup)
         else:
             await source.answer(warning)
             await source.answer("Нажми кнопку ниже, чтобы вернуться к редактированию:", reply_markup=markup)
@@ -483,55 +514,18 @@ async def finalize_trade(source: Message | CallbackQuery, state: FSMContext):
 
     entry = data.get("entry")
     usdt_amount = data.get("usdt_amount")
-    entry_fee = data.get("fee_entry_percent", 0.0)
-    status = data.get("status")
-
-    close_price = None
-    exit_fee = 0.0
-    profit = None
-    pnl = None
-    trade_status = "открыта"
 
     try:
-        # Количество купленных монет с учетом комиссии на вход
-        coins = (usdt_amount / entry) * (1 - entry_fee / 100)
+        # Статус упрощается до "открыта"/"закрыта", для закрытой считаются PnL и профит
+        data.update(settle_trade(data))
     except ZeroDivisionError:
         if isinstance(source, CallbackQuery):
-            await source.message.edit_text("❌ Невозможно рассчитать: проверь входную цену и сумму сделки.")
+            await outbound.edit_text(source.message, "❌ Невозможно рассчитать: проверь входную цену и сумму сделки.")
         else:
             await source.answer("❌ Невозможно рассчитать: проверь входную цену и сумму сделки.")
         return
-
-    if status == "Закрыто с прибылью":
-        close_price = float(data.get("targets").split("/")[0].strip())
-        exit_fee = 0.18
-        trade_status = "закрыта"
-    elif status == "Закрыто по стопу":
-        close_price = float(data.get("stop"))
-        exit_fee = 0.18
-        trade_status = "закрыта"
-    elif status.startswith("Закрыто вручную"):
-        close_price = float(data.get("close_price"))
-        exit_fee = float(data.get("fee_exit"))
-        trade_status = "закрыта"
-
-    if close_price:
-        final_usdt = (coins * close_price) * (1 - exit_fee / 100)
-        profit = final_usdt - usdt_amount
-        pnl = (profit / usdt_amount) * 100
-        data["close_price"] = close_price
-        data["pnl"] = round(pnl, 2)
-        data["profit_usdt"] = round(profit, 2)
-        data["fee_exit_percent"] = exit_fee
-    else:
-        
-        data["close_price"] = None
-        data["pnl"] = None
-        data["profit_usdt"] = None
-        data["fee_exit_percent"] = None
-
-    # Упрощаем статус до "открыта"/"закрыта"
-    data["status"] = trade_status
+    trade_status = data["status"]
+    close_price = data["close_price"]
 
     # Сохраняем в базу
     user_id = source.from_user.id
@@ -570,41 +564,79 @@ async def save_comment_and_trade(message: Message, state: FSMContext):
     await finalize_trade(message, state)
 
 
-@dp.message(F.text == "📂 Открытые сделки")
-async def open_trades_menu(message: Message):
-    trades = await db.get_open_trades(message.from_user.id)
+OPEN_TRADES_PAGE_SIZE = 10
+
+# Страница списка открытых сделок. Курсор — id крайней сделки соседней страницы,
+# кнопки "вперёд/назад" несут его в callback_data (open_page:next:<id> / open_page:prev:<id>)
+async def render_open_trades_page(user_id: int, after_id: int = None, before_id: int = None):
+    page_size = OPEN_TRADES_PAGE_SIZE
+    trades = await db.get_open_trades(user_id, after_id=after_id, before_id=before_id, limit=page_size + 1)
+
+    # Лишняя (page_size + 1) строка показывает, есть ли ещё страница в ту же сторону
+    if before_id is not None:
+        has_prev, has_next = len(trades) > page_size, True
+        trades = trades[-page_size:]
+    else:
+        has_prev, has_next = after_id is not None, len(trades) > page_size
+        trades = trades[:page_size]
 
     if not trades:
-        await message.answer("😎 У вас нет открытых сделок.")
-        return
+        if after_id is None and before_id is None:
+            return None
+        # Сделки соседней страницы успели закрыть — показываем первую
+        return await render_open_trades_page(user_id)
 
-    # Формируем инлайн-кнопки
+    # Формируем инлайн-кнопки; если цена монеты известна — с нереализованным PnL
+    quotes = await current_prices(trade[1] for trade in trades)
     buttons = []
-    for trade_id, coin, usdt_amount in trades:
+    for trade_id, coin, usdt_amount, entry, entry_fee in trades:
         text = f"{coin} - {usdt_amount:.2f} USDT"
+        if coin in quotes and entry:
+            _, pnl = unrealized_result(entry, usdt_amount, entry_fee, quotes[coin])
+            text += f" ({pnl:+.2f}%)"
         buttons.append([InlineKeyboardButton(text=text, callback_data=f"openinfo:{trade_id}")])
 
+    navigation = []
+    if has_prev:
+        navigation.append(InlineKeyboardButton(text="⬅️ Назад", callback_data=f"open_page:prev:{trades[0][0]}"))
+    if has_next:
+        navigation.append(InlineKeyboardButton(text="Вперёд ➡️", callback_data=f"open_page:next:{trades[-1][0]}"))
+    if navigation:
+        buttons.append(navigation)
+
+    total = await db.get_open_trades_count(user_id)
     keyboard = InlineKeyboardMarkup(inline_keyboard=buttons)
-    await message.answer(f"📂 У вас {len(trades)} открытых сделок:", reply_markup=keyboard)
+    return f"📂 У вас {total} открытых сделок:", keyboard
 
 
 # Кнопка просмотра открытые сделки
 @dp.message(F.text == "📂 Открытые сделки")
 async def open_trades_menu(message: Message):
-    trades = await db.get_open_trades(message.from_user.id)
+    page = await render_open_trades_page(message.from_user.id)
 
-    if not trades:
+    if not page:
         await message.answer("😎 У вас нет открытых сделок.")
         return
 
-    # Формируем инлайн-кнопки
-    buttons = []
-    for trade_id, coin, usdt_amount in trades:
-        text = f"{coin} - {usdt_amount:.2f} USDT"
-        buttons.append([InlineKeyboardButton(text=text, callback_data=f"openinfo:{trade_id}")])
+    text, keyboard = page
+    await message.answer(text, reply_markup=keyboard)
 
-    keyboard = InlineKeyboardMarkup(inline_keyboard=buttons)
-    await message.answer(f"📂 У вас {len(trades)} открытых сделок:", reply_markup=keyboard)
+
+# Листание списка открытых сделок
+@dp.callback_query(F.data.startswith("open_page:"))
+async def open_trades_page(callback: CallbackQuery):
+    _, direction, trade_id = callback.data.split(":")
+    if direction == "next":
+        page = await render_open_trades_page(callback.from_user.id, after_id=int(trade_id))
+    else:
+        page = await render_open_trades_page(callback.from_user.id, before_id=int(trade_id))
+
+    if not page:
+        await outbound.edit_text(callback.message, "😎 У вас нет открытых сделок.")
+        return
+
+    text, keyboard = page
+    await outbound.edit_text(callback.message, text, reply_markup=keyboard)
 
 
 @dp.callback_query(F.data.startswith("openinfo:"))
@@ -637,7 +669,7 @@ async def show_close_draft(message_or_callback, state: FSMContext):
     ])
 
     if isinstance(message_or_callback, CallbackQuery):
-        await message_or_callback.message.edit_text(text, reply_markup=markup)
+        await outbound.edit_text(message_or_callback.message, text, reply_markup=markup)
     else:
         await message_or_callback.answer(text, reply_markup=markup)
 
@@ -653,32 +685,26 @@ async def start_close_trade(callback: CallbackQuery, state: FSMContext):
     trade_id = int(callback.data.split(":")[1])
 
     # Получаем ВСЕ необходимые поля для дальнейших расчетов
-    async with aiosqlite.connect("trades.db") as db_conn:
-        cursor = await db_conn.execute('''
-            SELECT id, coin, entry, usdt_amount, fee_entry_percent, created_at
-            FROM trades
-            WHERE id = ?
-        ''', (trade_id,))
-        row = await cursor.fetchone()
-
-    if not row:
+    trade = await db.get_trade(callback.from_user.id, trade_id)
+
+    if not trade:
         await callback.message.answer("❌ Сделка не найдена.")
         return
-
-    # Разбиваем значения по переменным
-    trade_id, coin, entry, usdt_amount, fee_entry_percent, created_at = row
+    if trade.status != "открыта":
+        await callback.message.answer("⚠️ Сделка уже закрыта.")
+        return
 
     # Сохраняем в FSMContext
     await state.set_state(CloseDealForm.closing_trade)
     await state.update_data({
         "selected_trade": {
-            "id": trade_id,
-            "coin": coin,
-            "entry": entry,
-            "created_at": created_at
+            "id": trade.id,
+            "coin": trade.coin,
+            "entry": trade.entry,
+            "created_at": trade.created_at
         },
-        "usdt_amount": usdt_amount,
-        "fee_entry_percent": fee_entry_percent
+        "usdt_amount": trade.usdt_amount,
+        "fee_entry_percent": trade.fee_entry_percent
     })
 
     # Показываем интерфейс черновика закрытия
@@ -691,7 +717,7 @@ async def prompt_close_price(callback: CallbackQuery, state: FSMContext):
         [InlineKeyboardButton(text="🔙 Назад", callback_data="back_to_close_draft")]
     ])
     await state.set_state(CloseDealForm.entering_close_price)
-    await callback.message.edit_text("📉 Введи цену закрытия ($):", reply_markup=keyboard)
+    await outbound.edit_text(callback.message, "📉 Введи цену закрытия ($):", reply_markup=keyboard)
 
 
 # Обработка пользовательского ввода цены закрытия
@@ -717,7 +743,7 @@ async def prompt_close_fee(callback: CallbackQuery, state: FSMContext):
         [InlineKeyboardButton(text="✍️ Ввести вручную", callback_data="close_fee:custom")],
         [InlineKeyboardButton(text="🔙 Назад", callback_data="back_to_close_draft")]
     ])
-    await callback.message.edit_text("📊 Выбери комиссию на закрытие:", reply_markup=keyboard)
+    await outbound.edit_text(callback.message, "📊 Выбери комиссию на закрытие:", reply_markup=keyboard)
 
 
 # Обработка выбора фиксированной комиссии
@@ -730,7 +756,7 @@ async def handle_close_fee(callback: CallbackQuery, state: FSMContext):
             [InlineKeyboardButton(text="🔙 Назад", callback_data="back_to_close_draft")]
         ])
         await state.set_state(CloseDealForm.entering_close_fee)
-        await callback.message.edit_text("✍️ Введи комиссию вручную (%):", reply_markup=keyboard)
+        await outbound.edit_text(callback.message, "✍️ Введи комиссию вручную (%):", reply_markup=keyboard)
     else:
         try:
             await state.update_data(close_fee=float(value))
@@ -746,7 +772,7 @@ async def handle_custom_fee(callback: CallbackQuery, state: FSMContext):
         [InlineKeyboardButton(text="🔙 Назад", callback_data="back_to_close_draft")]
     ])
     await state.set_state(CloseDealForm.entering_close_fee)
-    await callback.message.edit_text("✍️ Введи комиссию вручную (%):", reply_markup=keyboard)
+    await outbound.edit_text(callback.message, "✍️ Введи комиссию вручную (%):", reply_markup=keyboard)
 
 
 # Обработка пользовательского ввода комиссии вручную
@@ -763,19 +789,14 @@ async def receive_close_fee(message: Message, state: FSMContext):
 # Обработка кнопка назад в show_trade_info
 @dp.callback_query(F.data == "back_to_open_trades")
 async def back_to_open_trades(callback: CallbackQuery):
-    trades = await db.get_open_trades(callback.from_user.id)
+    page = await render_open_trades_page(callback.from_user.id)
 
-    if not trades:
-        await callback.message.edit_text("😎 У вас нет открытых сделок.")
+    if not page:
+        await outbound.edit_text(callback.message, "😎 У вас нет открытых сделок.")
         return
 
-    buttons = []
-    for trade_id, coin, usdt_amount in trades:
-        text = f"{coin} - {usdt_amount:.2f} USDT"
-        buttons.append([InlineKeyboardButton(text=text, callback_data=f"openinfo:{trade_id}")])
-
-    keyboard = InlineKeyboardMarkup(inline_keyboard=buttons)
-    await callback.message.edit_text(f"📂 У вас {len(trades)} открытых сделок:", reply_markup=keyboard)
+    text, keyboard = page
+    await outbound.edit_text(callback.message, text, reply_markup=keyboard)
 
 # Обработка кнопок "назад" при вводе цены и комиссии закрытия
 @dp.callback_query(F.data == "back_to_close_draft")
@@ -783,7 +804,7 @@ async def back_to_close_draft(callback: CallbackQuery, state: FSMContext):
     data = await state.get_data()
 
     if "selected_trade" not in data:
-        await callback.message.edit_text("⚠️ Не удалось вернуться: информация о сделке не найдена.")
+        await outbound.edit_text(callback.message, "⚠️ Не удалось вернуться: информация о сделке не найдена.")
         return
 
     await state.set_state(CloseDealForm.closing_trade)
@@ -796,7 +817,7 @@ async def confirm_close_warning(callback: CallbackQuery, state: FSMContext):
     trade = data.get("selected_trade")
 
     if not trade:
-        await callback.message.edit_text("❌ Ошибка: сделка не выбрана.")
+        await outbound.edit_text(callback.message, "❌ Ошибка: сделка не выбрана.")
         return
 
     close_price = data.get("close_price")
@@ -807,7 +828,7 @@ async def confirm_close_warning(callback: CallbackQuery, state: FSMContext):
         keyboard = InlineKeyboardMarkup(inline_keyboard=[
             [InlineKeyboardButton(text="🔙 Назад", callback_data="back_to_close_draft")]
         ])
-        await callback.message.edit_text(
+        await outbound.edit_text(callback.message, 
             "⚠️ Укажи цену закрытия и комиссию перед подтверждением.",
             reply_markup=keyboard
         )
@@ -825,7 +846,7 @@ async def confirm_close_warning(callback: CallbackQuery, state: FSMContext):
         [InlineKeyboardButton(text="✅ Подтвердить", callback_data="final_close_trade")],
         [InlineKeyboardButton(text="🔙 Назад", callback_data="back_to_close_draft")]
     ])
-    await callback.message.edit_text(text, reply_markup=keyboard)
+    await outbound.edit_text(callback.message, text, reply_markup=keyboard)
 
 # Финальное закрытие сделки
 @dp.callback_query(F.data == "final_close_trade")
@@ -839,11 +860,7 @@ async def finalize_close_trade(callback: CallbackQuery, state: FSMContext):
     close_price = float(data["close_price"])
     close_fee = float(data["close_fee"])
 
-    coins = (amount / entry) * (1 - entry_fee / 100)
-    final_usdt = (coins * close_price) * (1 - close_fee / 100)
-
-    profit = final_usdt - amount
-    pnl = (profit / amount) * 100
+    profit, pnl = close_result(entry, amount, entry_fee, close_price, close_fee)
 
     data.update({
         "status": "закрыта",
@@ -854,8 +871,12 @@ async def finalize_close_trade(callback: CallbackQuery, state: FSMContext):
         "closed_at": "CURRENT_TIMESTAMP"
     })
 
-    await db.close_trade(trade['id'], data)
+    closed = await db.close_trade(trade['id'], data)
     await state.clear()
+    if not closed:
+        # Сделку уже закрыли (например, автоматически по стопу или цели)
+        await outbound.edit_text(callback.message, "⚠️ Сделка уже закрыта.")
+        return
 
     text = (
         f"✅ Сделка закрыта\n\n"
@@ -866,7 +887,7 @@ async def finalize_close_trade(callback: CallbackQuery, state: FSMContext):
         f"📈 PnL: {data['pnl']}%\n"
         f"💰 Профит: {data['profit_usdt']} USDT"
     )
-    await callback.message.edit_text(text)
+    await outbound.edit_text(callback.message, text)
 
 
 
@@ -877,55 +898,32 @@ async def finalize_close_trade(callback: CallbackQuery, state: FSMContext):
 # 
 # Кнопка "Статистика" 
 
-# Функция для подсчета статистики
-async def calculate_stats(trades: list) -> tuple[float, float, int, float]:
-    total_pnl = 0
-    total_profit = 0
-    win_count = 0
-
-    for trade in trades:
-        pnl = trade['pnl'] or 0
-        profit = trade['profit_usdt'] or 0
-
-        total_pnl += pnl
-        total_profit += profit
-        if pnl > 0:
-            win_count += 1
-
-    total_count = len(trades)
-    average_pnl = total_pnl / total_count if total_count else 0
-    winrate = (win_count / total_count) * 100 if total_count else 0
-
-    return average_pnl, total_profit, total_count, winrate
-
-
 # Универсальная функция получения текста и клавиатуры статистики
 async def get_main_statistics(user_id: int) -> tuple[str, InlineKeyboardMarkup]:
     now = datetime.now()
     today = now.strftime("%Y-%m-%d")
     first_day_of_month = today
 
-    closed_trades = await db.get_closed_trades_in_period(user_id, first_day_of_month, today)
+    stats = await db.get_period_statistics(user_id, first_day_of_month, today)
     open_trades = await db.get_open_trades_count(user_id)
 
-    if not closed_trades:
+    if not stats:
         text = "❗ У тебя пока нет закрытых сделок в этом месяце."
     else:
-        average_pnl, total_profit, count, winrate = await calculate_stats(closed_trades)
-
         text = (
             f"📊 Статистика за {now.strftime('%d.%m.%Y')}\n\n"
-            f"📈 Средний PnL: {average_pnl:.2f}%\n"
-            f"💰 Суммарный профит: {total_profit:.2f} USDT\n"
-            f"📋 Закрыто сделок: {count}\n"
-            f"🏆 Winrate: {winrate:.2f}%\n"
+            f"📈 Средний PnL: {stats['average_pnl']:.2f}%\n"
+            f"💰 Суммарный профит: {stats['total_profit']:.2f} USDT\n"
+            f"📋 Закрыто сделок: {stats['total_trades']}\n"
+            f"🏆 Winrate: {stats['winrate']:.2f}%\n"
             f"📂 Открытых сделок сейчас: {open_trades}\n\n"
             f"Хочешь посмотреть более детальную статистику?\n👇 Выбери ниже:"
         )
 
     keyboard = InlineKeyboardMarkup(inline_keyboard=[
         [InlineKeyboardButton(text="📅 Статистика за период", callback_data="stat_period")],
-        [InlineKeyboardButton(text="🪙 Статистика по монете", callback_data="stat_coin")]
+        [InlineKeyboardButton(text="🪙 Статистика по монете", callback_data="stat_coin")],
+        [InlineKeyboardButton(text="📈 Расширенная статистика", callback_data="stat_advanced")]
     ])
 
     return text, keyboard
@@ -947,7 +945,7 @@ async def choose_period(callback: CallbackQuery):
         [InlineKeyboardButton(text="✍️ Свой период", callback_data="period:custom")],
         [InlineKeyboardButton(text="🔙 Назад", callback_data="back_to_main_stats")]
     ])
-    await callback.message.edit_text(
+    await outbound.edit_text(callback.message, 
         "📅 Выбери период для отображения статистики:",
         reply_markup=keyboard
     )
@@ -962,7 +960,8 @@ async def handle_period_choice(callback: CallbackQuery, state: FSMContext):
     if choice == "custom":
         # Переход на календарь для выбора даты начала
         await state.set_state(PeriodStates.selecting_start_date)
-        await callback.message.edit_text("📅 Выбери дату начала периода:", reply_markup=await calendar_with_back("stat_period"))
+        await state.update_data(stat_coin=None)
+        await outbound.edit_text(callback.message, "📅 Выбери дату начала периода:", reply_markup=await calendar_with_back("stat_period"))
         return
 
     days = int(choice)
@@ -971,20 +970,18 @@ async def handle_period_choice(callback: CallbackQuery, state: FSMContext):
     start_date = (now - timedelta(days=days)).strftime("%Y-%m-%d")
 
     user_id = callback.from_user.id
-    closed_trades = await db.get_closed_trades_in_period(user_id, start_date, end_date)
+    stats = await db.get_period_statistics(user_id, start_date, end_date)
 
-    if not closed_trades:
-        await callback.message.edit_text(f"❗ У тебя нет закрытых сделок за последние {days} дней.")
+    if not stats:
+        await outbound.edit_text(callback.message, f"❗ У тебя нет закрытых сделок за последние {days} дней.")
         return
 
-    average_pnl, total_profit, count, winrate = await calculate_stats(closed_trades)
-
     text = (
         f"📅 Статистика за последние {days} дней\n\n"
-        f"📈 Средний PnL: {average_pnl:.2f}%\n"
-        f"💰 Суммарный профит: {total_profit:.2f} USDT\n"
-        f"📋 Закрыто сделок: {count}\n"
-        f"🏆 Winrate: {winrate:.2f}%\n\n"
+        f"📈 Средний PnL: {stats['average_pnl']:.2f}%\n"
+        f"💰 Суммарный профит: {stats['total_profit']:.2f} USDT\n"
+        f"📋 Закрыто сделок: {stats['total_trades']}\n"
+        f"🏆 Winrate: {stats['winrate']:.2f}%\n\n"
         f"🔙 Можешь вернуться назад:"
     )
 
@@ -992,7 +989,7 @@ async def handle_period_choice(callback: CallbackQuery, state: FSMContext):
         [InlineKeyboardButton(text="🔙 Назад", callback_data="stat_period")]
     ])
 
-    await callback.message.edit_text(text, reply_markup=keyboard)
+    await outbound.edit_text(callback.message, text, reply_markup=keyboard)
 
 # Обработчик выбора кастомного периода
 # Функция для календаря (с кнопкой "назад")
@@ -1019,55 +1016,59 @@ async def process_calendar(callback: CallbackQuery, callback_data: dict, state:
     if selected:
         current_state = await state.get_state()
 
+        # Монета в данных состояния — календарь открыт из статистики по монете
+        data = await state.get_data()
+        coin = data.get("stat_coin")
+        back = f"coin_stat_period:{db.get_coin_id(coin)}" if coin else "stat_period"
+
         if current_state == PeriodStates.selecting_start_date:
             await state.update_data(start_date=date.strftime("%Y-%m-%d"))
             await state.set_state(PeriodStates.selecting_end_date)
-            await callback.message.edit_text(
+            await outbound.edit_text(callback.message, 
                 "📅 Теперь выбери дату окончания периода:",
-                reply_markup=await calendar_with_back("stat_period")
+                reply_markup=await calendar_with_back(back)
             )
 
         elif current_state == PeriodStates.selecting_end_date:
-            data = await state.get_data()
             start_date = data.get("start_date")
             end_date = date.strftime("%Y-%m-%d")
 
             if end_date < start_date:
-                await callback.message.edit_text(
+                await outbound.edit_text(callback.message, 
                     "❗ Дата окончания не может быть раньше даты начала. Выбери снова:",
-                    reply_markup=await calendar_with_back("stat_period")
+                    reply_markup=await calendar_with_back(back)
                 )
                 return
 
             # Получаем сделки
             user_id = callback.from_user.id
-            closed_trades = await db.get_closed_trades_in_period(user_id, start_date, end_date)
+            if coin:
+                stats = await db.get_coin_period_statistics(user_id, coin, start_date, end_date)
+            else:
+                stats = await db.get_period_statistics(user_id, start_date, end_date)
 
             keyboard = InlineKeyboardMarkup(inline_keyboard=[
-                [InlineKeyboardButton(text="🔙 Назад", callback_data="stat_period")]
+                [InlineKeyboardButton(text="🔙 Назад", callback_data=back)]
             ])
 
-            if not closed_trades:
-                await callback.message.edit_text(
-                    f"❗ Нет закрытых сделок за период {start_date} - {end_date}.",
+            if not stats:
+                await outbound.edit_text(callback.message, 
+                    f"❗ Нет закрытых сделок{f' по {coin}' if coin else ''} за период {start_date} - {end_date}.",
                     reply_markup=keyboard
                 )
                 await state.clear()
                 return
 
-            # Считаем статистику
-            average_pnl, total_profit, count, winrate = await calculate_stats(closed_trades)
-
             text = (
-                f"📅 Статистика за период {start_date} - {end_date}\n\n"
-                f"📈 Средний PnL: {average_pnl:.2f}%\n"
-                f"💰 Суммарный профит: {total_profit:.2f} USDT\n"
-                f"📋 Закрыто сделок: {count}\n"
-                f"🏆 Winrate: {winrate:.2f}%\n\n"
+                f"📅 Статистика{f' по {coin}' if coin else ''} за период {start_date} - {end_date}\n\n"
+                f"📈 Средний PnL: {stats['average_pnl']:.2f}%\n"
+                f"💰 Суммарный профит: {stats['total_profit']:.2f} USDT\n"
+                f"📋 Закрыто сделок: {stats['total_trades']}\n"
+                f"🏆 Winrate: {stats['winrate']:.2f}%\n\n"
                 f"🔙 Можешь вернуться назад:"
             )
 
-            await callback.message.edit_text(text, reply_markup=keyboard)
+            await outbound.edit_text(callback.message, text, reply_markup=keyboard)
             await state.clear()
 
 
@@ -1076,7 +1077,45 @@ async def process_calendar(callback: CallbackQuery, callback_data: dict, state:
 @dp.callback_query(F.data == "back_to_main_stats")
 async def back_to_main_stats(callback: CallbackQuery):
     text, keyboard = await get_main_statistics(callback.from_user.id)
-    await callback.message.edit_text(text, reply_markup=keyboard)
+    await outbound.edit_text(callback.message, text, reply_markup=keyboard)
+
+
+# None — метрика не определена (мало сделок), inf — нет убытков при положительном результате
+def format_ratio(value: float | None) -> str:
+    if value is None:
+        return "—"
+    return "∞" if value == float("inf") else f"{value:.2f}"
+
+
+# Расширенная статистика по всем закрытым сделкам
+@dp.callback_query(F.data == "stat_advanced")
+async def show_advanced_statistics(callback: CallbackQuery):
+    stats = await analytics.get_advanced_statistics(callback.from_user.id)
+
+    keyboard = InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text="🔙 Назад", callback_data="back_to_main_stats")]
+    ])
+    if not stats:
+        await outbound.edit_text(callback.message, "❗ У тебя пока нет закрытых сделок.", reply_markup=keyboard)
+        return
+
+    streak = stats["current_streak"]
+    current = f"{streak} в плюс" if streak > 0 else f"{-streak} в минус"
+    since = datetime.fromtimestamp(stats["first_trade_at"]).strftime("%d.%m.%Y")
+    text = (
+        f"📈 Расширенная статистика (с {since})\n\n"
+        f"📋 Закрыто сделок: {stats['total_trades']}\n"
+        f"💰 Итоговый профит: {stats['total_profit']:.2f} USDT\n"
+        f"🏆 Winrate: {stats['winrate']:.2f}%\n\n"
+        f"📉 Макс. просадка: {stats['max_drawdown']:.2f} USDT ({stats['max_drawdown_days']:.0f} дн.)\n"
+        f"⚖️ Profit factor: {format_ratio(stats['profit_factor'])}\n"
+        f"🎯 Матожидание: {stats['expectancy']:.2f} USDT ({stats['expectancy_pnl']:.2f}%) на сделку\n"
+        f"📐 Sharpe: {format_ratio(stats['sharpe'])}, Sortino: {format_ratio(stats['sortino'])} (на сделку)\n\n"
+        f"🔥 Лучшая серия: {stats['win_streak']} в плюс\n"
+        f"🧊 Худшая серия: {stats['loss_streak']} в минус\n"
+        f"➡️ Текущая серия: {current}"
+    )
+    await outbound.edit_text(callback.message, text, reply_markup=keyboard)
 
 
 
@@ -1097,7 +1136,7 @@ async def choose_coin(callback: CallbackQuery, state: FSMContext):
     markup = keyboard.as_markup()
 
     text = "🪙 Выбери монету из списка или укажи вручную.\n(Показаны монеты с активными или недавними сделками):"
-    await callback.message.edit_text(text, reply_markup=markup)
+    await outbound.edit_text(callback.message, text, reply_markup=markup)
 
 # Выбор монеты из списка
 @dp.callback_query(F.data.startswith("coin_stat:"))
@@ -1107,7 +1146,7 @@ async def show_coin_statistics(callback: CallbackQuery):
 
     stats = await db.get_coin_statistics(user_id, coin)
     if not stats:
-        await callback.message.edit_text("❗ Нет данных по выбранной монете.", reply_markup=await back_to_coin_stats_keyboard())
+        await outbound.edit_text(callback.message, "❗ Нет данных по выбранной монете.", reply_markup=await back_to_coin_stats_keyboard())
         return
 
     text = (
@@ -1120,22 +1159,22 @@ async def show_coin_statistics(callback: CallbackQuery):
     )
 
     keyboard = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="📅 Статистика за период", callback_data="coin_stat_period")],
-        [InlineKeyboardButton(text="📜 История сделок", callback_data="coin_trade_history")],
+        [InlineKeyboardButton(text="📅 Статистика за период", callback_data=f"coin_stat_period:{db.get_coin_id(coin)}")],
+        [InlineKeyboardButton(text="📜 История сделок", callback_data=f"coin_trade_history:{db.get_coin_id(coin)}")],
         [InlineKeyboardButton(text="🔙 Назад", callback_data="stat_coin")]
     ])
-    await callback.message.edit_text(text, reply_markup=keyboard)
+    await outbound.edit_text(callback.message, text, reply_markup=keyboard)
 
 # Обработка кнопки "Другая монета"
 @dp.callback_query(F.data == "coin_stat_manual")
 async def enter_manual_coin(callback: CallbackQuery, state: FSMContext):
     await state.set_state(CoinStatStates.entering_manual_coin)
-    await callback.message.edit_text("✍️ Пришли монету в формате BTC/USDT:")
+    await outbound.edit_text(callback.message, "✍️ Пришли монету в формате BTC/USDT:")
 
 # Обработка текстового ввода монеты
 @dp.message(CoinStatStates.entering_manual_coin)
 async def manual_coin_entered(message: Message, state: FSMContext):
-    coin = message.text.strip().upper()
+    coin = db.normalize_coin(message.text) or ""
     user_id = message.from_user.id
 
     stats = await db.get_coin_statistics(user_id, coin)
@@ -1157,13 +1196,177 @@ async def manual_coin_entered(message: Message, state: FSMContext):
     )
 
     keyboard = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="📅 Статистика за период", callback_data="coin_stat_period")],
-        [InlineKeyboardButton(text="📜 История сделок", callback_data="coin_trade_history")],
+        [InlineKeyboardButton(text="📅 Статистика за период", callback_data=f"coin_stat_period:{db.get_coin_id(coin)}")],
+        [InlineKeyboardButton(text="📜 История сделок", callback_data=f"coin_trade_history:{db.get_coin_id(coin)}")],
         [InlineKeyboardButton(text="🔙 Назад", callback_data="stat_coin")]
     ])
     await message.answer(text, reply_markup=keyboard)
     await state.clear()
 
+# id монеты из callback_data; None — мусор или кнопка старого формата с символом монеты
+def parse_coin_id(value: str) -> int | None:
+    return int(value) if value.isdigit() else None
+
+
+# Статистика по монете за период: 7/14/30 дней или свой период через тот же календарь,
+# что и общая статистика (монета хранится в данных PeriodStates под ключом stat_coin,
+# чтобы не затереть монету черновика сделки). В callback_data монета передаётся по id
+@dp.callback_query(F.data.startswith("coin_stat_period:"))
+async def choose_coin_period(callback: CallbackQuery):
+    coin_id = parse_coin_id(callback.data.split(":", 1)[1])
+    if coin_id is None:
+        await callback.answer("Кнопка устарела, открой статистику по монете заново")
+        return
+    coin = await db.get_coin_symbol(coin_id)
+    if coin is None:
+        await outbound.edit_text(callback.message, "❗ Нет данных по выбранной монете.",
+                                 reply_markup=await back_to_coin_stats_keyboard())
+        return
+    keyboard = InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text="📆 За 7 дней", callback_data=f"coin_period:{coin_id}:7")],
+        [InlineKeyboardButton(text="📆 За 14 дней", callback_data=f"coin_period:{coin_id}:14")],
+        [InlineKeyboardButton(text="📆 За 30 дней", callback_data=f"coin_period:{coin_id}:30")],
+        [InlineKeyboardButton(text="✍️ Свой период", callback_data=f"coin_period:{coin_id}:custom")],
+        [InlineKeyboardButton(text="🔙 Назад", callback_data=f"coin_stat:{coin}")]
+    ])
+    await outbound.edit_text(callback.message, f"📅 Выбери период для статистики по {coin}:", reply_markup=keyboard)
+
+@dp.callback_query(F.data.startswith("coin_period:"))
+async def handle_coin_period_choice(callback: CallbackQuery, state: FSMContext):
+    coin_id, choice = callback.data[len("coin_period:"):].rsplit(":", 1)
+    coin_id = parse_coin_id(coin_id)
+    if coin_id is None:
+        await callback.answer("Кнопка устарела, открой статистику по монете заново")
+        return
+    coin = await db.get_coin_symbol(coin_id)
+    back_keyboard = InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text="🔙 Назад", callback_data=f"coin_stat_period:{coin_id}")]
+    ])
+    if coin is None:
+        await outbound.edit_text(callback.message, "❗ Нет данных по выбранной монете.",
+                                 reply_markup=await back_to_coin_stats_keyboard())
+        return
+
+    if choice == "custom":
+        await state.set_state(PeriodStates.selecting_start_date)
+        await state.update_data(stat_coin=coin)
+        await outbound.edit_text(callback.message, "📅 Выбери дату начала периода:",
+                                 reply_markup=await calendar_with_back(f"coin_stat_period:{coin_id}"))
+        return
+
+    days = int(choice)
+    now = datetime.now()
+    end_date = now.strftime("%Y-%m-%d")
+    start_date = (now - timedelta(days=days)).strftime("%Y-%m-%d")
+
+    stats = await db.get_coin_period_statistics(callback.from_user.id, coin, start_date, end_date)
+    if not stats:
+        await outbound.edit_text(callback.message, f"❗ Нет закрытых сделок по {coin} за последние {days} дней.",
+                                 reply_markup=back_keyboard)
+        return
+
+    text = (
+        f"📅 Статистика по {coin} за последние {days} дней\n\n"
+        f"📈 Средний PnL: {stats['average_pnl']:.2f}%\n"
+        f"💰 Суммарный профит: {stats['total_profit']:.2f} USDT\n"
+        f"📋 Закрыто сделок: {stats['total_trades']}\n"
+        f"🏆 Winrate: {stats['winrate']:.2f}%"
+    )
+    await outbound.edit_text(callback.message, text, reply_markup=back_keyboard)
+
+
+COIN_HISTORY_PAGE_SIZE = 10
+
+# Страница истории закрытых сделок по монете, от новых к старым. Курсор — id крайней
+# сделки соседней страницы (coin_hist:<id монеты>:next:<id> / coin_hist:<id монеты>:prev:<id>);
+# from — страница, начинающаяся с этой сделки (возврат из карточки сделки).
+# В callback_data монета передаётся по id: символ может не уложиться в 64 байта
+async def render_coin_history_page(user_id: int, coin: str, direction: str = None, trade_id: int = None):
+    page_size = COIN_HISTORY_PAGE_SIZE
+    coin_id = db.get_coin_id(coin)
+    if coin_id is None:
+        return None
+    cursor = {"next": "after_id", "prev": "before_id", "from": "from_id"}.get(direction)
+    kwargs = {cursor: trade_id} if cursor else {}
+    trades = await db.get_coin_trade_history(user_id, coin, limit=page_size + 1, **kwargs)
+
+    # Лишняя (page_size + 1) строка показывает, есть ли ещё страница в ту же сторону
+    if direction == "prev":
+        has_prev, has_next = len(trades) > page_size, True
+        trades = trades[-page_size:]
+    else:
+        has_prev, has_next = direction in ("next", "from"), len(trades) > page_size
+        trades = trades[:page_size]
+
+    if not trades:
+        if direction is None:
+            return None
+        return await render_coin_history_page(user_id, coin)
+
+    buttons = []
+    for trade_id, closed_at, pnl, profit in trades:
+        mark = "✅" if (pnl or 0) > 0 else "❌"
+        text = f"{mark} {closed_at.split()[0]} · {pnl or 0:+.2f}% · {profit or 0:+.2f} USDT"
+        buttons.append([InlineKeyboardButton(text=text, callback_data=f"histinfo:{coin_id}:{trade_id}:{trades[0][0]}")])
+
+    navigation = []
+    if has_prev:
+        navigation.append(InlineKeyboardButton(text="⬅️ Новее", callback_data=f"coin_hist:{coin_id}:prev:{trades[0][0]}"))
+    if has_next:
+        navigation.append(InlineKeyboardButton(text="Старее ➡️", callback_data=f"coin_hist:{coin_id}:next:{trades[-1][0]}"))
+    if navigation:
+        buttons.append(navigation)
+    buttons.append([InlineKeyboardButton(text="🔙 Назад", callback_data=f"coin_stat:{coin}")])
+
+    return f"📜 История сделок по {coin} (сначала новые):", InlineKeyboardMarkup(inline_keyboard=buttons)
+
+
+# Кнопка "История сделок" в статистике по монете
+@dp.callback_query(F.data.startswith("coin_trade_history:"))
+async def show_coin_trade_history(callback: CallbackQuery):
+    coin_id = parse_coin_id(callback.data.split(":", 1)[1])
+    if coin_id is None:
+        await callback.answer("Кнопка устарела, открой статистику по монете заново")
+        return
+    coin = await db.get_coin_symbol(coin_id)
+    page = coin and await render_coin_history_page(callback.from_user.id, coin)
+
+    if not page:
+        await outbound.edit_text(callback.message, f"❗ Нет закрытых сделок по {coin or 'монете'}.",
+                                 reply_markup=await back_to_coin_stats_keyboard())
+        return
+
+    text, keyboard = page
+    await outbound.edit_text(callback.message, text, reply_markup=keyboard)
+
+# Листание истории сделок по монете
+@dp.callback_query(F.data.startswith("coin_hist:"))
+async def coin_trade_history_page(callback: CallbackQuery):
+    coin_id, direction, trade_id = callback.data[len("coin_hist:"):].rsplit(":", 2)
+    coin_id = parse_coin_id(coin_id)
+    if coin_id is None:
+        await callback.answer("Кнопка устарела, открой статистику по монете заново")
+        return
+    coin = await db.get_coin_symbol(coin_id)
+    page = coin and await render_coin_history_page(callback.from_user.id, coin, direction, int(trade_id))
+
+    if not page:
+        await outbound.edit_text(callback.message, f"❗ Нет закрытых сделок по {coin or 'монете'}.",
+                                 reply_markup=await back_to_coin_stats_keyboard())
+        return
+
+    text, keyboard = page
+    await outbound.edit_text(callback.message, text, reply_markup=keyboard)
+
+# Карточка сделки из истории; "назад" возвращает на ту же страницу истории
+@dp.callback_query(F.data.startswith("histinfo:"))
+async def show_history_trade_info(callback: CallbackQuery):
+    coin_id, trade_id, page_id = callback.data[len("histinfo:"):].rsplit(":", 2)
+    if parse_coin_id(coin_id) is None:
+        await callback.answer("Кнопка устарела, открой статистику по монете заново")
+        return
+    await render_trade_info_message(callback, int(trade_id), back_callback=f"coin_hist:{coin_id}:from:{page_id}")
+
 # Функция возврата к выбору монеты
 async def back_to_coin_stats_keyboard():
     keyboard = InlineKeyboardMarkup(inline_keyboard=[
@@ -1172,6 +1375,118 @@ async def back_to_coin_stats_keyboard():
     return keyboard
 
 
+# Импорт истории сделок из CSV
+@dp.message(F.text == "/import")
+async def import_help(message: Message):
+    await message.answer(importer.IMPORT_HELP)
+
+
+@dp.message(F.document)
+async def import_document(message: Message):
+    document = message.document
+    if not (document.file_name or "").lower().endswith(".csv"):
+        await message.answer("📎 Для импорта сделок пришли файл .csv (формат: /import)")
+        return
+
+    status = await message.answer("⏳ Загружаю файл...")
+
+    async def progress(imported: int, skipped: int):
+        await outbound.edit_text(status, f"⏳ Импорт идёт: загружено {imported}, пропущено {skipped}")
+
+    try:
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "import.csv")
+            await bot.download(document, destination=path)
+            result = await importer.import_csv(path, message.from_user.id, message.chat.id, progress=progress)
+    except (importer.ImportRowError, UnicodeDecodeError, csv.Error) as e:
+        await outbound.edit_text(status, f"❌ Не удалось прочитать файл: {e}")
+        return
+    except Exception:
+        # Статус не должен навсегда остаться "⏳": уже записанные пачки сохранены
+        await outbound.edit_text(status, "❌ Импорт прерван из-за ошибки, часть строк могла быть загружена")
+        raise
+
+    text = f"✅ Импорт завершён: загружено {result['imported']}, пропущено {result['skipped']}"
+    if result["errors"]:
+        text += "\n\nОшибки:\n" + "\n".join(result["errors"])
+        if result["skipped"] > len(result["errors"]):
+            text += f"\n...и ещё {result['skipped'] - len(result['errors'])}"
+    await outbound.edit_text(status, text)
+
+
+# Экспорт журнала сделок в файл
+EXPORT_PERIODS = (("30 дней", "30"), ("90 дней", "90"), ("Всё время", "all"))
+
+
+def export_keyboard() -> InlineKeyboardMarkup:
+    formats = [fmt for fmt in exporter.FORMATS if fmt != "parquet" or exporter.parquet_available()]
+    return InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text=f"{label} · {fmt.upper()}", callback_data=f"export:{fmt}:{days}")
+         for fmt in formats]
+        for label, days in EXPORT_PERIODS
+    ])
+
+
+async def send_export(message: Message, user_id: int, fmt: str, start_date: str = None,
+                      end_date: str = None, coin: str = None):
+    status = await message.answer("⏳ Готовлю файл...")
+    with tempfile.TemporaryDirectory() as tmp:
+        name = f"trades_{coin or 'all'}_{datetime.now().strftime('%Y%m%d')}.{fmt}"
+        path = os.path.join(tmp, name)
+        try:
+            count = await exporter.export_trades(path, user_id, fmt, start_date, end_date, coin)
+        except (RuntimeError, ValueError) as e:
+            await outbound.edit_text(status, f"❌ {e}")
+            return
+        if not count:
+            await outbound.edit_text(status, "📭 Нет сделок для выгрузки")
+            return
+        await bot.send_document(message.chat.id, FSInputFile(path, filename=name),
+                                caption=f"📤 Сделок в файле: {count}")
+    await outbound.edit_text(status, "✅ Экспорт готов")
+
+
+@dp.message(F.text == "📤 Экспорт")
+async def export_menu(message: Message):
+    await message.answer(
+        "📤 Выгрузка журнала сделок. За период — только закрытые сделки, «Всё время» — все.\n"
+        "Фильтр по монете и свои даты: /export BTC 2024-01-01 2024-03-31 csv",
+        reply_markup=export_keyboard()
+    )
+
+
+@dp.callback_query(F.data.startswith("export:"))
+async def export_callback(callback: CallbackQuery):
+    _, fmt, days = callback.data.split(":")
+    start_date = None
+    if days != "all":
+        start_date = (datetime.now() - timedelta(days=int(days))).strftime("%Y-%m-%d")
+    await callback.answer()
+    await send_export(callback.message, callback.from_user.id, fmt, start_date=start_date)
+
+
+# /export [монета] [дата_начала дата_конца] [csv|parquet]
+@dp.message(F.text.startswith("/export"))
+async def export_command(message: Message):
+    coin = None
+    dates = []
+    fmt = "csv"
+    for arg in message.text.split()[1:]:
+        if arg.lower() in exporter.FORMATS:
+            fmt = arg.lower()
+            continue
+        try:
+            datetime.strptime(arg, "%Y-%m-%d")
+            dates.append(arg)
+        except ValueError:
+            coin = db.normalize_coin(arg)
+    if len(dates) not in (0, 2):
+        await message.answer("❗ Укажи обе даты периода: /export 2024-01-01 2024-03-31")
+        return
+    start_date, end_date = dates or (None, None)
+    await send_export(message, message.from_user.id, fmt, start_date, end_date, coin)
+
+
 
 
 # 
@@ -1201,10 +1516,166 @@ async def back_to_coin_stats_keyboard():
 
 
 
-# Точка входа в приложение (запуск бота)
-async def main():
+# Режим нескольких процессов (WORKERS > 1): этот процесс только принимает апдейты
+# (вебхук или long polling) и раздаёт их процессам-воркерам по id пользователя
+async def run_supervisor(count: int):
+    # Миграции — один раз, до запуска воркеров
+    await db.init_pool(size=1)
     await db.init_db()
-    await dp.start_polling(bot)
+    await db.close_pool()
+
+    supervisor = workers.Supervisor(
+        count,
+        [sys.executable, os.path.abspath(__file__), "--worker"],
+        health_interval=getattr(config, "WORKER_HEALTH_INTERVAL", workers.HEALTH_INTERVAL)
+    )
+    await supervisor.start()
+    metrics.register_collector("workers", supervisor.metrics)
+    metrics_runner = None
+    if getattr(config, "METRICS_PORT", None):
+        metrics_runner = await metrics.start_server(
+            host=getattr(config, "METRICS_HOST", metrics.METRICS_HOST),
+            port=config.METRICS_PORT
+        )
+    summary_task = asyncio.create_task(
+        supervisor.log_summary(getattr(config, "METRICS_LOG_INTERVAL", metrics.METRICS_LOG_INTERVAL))
+    )
+    try:
+        if getattr(config, "MODE", "polling") == "webhook":
+            path = getattr(config, "WEBHOOK_PATH", WEBHOOK_PATH)
+            secret = getattr(config, "WEBHOOK_SECRET", None)
+            max_inflight = getattr(config, "WEBHOOK_MAX_INFLIGHT", MAX_INFLIGHT)
+            await run_webhook(
+                dp, bot,
+                url=getattr(config, "WEBHOOK_URL", None),
+                path=path,
+                secret=secret,
+                host=getattr(config, "WEBAPP_HOST", WEBAPP_HOST),
+                port=getattr(config, "WEBAPP_PORT", WEBAPP_PORT),
+                max_inflight=max_inflight,
+                server=workers.ForwardingWebhookServer(
+                    supervisor, dp, bot, path=path, secret=secret, max_inflight=max_inflight
+                )
+            )
+        else:
+            try:
+                await workers.poll(supervisor, dp, bot)
+            finally:
+                await bot.session.close()
+    finally:
+        summary_task.cancel()
+        await supervisor.stop()
+        if metrics_runner is not None:
+            await metrics_runner.cleanup()
+
+
+# Точка входа в приложение (запуск бота). worker — номер процесса-воркера, если бот
+# запущен супервизором; без него бот работает одним процессом или сам становится супервизором
+async def main(worker: int = None):
+    logging.basicConfig(
+        level=logging.INFO,
+        format=("" if worker is None else f"[w{worker}] ") + "%(asctime)s %(levelname)s %(name)s: %(message)s"
+    )
+    count = getattr(config, "WORKERS", 1)
+    if worker is None and count > 1:
+        await run_supervisor(count)
+        return
+    db.tracer.configure(
+        slow_ms=getattr(config, "SLOW_QUERY_MS", None),
+        sample_rate=getattr(config, "TRACE_SAMPLE_RATE", None)
+    )
+    if getattr(config, "SLOW_QUERY_LOG", None):
+        db.slow_query_log.addHandler(logging.FileHandler(config.SLOW_QUERY_LOG, encoding="utf-8"))
+    await db.init_pool(size=getattr(config, "DB_POOL_SIZE", db.POOL_SIZE))
+    stats_cache.configure(
+        max_entries=getattr(config, "CACHE_MAX_ENTRIES", None),
+        max_bytes=getattr(config, "CACHE_MAX_BYTES", None)
+    )
+    trade_cache.configure(max_entries=getattr(config, "TRADE_CACHE_SIZE", None))
+    await db.init_db()
+    await db.start_writer(
+        window=getattr(config, "WRITE_BATCH_WINDOW", db.WRITE_BATCH_WINDOW),
+        max_batch=getattr(config, "WRITE_BATCH_MAX", db.WRITE_BATCH_MAX)
+    )
+    await storage.start()
+    if worker is not None:
+        # Лимит Telegram на весь бот делится между воркерами
+        outbound.set_global_rate(
+            getattr(config, "SEND_RATE_GLOBAL", GLOBAL_RATE) / count, max(1, GLOBAL_BURST // count)
+        )
+
+    metrics.register_collector("pool", db.get_pool_metrics)
+    metrics.register_collector("writer", db.get_writer_metrics)
+    metrics.register_collector("cache", db.get_cache_metrics)
+    metrics.register_collector("trade_cache", db.get_trade_cache_metrics)
+    metrics.register_collector("outbound", outbound.metrics)
+    metrics.register_collector("fsm", storage.metrics)
+    metrics.register_collector("queries", db.get_query_metrics)
+    price_task = None
+    alert_engine = None
+    # Фоновое обновление цен и уведомления — в одном процессе: иначе они бы дублировались
+    primary = worker is None or worker == workers.PRIMARY
+    if price_feed is not None:
+        metrics.register_collector("prices", price_feed.metrics)
+    if price_feed is not None and primary:
+        if getattr(config, "PRICE_ALERTS", True):
+            # Подписка до загрузки, чтобы не пропустить сделки, открытые во время неё
+            alert_engine = AlertEngine(
+                outbound.send_message,
+                auto_close=getattr(config, "AUTO_CLOSE", False),
+                exit_fee=getattr(config, "AUTO_CLOSE_EXIT_FEE", TARGET_STOP_EXIT_FEE)
+            )
+            db.trade_listeners.append(alert_engine)
+            await alert_engine.load()
+            price_feed.listeners.append(alert_engine.on_prices)
+            metrics.register_collector("alerts", alert_engine.metrics)
+        price_task = asyncio.create_task(price_feed.run(
+            db.get_open_coins,
+            interval=getattr(config, "PRICE_REFRESH_INTERVAL", prices.PRICE_REFRESH_INTERVAL)
+        ))
+    metrics_runner = None
+    # У воркеров метрики отдаёт супервизор (по их отчётам о нагрузке)
+    if getattr(config, "METRICS_PORT", None) and worker is None:
+        metrics_runner = await metrics.start_server(
+            host=getattr(config, "METRICS_HOST", metrics.METRICS_HOST),
+            port=config.METRICS_PORT
+        )
+    summary_task = asyncio.create_task(
+        metrics.log_summary(getattr(config, "METRICS_LOG_INTERVAL", metrics.METRICS_LOG_INTERVAL))
+    )
+    try:
+        if worker is not None:
+            await workers.run_worker(
+                dp, bot, worker,
+                max_inflight=getattr(config, "WEBHOOK_MAX_INFLIGHT", MAX_INFLIGHT),
+                health_interval=getattr(config, "WORKER_HEALTH_INTERVAL", workers.HEALTH_INTERVAL)
+            )
+        elif getattr(config, "MODE", "polling") == "webhook":
+            await run_webhook(
+                dp, bot,
+                url=getattr(config, "WEBHOOK_URL", None),
+                path=getattr(config, "WEBHOOK_PATH", WEBHOOK_PATH),
+                secret=getattr(config, "WEBHOOK_SECRET", None),
+                host=getattr(config, "WEBAPP_HOST", WEBAPP_HOST),
+                port=getattr(config, "WEBAPP_PORT", WEBAPP_PORT),
+                max_inflight=getattr(config, "WEBHOOK_MAX_INFLIGHT", MAX_INFLIGHT)
+            )
+        else:
+            await dp.start_polling(bot)
+    finally:
+        summary_task.cancel()
+        if price_task is not None:
+            price_task.cancel()
+            await price_feed.close()
+        if alert_engine is not None:
+            await alert_engine.close()
+        if metrics_runner is not None:
+            await metrics_runner.cleanup()
+        await db.stop_writer()
+        await db.close_pool()
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    parser = argparse.ArgumentParser(description="Телеграм-бот журнала сделок")
+    parser.add_argument("--worker", type=int, default=None, help="номер процесса-воркера (запускает супервизор)")
+    args = parser.parse_args()
+    asyncio.run(main(worker=args.worker))
@@ -0,0 +1,225 @@
+import sqlite3
+import sys
+from collections import OrderedDict
+from functools import wraps
+
+MAX_ENTRIES = 10000
+MAX_BYTES = 32 * 1024 * 1024
+TRADE_CACHE_SIZE = 2000        # карточек сделок в кэше по id
+
+
+# Приблизительный размер значения в памяти (строки, списки, кортежи, словари, sqlite3.Row)
+def estimate_size(value) -> int:
+    size = sys.getsizeof(value)
+    if isinstance(value, dict):
+        size += sum(estimate_size(k) + estimate_size(v) for k, v in value.items())
+    elif isinstance(value, (list, tuple, set, sqlite3.Row)):
+        size += sum(estimate_size(item) for item in value)
+    return size
+
+
+# LRU-кэш результатов запросов по пользователям.
+# Ключ кэша всегда начинается с user_id, чтобы запись сделки сбрасывала только его данные.
+# Значения по одной монете (ключ (user_id, имя, (coin, ...))) помечаются монетой: запись
+# сделки по монете сбрасывает общие значения пользователя и значения этой монеты,
+# а статистика по остальным монетам остаётся в кэше
+class UserCache:
+    def __init__(self, max_entries: int = MAX_ENTRIES, max_bytes: int = MAX_BYTES):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()   # key -> (value, size, coin)
+        self._user_keys = {}            # user_id -> set(key)
+        self._generations = {}          # user_id / (user_id, coin) -> номер поколения данных
+        self._full_generations = {}     # user_id -> номер поколения, сбрасываемого целиком
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def configure(self, max_entries: int = None, max_bytes: int = None):
+        if max_entries is not None:
+            self.max_entries = max_entries
+        if max_bytes is not None:
+            self.max_bytes = max_bytes
+        self._shrink()
+
+    # Поколение данных, от которых зависит значение: любые записи пользователя для общих
+    # значений, записи по монете и полный сброс пользователя — для значений по монете
+    def generation(self, user_id: int, coin: str = None):
+        if coin is None:
+            return self._generations.get(user_id, 0)
+        return self._full_generations.get(user_id, 0), self._generations.get((user_id, coin), 0)
+
+    def get(self, key) -> tuple[bool, object]:
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return False, None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return True, entry[0]
+
+    # Значение сохраняется, только если данные пользователя не менялись с момента чтения
+    def set(self, key, value, generation, coin: str = None):
+        user_id = key[0]
+        if generation != self.generation(user_id, coin):
+            return
+
+        size = estimate_size(value)
+        if size > self.max_bytes:
+            return
+
+        self._remove(key)
+        self._entries[key] = (value, size, coin)
+        self._user_keys.setdefault(user_id, set()).add(key)
+        self.bytes += size
+        self._shrink()
+
+    # Сброс после записи сделок пользователя. coins — монеты затронутых сделок;
+    # None — сбросить все значения пользователя
+    def invalidate_user(self, user_id: int, coins=None):
+        self._generations[user_id] = self.generation(user_id) + 1
+        if coins is None:
+            self._full_generations[user_id] = self._full_generations.get(user_id, 0) + 1
+            keys = self._user_keys.pop(user_id, ())
+        else:
+            coins = set(coins)
+            for coin in coins:
+                self._generations[(user_id, coin)] = self._generations.get((user_id, coin), 0) + 1
+            keys = [
+                key for key in self._user_keys.get(user_id, ())
+                if self._entries[key][2] is None or self._entries[key][2] in coins
+            ]
+
+        for key in list(keys):
+            if key in self._entries:
+                self._remove(key)
+                self.invalidations += 1
+
+    def clear(self):
+        self._entries.clear()
+        self._user_keys.clear()
+        self.bytes = 0
+
+    def _remove(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return
+        self.bytes -= entry[1]
+        keys = self._user_keys.get(key[0])
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self._user_keys[key[0]]
+
+    def _shrink(self):
+        while self._entries and (len(self._entries) > self.max_entries or self.bytes > self.max_bytes):
+            oldest = next(iter(self._entries))
+            self._remove(oldest)
+            self.evictions += 1
+
+    def stats(self) -> dict:
+        return {
+            "entries": len(self._entries),
+            "bytes": self.bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "invalidations": self.invalidations,
+        }
+
+
+stats_cache = UserCache()
+
+
+# LRU-кэш карточек сделок по id (read-through: при промахе значение читает вызывающий).
+# Сделка меняется только при закрытии, поэтому закрытие сбрасывает её запись.
+# Значение, прочитанное до сброса, в кэш уже не попадает (как в UserCache)
+class TradeCache:
+    def __init__(self, max_entries: int = TRADE_CACHE_SIZE):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()   # trade_id -> значение
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def configure(self, max_entries: int = None):
+        if max_entries is not None:
+            self.max_entries = max_entries
+        self._shrink()
+
+    def get(self, trade_id: int) -> tuple[bool, object]:
+        value = self._entries.get(trade_id)
+        if value is None:
+            self.misses += 1
+            return False, None
+        self._entries.move_to_end(trade_id)
+        self.hits += 1
+        return True, value
+
+    def set(self, trade_id: int, value, generation: int):
+        if generation != self.generation or self.max_entries <= 0:
+            return
+        self._entries[trade_id] = value
+        self._entries.move_to_end(trade_id)
+        self._shrink()
+
+    def invalidate(self, trade_id: int):
+        self.generation += 1
+        if self._entries.pop(trade_id, None) is not None:
+            self.invalidations += 1
+
+    def _shrink(self):
+        while len(self._entries) > max(self.max_entries, 0):
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def stats(self) -> dict:
+        return {
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "invalidations": self.invalidations,
+        }
+
+
+trade_cache = TradeCache()
+
+
+# Декоратор для функций чтения из database.py, у которых первый аргумент — user_id
+def cached(func):
+    @wraps(func)
+    async def wrapper(user_id: int, *args, **kwargs):
+        key = (user_id, func.__name__, args, tuple(sorted(kwargs.items())))
+        found, value = stats_cache.get(key)
+        if found:
+            return value
+
+        generation = stats_cache.generation(user_id)
+        value = await func(user_id, *args, **kwargs)
+        stats_cache.set(key, value, generation)
+        return value
+
+    return wrapper
+
+
+# То же для функций (user_id, coin, ...): значение сбрасывается только записью сделки
+# пользователя по этой монете
+def cached_per_coin(func):
+    @wraps(func)
+    async def wrapper(user_id: int, coin: str, *args, **kwargs):
+        key = (user_id, func.__name__, (coin,) + args, tuple(sorted(kwargs.items())))
+        found, value = stats_cache.get(key)
+        if found:
+            return value
+
+        generation = stats_cache.generation(user_id, coin)
+        value = await func(user_id, coin, *args, **kwargs)
+        stats_cache.set(key, value, generation, coin)
+        return value
+
+    return wrapper
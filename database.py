@@ -1,9 +1,442 @@
+import asyncio
+import contextvars
+import logging
+import random
+import time
 import aiosqlite
+from collections import OrderedDict
+from typing import NamedTuple
+from cache import cached, cached_per_coin, stats_cache, trade_cache
+from metrics import timed
+from trade_logic import close_result
+from contextlib import asynccontextmanager
 from datetime import datetime, timedelta
 
+DB_PATH = "trades.db"
+POOL_SIZE = 4
+STATEMENT_CACHE_SIZE = 256
+WRITE_BATCH_WINDOW = 0.005    # сколько секунд писатель ждёт попутные записи
+WRITE_BATCH_MAX = 64          # максимум записей в одной транзакции
+SLOW_QUERY_MS = 100.0         # запросы дольше этого попадают в журнал медленных запросов
+TRACE_SAMPLE_RATE = 1.0       # доля замеряемых запросов (0..1)
+
+# Настройки, которые применяются к каждому соединению пула
+PRAGMAS = (
+    "PRAGMA journal_mode = WAL",
+    "PRAGMA synchronous = NORMAL",
+    "PRAGMA busy_timeout = 5000",
+    "PRAGMA temp_store = MEMORY",
+    "PRAGMA cache_size = -16000",
+    "PRAGMA mmap_size = 134217728",
+)
+
+# Сколько времени текущая задача провела в базе (ожидание соединения, запросы, ожидание
+# COMMIT записи). Счётчик включается установкой списка [0.0], например в нагрузочном стенде
+db_time = contextvars.ContextVar("db_time", default=None)
+
+
+def _account_db_time(elapsed: float):
+    spent = db_time.get()
+    if spent is not None:
+        spent[0] += elapsed
+
+
+# Пул долгоживущих соединений: каждое соединение держит свой поток aiosqlite
+# и свой кэш подготовленных запросов, поэтому их не пересоздаём на каждый вызов
+class ConnectionPool:
+    def __init__(self, path: str = DB_PATH, size: int = POOL_SIZE):
+        self.path = path
+        self.size = size
+        self._connections = []
+        self._idle = None
+        self.in_use = 0
+        self.waiting = 0
+        self.acquire_count = 0
+        self.acquire_time_total = 0.0
+        self.acquire_time_max = 0.0
+
+    @property
+    def is_open(self) -> bool:
+        return bool(self._connections)
+
+    async def open(self):
+        if self.is_open:
+            return
+        self._idle = asyncio.LifoQueue()
+        for _ in range(self.size):
+            conn = await aiosqlite.connect(self.path, cached_statements=STATEMENT_CACHE_SIZE)
+            conn.row_factory = aiosqlite.Row
+            for pragma in PRAGMAS:
+                await conn.execute(pragma)
+            self._connections.append(conn)
+            self._idle.put_nowait(conn)
+
+    async def close(self):
+        connections, self._connections = self._connections, []
+        for conn in connections:
+            await conn.close()
+        self._idle = None
+
+    @asynccontextmanager
+    async def acquire(self):
+        if not self.is_open:
+            raise RuntimeError("Пул соединений не открыт: сначала вызови init_pool()")
+
+        started = time.perf_counter()
+        self.waiting += 1
+        try:
+            conn = await self._idle.get()
+        finally:
+            self.waiting -= 1
+
+        elapsed = time.perf_counter() - started
+        self.acquire_count += 1
+        self.acquire_time_total += elapsed
+        self.acquire_time_max = max(self.acquire_time_max, elapsed)
+
+        self.in_use += 1
+        try:
+            yield conn
+        except BaseException:
+            # Не отдаём в пул соединение с незавершённой транзакцией
+            if conn.in_transaction:
+                await conn.rollback()
+            raise
+        finally:
+            self.in_use -= 1
+            if self._idle is not None:
+                self._idle.put_nowait(conn)
+            _account_db_time(time.perf_counter() - started)
+
+    def metrics(self) -> dict:
+        return {
+            "size": self.size,
+            "in_use": self.in_use,
+            "waiting": self.waiting,
+            "acquire_count": self.acquire_count,
+            "acquire_time_avg": self.acquire_time_total / self.acquire_count if self.acquire_count else 0.0,
+            "acquire_time_max": self.acquire_time_max,
+        }
+
+
+pool = ConnectionPool()
+
+
+# Открытие пула соединений (вызывается один раз при старте бота)
+async def init_pool(path: str = DB_PATH, size: int = POOL_SIZE):
+    pool.path = path
+    pool.size = size
+    await pool.open()
+
+
+# Закрытие пула при остановке бота
+async def close_pool():
+    await pool.close()
+
+
+# Метрики пула: занятые соединения, ожидающие корутины, время получения соединения
+def get_pool_metrics() -> dict:
+    return pool.metrics()
+
+
+# Метрики кэша статистики: попадания, промахи, вытеснения
+def get_cache_metrics() -> dict:
+    return stats_cache.stats()
+
+
+def get_trade_cache_metrics() -> dict:
+    return trade_cache.stats()
+
+
+slow_query_log = logging.getLogger("slow_queries")
+
+
+# Форма параметров без значений: (int, str, NoneType); для executemany — число строк × форма
+def params_shape(params, many: bool = False) -> str:
+    if many:
+        params = list(params)
+        first = params[0] if params else ()
+        return f"{len(params)} × {params_shape(first)}"
+    return "(" + ", ".join(type(value).__name__ for value in params) + ")"
+
+
+# Трассировка SQL: каждый запрос бота проходит через fetch_all/fetch_one/traced_execute/
+# traced_executemany. Замеряется доля sample_rate запросов; запросы дольше slow_ms пишутся
+# в журнал slow_queries вместе с EXPLAIN QUERY PLAN (план по тексту запроса кэшируется)
+class QueryTracer:
+    def __init__(self, slow_ms: float = SLOW_QUERY_MS, sample_rate: float = TRACE_SAMPLE_RATE):
+        self.slow_ms = slow_ms
+        self.sample_rate = sample_rate
+        self._plans = OrderedDict()     # текст запроса -> план
+        self._statements = {}           # текст запроса -> [вызовов, суммарное время, максимум, строк]
+        self.traced = 0
+        self.slow = 0
+
+    def configure(self, slow_ms: float = None, sample_rate: float = None):
+        if slow_ms is not None:
+            self.slow_ms = slow_ms
+        if sample_rate is not None:
+            self.sample_rate = sample_rate
+
+    def sampled(self) -> bool:
+        return self.sample_rate >= 1 or random.random() < self.sample_rate
+
+    async def record(self, conn, sql: str, params, elapsed: float, rows: int, many: bool = False):
+        self.traced += 1
+        stats = self._statements.get(sql)
+        if stats is None:
+            stats = self._statements[sql] = [0, 0.0, 0.0, 0]
+        stats[0] += 1
+        stats[1] += elapsed
+        stats[2] = max(stats[2], elapsed)
+        stats[3] += max(rows, 0)
+
+        # Пакетный запрос считается медленным по времени на одну строку
+        per_call = elapsed / max(len(params), 1) if many else elapsed
+        if per_call * 1000 < self.slow_ms:
+            return
+        self.slow += 1
+        plan = await self._plan(conn, sql, params, many)
+        slow_query_log.warning(
+            "%.1f ms, rows=%s, params=%s\n%s\nplan: %s",
+            elapsed * 1000, rows, params_shape(params, many), " ".join(sql.split()), " | ".join(plan) or "-"
+        )
+
+    async def _plan(self, conn, sql: str, params, many: bool) -> list[str]:
+        plan = self._plans.get(sql)
+        if plan is not None:
+            self._plans.move_to_end(sql)
+            return plan
+        if many:
+            params = next(iter(params), ())
+        try:
+            cursor = await conn.execute("EXPLAIN QUERY PLAN " + sql, params)
+            plan = [row[3] for row in await cursor.fetchall()]
+        except Exception as e:
+            plan = [f"план недоступен: {e}"]
+        self._plans[sql] = plan
+        if len(self._plans) > STATEMENT_CACHE_SIZE:
+            self._plans.popitem(last=False)
+        return plan
+
+    # Самые затратные запросы по суммарному времени
+    def top(self, limit: int = 10) -> list[dict]:
+        ranked = sorted(self._statements.items(), key=lambda item: item[1][1], reverse=True)[:limit]
+        return [
+            {"sql": " ".join(sql.split()), "calls": calls, "total_ms": total * 1000,
+             "max_ms": longest * 1000, "rows": rows}
+            for sql, (calls, total, longest, rows) in ranked
+        ]
+
+    def metrics(self) -> dict:
+        return {
+            "traced": self.traced,
+            "slow": self.slow,
+            "statements": len(self._statements),
+            "sample_rate": self.sample_rate,
+        }
+
+
+tracer = QueryTracer()
+
+
+async def _traced(conn, sql: str, params, call, count_rows, many: bool = False):
+    if not tracer.sampled():
+        return await call()
+    started = time.perf_counter()
+    result = await call()
+    await tracer.record(conn, sql, params, time.perf_counter() - started, count_rows(result), many)
+    return result
+
+
+async def fetch_all(conn, sql: str, params=()) -> list:
+    async def call():
+        cursor = await conn.execute(sql, params)
+        return await cursor.fetchall()
+
+    return await _traced(conn, sql, params, call, len)
+
+
+async def fetch_one(conn, sql: str, params=()):
+    async def call():
+        cursor = await conn.execute(sql, params)
+        return await cursor.fetchone()
+
+    return await _traced(conn, sql, params, call, lambda row: 0 if row is None else 1)
+
+
+# Запрос на изменение; возвращает курсор (lastrowid, rowcount)
+async def traced_execute(conn, sql: str, params=()):
+    return await _traced(conn, sql, params, lambda: conn.execute(sql, params), lambda cursor: cursor.rowcount)
+
+
+async def traced_executemany(conn, sql: str, params_seq):
+    params_seq = list(params_seq)
+    return await _traced(
+        conn, sql, params_seq, lambda: conn.executemany(sql, params_seq), lambda cursor: cursor.rowcount, many=True
+    )
+
+
+# Метрики трассировки: сколько запросов замерено и сколько из них медленных
+def get_query_metrics() -> dict:
+    return tracer.metrics()
+
+
+# Единственный писатель: забирает операции записи из очереди и объединяет те,
+# что пришли в пределах короткого окна, в одну транзакцию (один fsync на пачку).
+# Операция — корутина, принимающая соединение; ожидающий получает её результат
+# только после COMMIT той пачки, в которую она попала
+class WriteQueue:
+    def __init__(self, path: str = DB_PATH, window: float = WRITE_BATCH_WINDOW, max_batch: int = WRITE_BATCH_MAX):
+        self.path = path
+        self.window = window
+        self.max_batch = max_batch
+        self._queue = None
+        self._conn = None
+        self._task = None
+        self.batches = 0
+        self.writes = 0
+        self.failed_batches = 0
+        self.last_batch_size = 0
+        self.max_batch_size = 0
+        self.commit_time_total = 0.0
+
+    @property
+    def is_running(self) -> bool:
+        return self._task is not None
+
+    async def start(self):
+        if self.is_running:
+            return
+        self._conn = await aiosqlite.connect(self.path, cached_statements=STATEMENT_CACHE_SIZE)
+        self._conn.row_factory = aiosqlite.Row
+        for pragma in PRAGMAS:
+            await self._conn.execute(pragma)
+        # Запись подтверждается только после fsync: пачки делают его дешёвым
+        await self._conn.execute("PRAGMA synchronous = FULL")
+        self._queue = asyncio.Queue()
+        self._task = asyncio.create_task(self._run())
+
+    # Остановка: уже поставленные в очередь записи дописываются до конца
+    async def stop(self):
+        if not self.is_running:
+            return
+        self._queue.put_nowait(None)
+        await self._task
+        self._task = None
+        await self._conn.close()
+        self._conn = None
+
+    async def submit(self, operation):
+        if not self.is_running:
+            raise RuntimeError("Очередь записи не запущена: сначала вызови start_writer()")
+        started = time.perf_counter()
+        future = asyncio.get_running_loop().create_future()
+        self._queue.put_nowait((operation, future))
+        try:
+            return await future
+        finally:
+            _account_db_time(time.perf_counter() - started)
+
+    async def _run(self):
+        stopping = False
+        while not stopping:
+            item = await self._queue.get()
+            if item is None:
+                break
+
+            batch = [item]
+            stopping = self._drain(batch)
+            if not stopping and self.window and len(batch) < self.max_batch:
+                await asyncio.sleep(self.window)
+                stopping = self._drain(batch)
+
+            await self._commit_batch(batch)
+
+    # Забирает из очереди всё, что уже пришло; True, если встретился сигнал остановки
+    def _drain(self, batch: list) -> bool:
+        while len(batch) < self.max_batch and not self._queue.empty():
+            item = self._queue.get_nowait()
+            if item is None:
+                return True
+            batch.append(item)
+        return False
+
+    async def _commit_batch(self, batch: list):
+        started = time.perf_counter()
+        outcomes = []
+        try:
+            await self._conn.execute("BEGIN IMMEDIATE")
+            for operation, future in batch:
+                # Каждая операция в своей точке сохранения: ошибка одной не откатывает соседей
+                await self._conn.execute("SAVEPOINT write_op")
+                try:
+                    result = await operation(self._conn)
+                except Exception as e:
+                    await self._conn.execute("ROLLBACK TO write_op")
+                    outcomes.append((future, None, e))
+                else:
+                    outcomes.append((future, result, None))
+                await self._conn.execute("RELEASE write_op")
+            await self._conn.commit()
+        except Exception as e:
+            if self._conn.in_transaction:
+                await self._conn.rollback()
+            self.failed_batches += 1
+            outcomes = [(future, None, e) for _, future in batch]
+
+        elapsed = time.perf_counter() - started
+        self.batches += 1
+        self.writes += len(batch)
+        self.last_batch_size = len(batch)
+        self.max_batch_size = max(self.max_batch_size, len(batch))
+        self.commit_time_total += elapsed
+
+        for future, result, error in outcomes:
+            if future.done():
+                continue
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(result)
+
+    def metrics(self) -> dict:
+        return {
+            "queue_depth": self._queue.qsize() if self._queue is not None else 0,
+            "batches": self.batches,
+            "writes": self.writes,
+            "failed_batches": self.failed_batches,
+            "last_batch_size": self.last_batch_size,
+            "max_batch_size": self.max_batch_size,
+            "avg_batch_size": self.writes / self.batches if self.batches else 0.0,
+            "commit_time_avg": self.commit_time_total / self.batches if self.batches else 0.0,
+        }
+
+
+writer = WriteQueue()
+
+
+# Запуск писателя (вызывается один раз при старте бота, после init_pool)
+async def start_writer(window: float = WRITE_BATCH_WINDOW, max_batch: int = WRITE_BATCH_MAX):
+    writer.path = pool.path
+    writer.window = window
+    writer.max_batch = max_batch
+    await writer.start()
+
+
+# Остановка писателя: дописывает очередь и закрывает соединение
+async def stop_writer():
+    await writer.stop()
+
+
+# Метрики очереди записи: глубина очереди и размеры пачек
+def get_writer_metrics() -> dict:
+    return writer.metrics()
+
+
 # Инициализация базы данных
 async def init_db():
-    async with aiosqlite.connect("trades.db") as db:
+    async with pool.acquire() as db:
         await db.execute('''
         CREATE TABLE IF NOT EXISTS trades (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -28,21 +461,277 @@ async def init_db():
         );
         ''')
         await db.commit()
+        await migrate_db(db)
+        await load_coins(db)
+
+
+# Дневные итоги по закрытым сделкам: одна строка на (пользователь, день, монета).
+# Сделки без монеты учитываются под coin_id = 0.
+# Пересчёт всей таблицы из trades (для миграции и ручного backfill)
+SQL_REBUILD_DAILY_STATS = '''
+    DELETE FROM daily_stats;
+    INSERT INTO daily_stats (user_id, day, coin_id, trades_count, wins, sum_pnl, sum_profit)
+    SELECT user_id, DATE(closed_at), COALESCE(coin_id, 0), COUNT(*), TOTAL(pnl > 0), TOTAL(pnl), TOTAL(profit_usdt)
+    FROM trades
+    WHERE status = 'закрыта' AND closed_at IS NOT NULL
+    GROUP BY user_id, DATE(closed_at), COALESCE(coin_id, 0);
+'''
+
+# Добавление одной закрытой сделки в дневные итоги
+SQL_ADD_TO_DAILY_STATS = '''
+    INSERT INTO daily_stats (user_id, day, coin_id, trades_count, wins, sum_pnl, sum_profit)
+    SELECT user_id, DATE(closed_at), COALESCE(coin_id, 0), 1, COALESCE(pnl > 0, 0), COALESCE(pnl, 0), COALESCE(profit_usdt, 0)
+    FROM trades
+    WHERE id = ? AND status = 'закрыта' AND closed_at IS NOT NULL
+    ON CONFLICT (user_id, day, coin_id) DO UPDATE SET
+        trades_count = trades_count + excluded.trades_count,
+        wins = wins + excluded.wins,
+        sum_pnl = sum_pnl + excluded.sum_pnl,
+        sum_profit = sum_profit + excluded.sum_profit
+'''
+
+# Добавление к дневным итогам всех закрытых сделок из диапазона id (для пакетного импорта)
+SQL_ADD_RANGE_TO_DAILY_STATS = '''
+    INSERT INTO daily_stats (user_id, day, coin_id, trades_count, wins, sum_pnl, sum_profit)
+    SELECT user_id, DATE(closed_at), COALESCE(coin_id, 0), COUNT(*), TOTAL(pnl > 0), TOTAL(pnl), TOTAL(profit_usdt)
+    FROM trades
+    WHERE id BETWEEN ? AND ? AND status = 'закрыта' AND closed_at IS NOT NULL
+    GROUP BY user_id, DATE(closed_at), COALESCE(coin_id, 0)
+    ON CONFLICT (user_id, day, coin_id) DO UPDATE SET
+        trades_count = trades_count + excluded.trades_count,
+        wins = wins + excluded.wins,
+        sum_pnl = sum_pnl + excluded.sum_pnl,
+        sum_profit = sum_profit + excluded.sum_profit
+'''
+
+
+# Миграции схемы: номер версии = позиция в списке + 1 (хранится в PRAGMA user_version)
+MIGRATIONS = [
+    # 1: покрывающие индексы под статистику, списки открытых сделок и монеты
+    '''
+    CREATE INDEX IF NOT EXISTS idx_trades_user_status_closed
+        ON trades (user_id, status, closed_at, coin, pnl, profit_usdt);
+    CREATE INDEX IF NOT EXISTS idx_trades_user_coin_status
+        ON trades (user_id, coin, status, closed_at, pnl, profit_usdt);
+    ''',
+    # 2: дневные итоги статистики; закрытым сделкам без даты закрытия проставляем дату создания
+    '''
+    CREATE TABLE IF NOT EXISTS daily_stats (
+        user_id INTEGER NOT NULL,
+        day TEXT NOT NULL,
+        coin TEXT NOT NULL,
+        trades_count INTEGER NOT NULL DEFAULT 0,
+        wins INTEGER NOT NULL DEFAULT 0,
+        sum_pnl REAL NOT NULL DEFAULT 0,
+        sum_profit REAL NOT NULL DEFAULT 0,
+        PRIMARY KEY (user_id, day, coin)
+    ) WITHOUT ROWID;
+    CREATE INDEX IF NOT EXISTS idx_daily_stats_user_coin_day
+        ON daily_stats (user_id, coin, day);
+    UPDATE trades SET closed_at = created_at
+    WHERE status = 'закрыта' AND closed_at IS NULL;
+    INSERT INTO daily_stats (user_id, day, coin, trades_count, wins, sum_pnl, sum_profit)
+    SELECT user_id, DATE(closed_at), COALESCE(coin, ''), COUNT(*), TOTAL(pnl > 0), TOTAL(pnl), TOTAL(profit_usdt)
+    FROM trades
+    WHERE status = 'закрыта' AND closed_at IS NOT NULL
+    GROUP BY user_id, DATE(closed_at), COALESCE(coin, '');
+    ''',
+    # 3: состояния FSM (черновики сделок и закрытий), чтобы они переживали перезапуск
+    '''
+    CREATE TABLE IF NOT EXISTS fsm_storage (
+        key TEXT PRIMARY KEY,
+        state TEXT,
+        data TEXT NOT NULL,
+        updated_at REAL NOT NULL
+    ) WITHOUT ROWID;
+    CREATE INDEX IF NOT EXISTS idx_fsm_storage_updated ON fsm_storage (updated_at);
+    ''',
+    # 4: постраничный список открытых сделок по ключу (created_at, id)
+    '''
+    CREATE INDEX IF NOT EXISTS idx_trades_user_status_created
+        ON trades (user_id, status, created_at);
+    ''',
+    # 5: история закрытых сделок по монете по ключу (closed_at, id)
+    '''
+    CREATE INDEX IF NOT EXISTS idx_trades_user_coin_status_closed
+        ON trades (user_id, coin, status, closed_at);
+    ''',
+    # 6: справочник монет. Символы приводятся к одному виду (как normalize_coin: без пробелов,
+    # в верхнем регистре), trades и daily_stats ссылаются на монету по id, текстовая колонка
+    # trades.coin удаляется вместе со старыми индексами по ней
+    '''
+    CREATE TABLE IF NOT EXISTS coins (
+        id INTEGER PRIMARY KEY,
+        symbol TEXT NOT NULL UNIQUE
+    );
+    INSERT OR IGNORE INTO coins (symbol)
+    SELECT DISTINCT UPPER(REPLACE(REPLACE(TRIM(coin), ' ', ''), char(9), ''))
+    FROM trades
+    WHERE TRIM(coin) != '';
+    ALTER TABLE trades ADD COLUMN coin_id INTEGER REFERENCES coins (id);
+    UPDATE trades SET coin_id = (
+        SELECT id FROM coins WHERE symbol = UPPER(REPLACE(REPLACE(TRIM(trades.coin), ' ', ''), char(9), ''))
+    );
+    DROP INDEX IF EXISTS idx_trades_user_status_closed;
+    DROP INDEX IF EXISTS idx_trades_user_coin_status;
+    DROP INDEX IF EXISTS idx_trades_user_coin_status_closed;
+    ALTER TABLE trades DROP COLUMN coin;
+    CREATE INDEX idx_trades_user_status_closed
+        ON trades (user_id, status, closed_at, coin_id, pnl, profit_usdt);
+    CREATE INDEX idx_trades_user_coin_status
+        ON trades (user_id, coin_id, status, closed_at, pnl, profit_usdt);
+    CREATE INDEX idx_trades_user_coin_status_closed
+        ON trades (user_id, coin_id, status, closed_at);
+    DROP TABLE daily_stats;
+    CREATE TABLE daily_stats (
+        user_id INTEGER NOT NULL,
+        day TEXT NOT NULL,
+        coin_id INTEGER NOT NULL,
+        trades_count INTEGER NOT NULL DEFAULT 0,
+        wins INTEGER NOT NULL DEFAULT 0,
+        sum_pnl REAL NOT NULL DEFAULT 0,
+        sum_profit REAL NOT NULL DEFAULT 0,
+        PRIMARY KEY (user_id, day, coin_id)
+    ) WITHOUT ROWID;
+    CREATE INDEX idx_daily_stats_user_coin_day
+        ON daily_stats (user_id, coin_id, day);
+    ''' + SQL_REBUILD_DAILY_STATS,
+    # 7: монеты с открытыми сделками всех пользователей (для обновления цен);
+    # частичный индекс хранит только открытые сделки и остаётся маленьким
+    '''
+    CREATE INDEX IF NOT EXISTS idx_trades_open_coin
+        ON trades (coin_id) WHERE status = 'открыта';
+    ''',
+]
+
+
+# Справочник монет в памяти: символ -> id и обратно. Загружается при старте (init_db)
+# и пополняется после коммита записи, которая добавила новую монету. Фильтры по монете
+# получают id без обращения к базе; неизвестный символ значит, что сделок по нему нет
+coin_ids: dict[str, int] = {}
+coin_symbols: dict[int, str] = {}
+
+
+# Единый вид символа монеты: без пробелов, в верхнем регистре ("btc / usdt" -> "BTC/USDT")
+def normalize_coin(symbol) -> str | None:
+    if symbol is None:
+        return None
+    return "".join(str(symbol).split()).upper() or None
+
+
+def get_coin_id(symbol: str) -> int | None:
+    return coin_ids.get(normalize_coin(symbol))
+
+
+def _register_coins(pairs):
+    for coin_id, symbol in pairs:
+        coin_ids[symbol] = coin_id
+        coin_symbols[coin_id] = symbol
+
 
-# Добавление новой сделки
+async def load_coins(db_conn):
+    rows = await fetch_all(db_conn, "SELECT id, symbol FROM coins")
+    coin_ids.clear()
+    coin_symbols.clear()
+    _register_coins(rows)
+
+
+# Догрузка монет, которые добавил другой процесс (воркер): id монет только растут.
+# Нужна там, где читаются сделки чужих пользователей
+async def refresh_coins(db_conn, ids):
+    if any(coin_id not in coin_symbols for coin_id in ids if coin_id is not None):
+        _register_coins(await fetch_all(
+            db_conn, "SELECT id, symbol FROM coins WHERE id > ?", (max(coin_symbols, default=0),)
+        ))
+
+
+# Символ монеты по id из callback_data (id короче символа и укладывается в 64 байта)
+async def get_coin_symbol(coin_id: int) -> str | None:
+    if coin_id not in coin_symbols:
+        async with pool.acquire() as db_conn:
+            await refresh_coins(db_conn, [coin_id])
+    return coin_symbols.get(coin_id)
+
+
+# id монет для записи (внутри операции писателя): новые символы добавляются в coins.
+# В справочник в памяти они попадают только после коммита — через _register_coins
+async def _intern_coins(db_conn, symbols) -> dict[str, int]:
+    ids = {}
+    for symbol in symbols:
+        if symbol is None or symbol in ids:
+            continue
+        coin_id = coin_ids.get(symbol)
+        if coin_id is None:
+            await traced_execute(db_conn, "INSERT OR IGNORE INTO coins (symbol) VALUES (?)", (symbol,))
+            coin_id = (await fetch_one(db_conn, "SELECT id FROM coins WHERE symbol = ?", (symbol,)))[0]
+        ids[symbol] = coin_id
+    return ids
+
+
+# Применение недостающих миграций
+async def migrate_db(db):
+    cursor = await db.execute("PRAGMA user_version")
+    current = (await cursor.fetchone())[0]
+
+    # Скрипт и новый номер версии — одна транзакция: упавшая посередине миграция
+    # откатывается целиком и при следующем запуске применяется заново
+    for version, script in enumerate(MIGRATIONS[current:], start=current + 1):
+        try:
+            await db.executescript(f"BEGIN;\n{script};\nPRAGMA user_version = {version};\nCOMMIT;")
+        except Exception:
+            await db.rollback()
+            raise
+
+
+# Пересчёт дневных итогов по всем сделкам (разовый backfill для старых баз)
+@timed
+async def rebuild_daily_stats():
+    async with pool.acquire() as db:
+        await db.executescript("BEGIN;" + SQL_REBUILD_DAILY_STATS + "COMMIT;")
+
+
+# Подписчики на открытие и закрытие сделок (например, движок ценовых уведомлений).
+# Вызываются после коммита: trade_opened(trade_id, chat_id, coin, stop, targets)
+# и trade_closed(trade_id, user_id, coin)
+trade_listeners = []
+
+
+# Запись уже закоммичена, поэтому ошибка подписчика только пишется в лог
+def _trade_opened(trade_id: int, chat_id: int, coin: str, stop, targets):
+    for listener in trade_listeners:
+        try:
+            listener.trade_opened(trade_id, chat_id, coin, stop, targets)
+        except Exception:
+            logging.exception("Ошибка подписчика %r при открытии сделки %s", listener, trade_id)
+
+
+def _trade_closed(trade_id: int, user_id: int, coin: str):
+    for listener in trade_listeners:
+        try:
+            listener.trade_closed(trade_id, user_id, coin)
+        except Exception:
+            logging.exception("Ошибка подписчика %r при закрытии сделки %s", listener, trade_id)
+
+
+# Добавление новой сделки (вместе с дневными итогами, если сделка сразу закрыта)
+@timed
 async def insert_trade(user_id, chat_id, data: dict):
-    async with aiosqlite.connect("trades.db") as db:
-        await db.execute('''
+    coin = normalize_coin(data.get('coin'))
+
+    async def operation(db):
+        coins = await _intern_coins(db, (coin,))
+        cursor = await traced_execute(db, '''
             INSERT INTO trades (
-                user_id, chat_id, coin, timeframe, entry, targets, stop,
+                user_id, chat_id, coin_id, timeframe, entry, targets, stop,
                 usdt_amount, fee_entry_percent, reason, status,
                 close_price, pnl, profit_usdt, fee_exit_percent,
                 comment, closed_at
-            ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?,
+                      COALESCE(?, CASE WHEN ? = 'закрыта' THEN CURRENT_TIMESTAMP END))
         ''', (
             user_id,
             chat_id,
-            data.get('coin'),
+            coins.get(coin),
             data.get('timeframe'),
             data.get('entry'),
             data.get('targets'),
@@ -56,14 +745,73 @@ async def insert_trade(user_id, chat_id, data: dict):
             data.get('profit_usdt'),
             data.get('fee_exit_percent'),
             data.get('comment'),
-            data.get('closed_at')  # None, если сделка не закрыта
+            data.get('closed_at'),  # None, если сделка не закрыта
+            data.get('status')
         ))
-        await db.commit()
+        if data.get('status') == 'закрыта':
+            await traced_execute(db, SQL_ADD_TO_DAILY_STATS, (cursor.lastrowid,))
+        return cursor.lastrowid, coins
+
+    trade_id, coins = await writer.submit(operation)
+    _register_coins((coin_id, symbol) for symbol, coin_id in coins.items())
+    stats_cache.invalidate_user(user_id, coins=(coin,))
+    if data.get('status') == 'открыта':
+        _trade_opened(trade_id, chat_id, coin, data.get('stop'), data.get('targets'))
+    return trade_id
 
-# Обновление сделки при закрытии
-async def close_trade(trade_id: int, data: dict):
-    async with aiosqlite.connect("trades.db") as db_conn:
-        await db_conn.execute('''
+# Пакетная вставка сделок одной транзакцией (импорт истории). Строка — кортеж полей
+# в порядке IMPORT_COLUMNS (coin — символ монеты, в базу пишется её id). Дневные итоги
+# пополняются одним запросом по диапазону id вставленных строк: транзакция записи
+# исключительная (BEGIN IMMEDIATE), поэтому id одной пачки идут подряд
+IMPORT_COLUMNS = (
+    "user_id", "chat_id", "coin", "timeframe", "entry", "targets", "stop",
+    "usdt_amount", "fee_entry_percent", "reason", "status",
+    "close_price", "pnl", "profit_usdt", "fee_exit_percent", "comment",
+    "created_at", "closed_at",
+)
+
+IMPORT_COIN_INDEX = IMPORT_COLUMNS.index("coin")
+
+SQL_IMPORT_TRADE = f'''
+    INSERT INTO trades ({", ".join("coin_id" if name == "coin" else name for name in IMPORT_COLUMNS)})
+    VALUES ({", ".join("?" * len(IMPORT_COLUMNS))})
+'''
+
+@timed
+async def import_trades(user_id: int, rows: list[tuple]) -> int:
+    if not rows:
+        return 0
+    index = IMPORT_COIN_INDEX
+    symbols = {normalize_coin(row[index]) for row in rows}
+
+    async def operation(db_conn):
+        coins = await _intern_coins(db_conn, symbols)
+        await traced_executemany(db_conn, SQL_IMPORT_TRADE, (
+            row[:index] + (coins.get(normalize_coin(row[index])),) + row[index + 1:] for row in rows
+        ))
+        # id выдаёт AUTOINCREMENT по sqlite_sequence, а не по MAX(id): после удаления
+        # последних сделок счётчик впереди MAX(id). Последний выданный id — seq
+        last_id = (await fetch_one(db_conn, "SELECT seq FROM sqlite_sequence WHERE name = 'trades'"))[0]
+        first_id = last_id - len(rows) + 1
+        await traced_execute(db_conn, SQL_ADD_RANGE_TO_DAILY_STATS, (first_id, last_id))
+        return (first_id, len(rows)), coins
+
+    (first_id, imported), coins = await writer.submit(operation)
+    _register_coins((coin_id, symbol) for symbol, coin_id in coins.items())
+    stats_cache.invalidate_user(user_id, coins=symbols)
+    if trade_listeners:
+        status, chat_id, stop, targets = (IMPORT_COLUMNS.index(name) for name in ("status", "chat_id", "stop", "targets"))
+        for offset, row in enumerate(rows):
+            if row[status] == 'открыта':
+                _trade_opened(first_id + offset, row[chat_id], normalize_coin(row[index]), row[stop], row[targets])
+    return imported
+
+# Обновление сделки при закрытии (вместе с дневными итогами).
+# Уже закрытая сделка не обновляется повторно, чтобы не учесть её в итогах дважды
+@timed
+async def close_trade(trade_id: int, data: dict) -> bool:
+    async def operation(db_conn):
+        cursor = await traced_execute(db_conn, '''
             UPDATE trades
             SET status = ?,
                 close_price = ?,
@@ -71,7 +819,7 @@ async def close_trade(trade_id: int, data: dict):
                 profit_usdt = ?,
                 pnl = ?,
                 closed_at = CURRENT_TIMESTAMP
-            WHERE id = ?
+            WHERE id = ? AND status = 'открыта'
         ''', (
             data['status'],
             data['close_price'],
@@ -80,101 +828,532 @@ async def close_trade(trade_id: int, data: dict):
             data['pnl'],
             trade_id
         ))
-        await db_conn.commit()
-
-# Получение всех открытых сделок пользователя, отсортированных по дате
-async def get_open_trades(user_id: int):
-    async with aiosqlite.connect("trades.db") as db:
-        cursor = await db.execute('''
-            SELECT id, coin, usdt_amount
-            FROM trades
-            WHERE user_id = ? AND status = 'открыта'
-            ORDER BY created_at ASC
-        ''', (user_id,))
-        return await cursor.fetchall()
+        if cursor.rowcount != 1:
+            return None
+        await traced_execute(db_conn, SQL_ADD_TO_DAILY_STATS, (trade_id,))
+        return await fetch_one(db_conn, "SELECT user_id, coin_id FROM trades WHERE id = ?", (trade_id,))
+
+    row = await writer.submit(operation)
+    if row is None:
+        return False
+    coin = coin_symbols.get(row[1])
+    stats_cache.invalidate_user(row[0], coins=(coin,))
+    trade_cache.invalidate(trade_id)
+    _trade_closed(trade_id, row[0], coin)
+    return True
+
+CLOSE_BATCH_SELECT = 500       # id в одном запросе выборки (лимит параметров SQLite)
+
+# Автоматическое закрытие пачки сделок (стоп или первая цель) одной транзакцией.
+# closes — [(id сделки, цена закрытия)]; профит и PnL считаются так же, как при закрытии
+# вручную, с комиссией выхода exit_fee. Закрываются только ещё открытые сделки, поэтому
+# повторное закрытие той же сделки ничего не меняет. Возвращает закрытые сделки:
+# [(id, user_id, chat_id, монета, цена закрытия, профит USDT, PnL %)]
+SQL_CLOSE_AT_PRICE = '''
+    UPDATE trades
+    SET status = 'закрыта',
+        close_price = ?,
+        fee_exit_percent = ?,
+        profit_usdt = ?,
+        pnl = ?,
+        closed_at = CURRENT_TIMESTAMP
+    WHERE id = ? AND status = 'открыта'
+'''
+
+@timed
+async def close_trades_at(closes: list[tuple[int, float]], exit_fee: float) -> list[tuple]:
+    prices = dict(closes)
+    ids = list(prices)
+
+    async def operation(db_conn):
+        rows = []
+        for i in range(0, len(ids), CLOSE_BATCH_SELECT):
+            chunk = ids[i:i + CLOSE_BATCH_SELECT]
+            rows += await fetch_all(db_conn, f'''
+                SELECT id, user_id, chat_id, coin_id, entry, usdt_amount, fee_entry_percent
+                FROM trades
+                WHERE id IN ({", ".join("?" * len(chunk))}) AND status = 'открыта'
+            ''', chunk)
+        closed = []
+        for trade_id, user_id, chat_id, coin_id, entry, usdt_amount, entry_fee in rows:
+            try:
+                profit, pnl = close_result(float(entry), float(usdt_amount), float(entry_fee or 0),
+                                           prices[trade_id], exit_fee)
+            except (TypeError, ValueError, ZeroDivisionError):
+                continue
+            closed.append((trade_id, user_id, chat_id, coin_id, prices[trade_id], round(profit, 2), round(pnl, 2)))
+        await traced_executemany(db_conn, SQL_CLOSE_AT_PRICE, (
+            (price, exit_fee, profit, pnl, trade_id) for trade_id, _, _, _, price, profit, pnl in closed
+        ))
+        await traced_executemany(db_conn, SQL_ADD_TO_DAILY_STATS, ((row[0],) for row in closed))
+        await refresh_coins(db_conn, {row[3] for row in closed})
+        return closed
+
+    closed = await writer.submit(operation) if ids else []
+    coins_by_user = {}
+    for trade_id, user_id, _, coin_id, _, _, _ in closed:
+        coins_by_user.setdefault(user_id, set()).add(coin_symbols.get(coin_id))
+    for user_id, coins in coins_by_user.items():
+        stats_cache.invalidate_user(user_id, coins=coins)
+    for row in closed:
+        trade_cache.invalidate(row[0])
+    closed = [(trade_id, user_id, chat_id, coin_symbols.get(coin_id), price, profit, pnl)
+              for trade_id, user_id, chat_id, coin_id, price, profit, pnl in closed]
+    for trade_id, user_id, _, coin, _, _, _ in closed:
+        _trade_closed(trade_id, user_id, coin)
+    return closed
+
+# Получение открытых сделок пользователя, отсортированных по дате.
+# Постраничность по ключу (created_at, id): страница после/до сделки с заданным id
+# читается одним диапазоном индекса, сколько бы открытых сделок ни было
+SQL_OPEN_TRADES = '''
+    SELECT id, coin_id, usdt_amount, entry, fee_entry_percent
+    FROM trades
+    WHERE user_id = ? AND status = 'открыта'
+    ORDER BY created_at, id
+    LIMIT ?
+'''
+
+SQL_OPEN_TRADES_AFTER = '''
+    SELECT id, coin_id, usdt_amount, entry, fee_entry_percent
+    FROM trades
+    WHERE user_id = ? AND status = 'открыта'
+      AND (created_at, id) > ((SELECT created_at FROM trades WHERE id = ?), ?)
+    ORDER BY created_at, id
+    LIMIT ?
+'''
+
+SQL_OPEN_TRADES_BEFORE = '''
+    SELECT id, coin_id, usdt_amount, entry, fee_entry_percent
+    FROM trades
+    WHERE user_id = ? AND status = 'открыта'
+      AND (created_at, id) < ((SELECT created_at FROM trades WHERE id = ?), ?)
+    ORDER BY created_at DESC, id DESC
+    LIMIT ?
+'''
+
+@timed
+@cached
+async def get_open_trades(user_id: int, after_id: int = None, before_id: int = None, limit: int = -1):
+    async with pool.acquire() as db:
+        if after_id is not None:
+            rows = await fetch_all(db, SQL_OPEN_TRADES_AFTER, (user_id, after_id, after_id, limit))
+        elif before_id is not None:
+            rows = await fetch_all(db, SQL_OPEN_TRADES_BEFORE, (user_id, before_id, before_id, limit))
+        else:
+            rows = await fetch_all(db, SQL_OPEN_TRADES, (user_id, limit))
+
+    # Страница "назад" читается в обратном порядке, возвращаем её по возрастанию
+    if before_id is not None:
+        rows.reverse()
+    return [(trade_id, coin_symbols.get(coin_id), *rest) for trade_id, coin_id, *rest in rows]
+
+# История закрытых сделок по монете, от новых к старым. Постраничность по ключу
+# (closed_at, id): страница читается одним диапазоном индекса idx_trades_user_coin_status_closed
+# (id в нём есть как rowid), поэтому монета с сотнями тысяч сделок листается так же
+# быстро, как редкая. Страница "с" (from) начинается с самой сделки — на неё
+# возвращается кнопка "назад" из карточки сделки
+SQL_COIN_HISTORY = '''
+    SELECT id, closed_at, pnl, profit_usdt
+    FROM trades
+    WHERE user_id = ? AND coin_id = ? AND status = 'закрыта'
+    ORDER BY closed_at DESC, id DESC
+    LIMIT ?
+'''
+
+SQL_COIN_HISTORY_AFTER = '''
+    SELECT id, closed_at, pnl, profit_usdt
+    FROM trades
+    WHERE user_id = ? AND coin_id = ? AND status = 'закрыта'
+      AND (closed_at, id) < ((SELECT closed_at FROM trades WHERE id = ?), ?)
+    ORDER BY closed_at DESC, id DESC
+    LIMIT ?
+'''
+
+SQL_COIN_HISTORY_FROM = '''
+    SELECT id, closed_at, pnl, profit_usdt
+    FROM trades
+    WHERE user_id = ? AND coin_id = ? AND status = 'закрыта'
+      AND (closed_at, id) <= ((SELECT closed_at FROM trades WHERE id = ?), ?)
+    ORDER BY closed_at DESC, id DESC
+    LIMIT ?
+'''
+
+SQL_COIN_HISTORY_BEFORE = '''
+    SELECT id, closed_at, pnl, profit_usdt
+    FROM trades
+    WHERE user_id = ? AND coin_id = ? AND status = 'закрыта'
+      AND (closed_at, id) > ((SELECT closed_at FROM trades WHERE id = ?), ?)
+    ORDER BY closed_at, id
+    LIMIT ?
+'''
+
+@timed
+@cached_per_coin
+async def get_coin_trade_history(user_id: int, coin: str, after_id: int = None, before_id: int = None,
+                                 from_id: int = None, limit: int = -1):
+    coin = get_coin_id(coin)
+    if coin is None:
+        return []
+
+    async with pool.acquire() as db:
+        if after_id is not None:
+            rows = await fetch_all(db, SQL_COIN_HISTORY_AFTER, (user_id, coin, after_id, after_id, limit))
+        elif before_id is not None:
+            rows = await fetch_all(db, SQL_COIN_HISTORY_BEFORE, (user_id, coin, before_id, before_id, limit))
+        elif from_id is not None:
+            rows = await fetch_all(db, SQL_COIN_HISTORY_FROM, (user_id, coin, from_id, from_id, limit))
+        else:
+            rows = await fetch_all(db, SQL_COIN_HISTORY, (user_id, coin, limit))
+
+    # Страница "назад" читается от старых к новым, возвращаем её в порядке истории
+    if before_id is not None:
+        rows.reverse()
+    return rows
+
+# Сделка целиком: карточка, черновик закрытия и возврат к карточке читают одну запись
+class TradeRecord(NamedTuple):
+    id: int
+    user_id: int
+    coin: str | None
+    timeframe: str | None
+    entry: float
+    targets: str | None
+    stop: float | None
+    usdt_amount: float
+    fee_entry_percent: float | None
+    reason: str | None
+    created_at: str
+    status: str
+    close_price: float | None
+    pnl: float | None
+    profit_usdt: float | None
+    closed_at: str | None
+
+
+SQL_TRADE_RECORD = '''
+    SELECT t.id, user_id, c.symbol, timeframe, entry, targets, stop, usdt_amount, fee_entry_percent, reason,
+           created_at, status, close_price, pnl, profit_usdt, closed_at
+    FROM trades t LEFT JOIN coins c ON c.id = t.coin_id
+    WHERE t.id = ?
+'''
+
+@timed
+async def _load_trade(trade_id: int) -> TradeRecord | None:
+    async with pool.acquire() as db:
+        row = await fetch_one(db, SQL_TRADE_RECORD, (trade_id,))
+    return TradeRecord(*row) if row else None
+
+# Сделка по id из кэша карточек (при промахе — из базы). Чужая сделка не отдаётся:
+# id приходит из callback_data, которую пользователь может подделать
+async def get_trade(user_id: int, trade_id: int) -> TradeRecord | None:
+    found, record = trade_cache.get(trade_id)
+    if not found:
+        generation = trade_cache.generation
+        record = await _load_trade(trade_id)
+        if record is not None:
+            trade_cache.set(trade_id, record, generation)
+    if record is None or record.user_id != user_id:
+        return None
+    return record
+
+# Перевод включительного диапазона дат в полуоткрытый [start, end + 1 день):
+# сравнение идёт по самому closed_at, поэтому условие попадает в индекс
+def day_range(start_date: str, end_date: str) -> tuple[str, str]:
+    end = datetime.strptime(end_date, "%Y-%m-%d") + timedelta(days=1)
+    return start_date, end.strftime("%Y-%m-%d")
 
 # Получение закрытых сделок пользователя за период
+SQL_CLOSED_IN_PERIOD = '''
+    SELECT pnl, profit_usdt
+    FROM trades
+    WHERE user_id = ?
+      AND status = 'закрыта'
+      AND closed_at >= ? AND closed_at < ?
+'''
+
+@timed
 async def get_closed_trades_in_period(user_id: int, start_date: str, end_date: str):
-    async with aiosqlite.connect("trades.db") as db_conn:
-        db_conn.row_factory = aiosqlite.Row
-        cursor = await db_conn.execute('''
-            SELECT pnl, profit_usdt
-            FROM trades
-            WHERE user_id = ?
-              AND status = 'закрыта'
-              AND DATE(closed_at) BETWEEN DATE(?) AND DATE(?)
-        ''', (user_id, start_date, end_date))
-        return await cursor.fetchall()
+    range_start, range_end = day_range(start_date, end_date)
+    async with pool.acquire() as db_conn:
+        return await fetch_all(db_conn, SQL_CLOSED_IN_PERIOD, (user_id, range_start, range_end))
+
+# Все закрытые сделки пользователя в порядке закрытия, одним проходом по индексу:
+# время закрытия (unix), pnl, профит и сумма сделки — колонки для analytics.py
+SQL_CLOSED_SERIES = '''
+    SELECT CAST(strftime('%s', closed_at) AS INTEGER),
+           COALESCE(pnl, 0), COALESCE(profit_usdt, 0), COALESCE(usdt_amount, 0)
+    FROM trades
+    WHERE user_id = ? AND status = 'закрыта' AND closed_at IS NOT NULL
+    ORDER BY closed_at
+'''
+
+@timed
+async def get_closed_trade_series(user_id: int):
+    async with pool.acquire() as db_conn:
+        return await fetch_all(db_conn, SQL_CLOSED_SERIES, (user_id,))
+
+# Выгрузка журнала пользователя. Фильтр по датам относится к дате закрытия (только закрытые
+# сделки), по монете — к индексу (user_id, coin_id, ...). Порядок (status, closed_at) совпадает
+# с порядком обоих индексов, поэтому SQLite отдаёт строки по мере чтения, без сортировки
+EXPORT_COLUMNS = (
+    "id", "coin", "timeframe", "entry", "targets", "stop", "usdt_amount",
+    "fee_entry_percent", "fee_exit_percent", "reason", "status",
+    "close_price", "pnl", "profit_usdt", "comment", "created_at", "closed_at",
+)
+EXPORT_BATCH = 1000
+
+
+# Монета задаётся id из справочника (get_coin_id), в файл попадает её символ
+def build_export_query(user_id: int, start_date: str = None, end_date: str = None,
+                       coin_id: int = None) -> tuple[str, tuple]:
+    conditions = ["t.user_id = ?"]
+    params = [user_id]
+    if coin_id is not None:
+        conditions.append("t.coin_id = ?")
+        params.append(coin_id)
+    if start_date or end_date:
+        range_start, range_end = day_range(start_date or "0001-01-01", end_date or "9998-12-31")
+        conditions.append("t.status = 'закрыта' AND t.closed_at >= ? AND t.closed_at < ?")
+        params += [range_start, range_end]
+    columns = ", ".join("c.symbol" if name == "coin" else f"t.{name}" for name in EXPORT_COLUMNS)
+    sql = f'''
+        SELECT {columns}
+        FROM trades t LEFT JOIN coins c ON c.id = t.coin_id
+        WHERE {" AND ".join(conditions)}
+        ORDER BY t.status, t.closed_at
+    '''
+    return sql, tuple(params)
+
+
+# Строки выгрузки порциями по batch_size: на всё время выгрузки занято одно соединение пула
+async def iter_trades(user_id: int, start_date: str = None, end_date: str = None, coin: str = None,
+                      batch_size: int = EXPORT_BATCH):
+    coin_id = None
+    if coin:
+        coin_id = get_coin_id(coin)
+        if coin_id is None:
+            return
+    sql, params = build_export_query(user_id, start_date, end_date, coin_id)
+    async with pool.acquire() as db_conn:
+        cursor = await traced_execute(db_conn, sql, params)
+        try:
+            while True:
+                rows = await cursor.fetchmany(batch_size)
+                if not rows:
+                    break
+                yield rows
+        finally:
+            await cursor.close()
+
+# Монеты, по которым у кого-нибудь есть открытые сделки (их цены обновляются фоном)
+SQL_OPEN_COINS = '''
+    SELECT DISTINCT coin_id
+    FROM trades
+    WHERE status = 'открыта' AND coin_id IS NOT NULL
+'''
+
+@timed
+async def get_open_coins() -> list[str]:
+    async with pool.acquire() as db_conn:
+        rows = await fetch_all(db_conn, SQL_OPEN_COINS)
+        await refresh_coins(db_conn, {row[0] for row in rows})
+    return [coin_symbols[row[0]] for row in rows if row[0] in coin_symbols]
+
+# Уровни всех открытых сделок (загрузка движка ценовых уведомлений при старте):
+# id, чат, монета, стоп и строка целей. Порциями, чтобы не держать весь результат дважды
+SQL_OPEN_TRADE_LEVELS = '''
+    SELECT id, chat_id, coin_id, stop, targets
+    FROM trades
+    WHERE status = 'открыта' AND coin_id IS NOT NULL
+'''
+
+async def iter_open_trade_levels(batch_size: int = EXPORT_BATCH):
+    async with pool.acquire() as db_conn:
+        cursor = await traced_execute(db_conn, SQL_OPEN_TRADE_LEVELS)
+        try:
+            while True:
+                rows = await cursor.fetchmany(batch_size)
+                if not rows:
+                    break
+                await refresh_coins(db_conn, {row[2] for row in rows})
+                yield [(trade_id, chat_id, coin_symbols.get(coin_id), stop, targets)
+                       for trade_id, chat_id, coin_id, stop, targets in rows]
+        finally:
+            await cursor.close()
 
 # Подсчёт количества открытых сделок пользователя
+SQL_OPEN_TRADES_COUNT = '''
+    SELECT COUNT(*)
+    FROM trades
+    WHERE user_id = ?
+      AND status = 'открыта'
+'''
+
+@timed
+@cached
 async def get_open_trades_count(user_id: int) -> int:
-    async with aiosqlite.connect("trades.db") as db_conn:
-        cursor = await db_conn.execute('''
-            SELECT COUNT(*)
-            FROM trades
-            WHERE user_id = ?
-              AND status = 'открыта'
-        ''', (user_id,))
-        result = await cursor.fetchone()
+    async with pool.acquire() as db_conn:
+        result = await fetch_one(db_conn, SQL_OPEN_TRADES_COUNT, (user_id,))
         return result[0] if result else 0
 
-# Получение монет, по которым были сделки за 30 дней или есть открытые сделки
+# Получение монет, по которым были сделки за 30 дней или есть открытые сделки.
+# Две ветки через UNION, чтобы каждая шла своим диапазоном по индексу вместо OR;
+# UNION сравнивает id монет, символы берутся из справочника
+SQL_ACTIVE_COINS = '''
+    SELECT coin_id
+    FROM trades
+    WHERE user_id = ? AND status = 'открыта'
+    UNION
+    SELECT coin_id
+    FROM trades
+    WHERE user_id = ? AND status = 'закрыта' AND closed_at >= ?
+'''
+
+@timed
+@cached
 async def get_active_coins(user_id: int):
-    async with aiosqlite.connect("trades.db") as db:
+    async with pool.acquire() as db:
         thirty_days_ago = (datetime.now() - timedelta(days=30)).strftime("%Y-%m-%d")
 
-        cursor = await db.execute('''
-            SELECT DISTINCT coin
-            FROM trades
-            WHERE user_id = ?
-              AND (
-                (status = 'открыта')
-                OR
-                (status = 'закрыта' AND DATE(closed_at) >= DATE(?))
-              )
-        ''', (user_id, thirty_days_ago))
-        rows = await cursor.fetchall()
-        return [row[0] for row in rows] if rows else []
+        rows = await fetch_all(db, SQL_ACTIVE_COINS, (user_id, user_id, thirty_days_ago))
+        return [coin_symbols[row[0]] for row in rows if row[0] in coin_symbols]
+
+# Агрегаты статистики считаются в SQLite одной строкой по дневным итогам
+# (O(дней), а не O(сделок)): количество, сумма и средний PnL, профит,
+# число прибыльных сделок и день последнего закрытия
+SQL_AGGREGATE_COLUMNS = '''
+    SUM(trades_count) AS total_trades,
+    TOTAL(sum_pnl) AS total_pnl,
+    TOTAL(sum_pnl) / MAX(TOTAL(trades_count), 1) AS average_pnl,
+    TOTAL(sum_profit) AS total_profit,
+    TOTAL(wins) AS win_count,
+    MAX(day) AS last_trade_date
+'''
+
+SQL_PERIOD_AGGREGATES = f'''
+    SELECT {SQL_AGGREGATE_COLUMNS}
+    FROM daily_stats
+    WHERE user_id = ? AND day BETWEEN ? AND ?
+'''
+
+# Без статистики ANALYZE планировщик выбирает первичный ключ (user_id, day, coin_id) и читает
+# дни всех монет пользователя; индекс (user_id, coin_id, day) даёт диапазон только по монете
+SQL_COIN_AGGREGATES = f'''
+    SELECT {SQL_AGGREGATE_COLUMNS}
+    FROM daily_stats INDEXED BY idx_daily_stats_user_coin_day
+    WHERE user_id = ? AND coin_id = ?
+'''
+
+SQL_COIN_PERIOD_AGGREGATES = f'''
+    SELECT {SQL_AGGREGATE_COLUMNS}
+    FROM daily_stats INDEXED BY idx_daily_stats_user_coin_day
+    WHERE user_id = ? AND coin_id = ? AND day BETWEEN ? AND ?
+'''
+
+
+# Перевод строки агрегатов в словарь статистики (None, если сделок нет)
+def _aggregates_to_stats(row) -> dict | None:
+    if not row or not row["total_trades"]:
+        return None
+
+    total_trades = row["total_trades"]
+    win_count = int(row["win_count"])
+
+    return {
+        "total_trades": total_trades,
+        "total_pnl": row["total_pnl"],
+        "average_pnl": row["average_pnl"],
+        "total_profit": row["total_profit"],
+        "win_count": win_count,
+        "winrate": win_count / total_trades * 100,
+        "last_trade_date": row["last_trade_date"]
+    }
+
+
+# Статистика закрытых сделок пользователя за период (даты включительно)
+@timed
+@cached
+async def get_period_statistics(user_id: int, start_date: str, end_date: str):
+    async with pool.acquire() as db:
+        row = await fetch_one(db, SQL_PERIOD_AGGREGATES, (user_id, start_date, end_date))
+    return _aggregates_to_stats(row)
+
 
 # Получение статистики по монете
+@timed
+@cached_per_coin
 async def get_coin_statistics(user_id: int, coin: str):
-    async with aiosqlite.connect("trades.db") as db:
-        cursor = await db.execute('''
-            SELECT pnl, profit_usdt, closed_at
-            FROM trades
-            WHERE user_id = ? AND coin = ? AND status = 'закрыта'
-        ''', (user_id, coin))
-        rows = await cursor.fetchall()
+    coin = get_coin_id(coin)
+    if coin is None:
+        return None
 
-    if not rows:
+    async with pool.acquire() as db:
+        row = await fetch_one(db, SQL_COIN_AGGREGATES, (user_id, coin))
+    return _aggregates_to_stats(row)
+
+
+# Статистика по монете за период (даты включительно)
+@timed
+@cached_per_coin
+async def get_coin_period_statistics(user_id: int, coin: str, start_date: str, end_date: str):
+    coin = get_coin_id(coin)
+    if coin is None:
         return None
 
-    total_pnl = 0
-    total_profit = 0
-    win_count = 0
-    total_count = len(rows)
-    last_trade_date = None
+    async with pool.acquire() as db:
+        row = await fetch_one(db, SQL_COIN_PERIOD_AGGREGATES, (user_id, coin, start_date, end_date))
+    return _aggregates_to_stats(row)
+
+
+# Запросы, которые выполняются на каждом экране бота, с примерами параметров
+HOT_QUERIES = {
+    "get_open_trades": (SQL_OPEN_TRADES, (1, 11)),
+    "get_open_trades:after": (SQL_OPEN_TRADES_AFTER, (1, 100, 100, 11)),
+    "get_open_trades:before": (SQL_OPEN_TRADES_BEFORE, (1, 100, 100, 11)),
+    "get_coin_trade_history": (SQL_COIN_HISTORY, (1, 1, 11)),
+    "get_coin_trade_history:after": (SQL_COIN_HISTORY_AFTER, (1, 1, 100, 100, 11)),
+    "get_coin_trade_history:before": (SQL_COIN_HISTORY_BEFORE, (1, 1, 100, 100, 11)),
+    "get_coin_trade_history:from": (SQL_COIN_HISTORY_FROM, (1, 1, 100, 100, 11)),
+    "get_closed_trades_in_period": (SQL_CLOSED_IN_PERIOD, (1, "2024-01-01", "2024-02-01")),
+    "get_closed_trade_series": (SQL_CLOSED_SERIES, (1,)),
+    "iter_trades": build_export_query(1),
+    "iter_trades:coin": build_export_query(1, coin_id=1),
+    "iter_trades:period": build_export_query(1, "2024-01-01", "2024-01-31"),
+    "get_open_trades_count": (SQL_OPEN_TRADES_COUNT, (1,)),
+    "get_open_coins": (SQL_OPEN_COINS, ()),
+    "get_active_coins": (SQL_ACTIVE_COINS, (1, 1, "2024-01-01")),
+    "get_period_statistics": (SQL_PERIOD_AGGREGATES, (1, "2024-01-01", "2024-01-31")),
+    "get_coin_statistics": (SQL_COIN_AGGREGATES, (1, 1)),
+    "get_coin_period_statistics": (SQL_COIN_PERIOD_AGGREGATES, (1, 1, "2024-01-01", "2024-01-31")),
+}
+
 
-    for row in rows:
-        pnl = row[0] or 0
-        profit = row[1] or 0
-        closed_at = row[2]
+# Горячие запросы, которые должны идти по конкретному индексу, а не просто без SCAN:
+# первичный ключ daily_stats тоже даёт SEARCH, но по всем монетам пользователя
+EXPECTED_INDEXES = {
+    "get_coin_statistics": "idx_daily_stats_user_coin_day",
+    "get_coin_period_statistics": "idx_daily_stats_user_coin_day",
+}
 
-        total_pnl += pnl
-        total_profit += profit
-        if pnl > 0:
-            win_count += 1
 
-        if closed_at:
-            last_trade_date = closed_at.split()[0]
+# EXPLAIN QUERY PLAN для всех горячих запросов
+async def explain_hot_queries() -> dict:
+    plans = {}
+    async with pool.acquire() as db:
+        for name, (sql, params) in HOT_QUERIES.items():
+            cursor = await db.execute("EXPLAIN QUERY PLAN " + sql, params)
+            plans[name] = [row[3] for row in await cursor.fetchall()]
+    return plans
 
-    average_pnl = total_pnl / total_count if total_count else 0
-    winrate = (win_count / total_count) * 100 if total_count else 0
 
+# Проверка планов: возвращает горячие запросы, которые читают таблицу полным проходом (SCAN)
+# или не используют ожидаемый для них индекс (EXPECTED_INDEXES)
+async def check_query_plans() -> dict:
+    plans = await explain_hot_queries()
     return {
-        "average_pnl": average_pnl,
-        "total_profit": total_profit,
-        "total_trades": total_count,
-        "winrate": winrate,
-        "last_trade_date": last_trade_date
+        name: steps
+        for name, steps in plans.items()
+        if any(step.startswith("SCAN") for step in steps)
+        or (name in EXPECTED_INDEXES and not any(EXPECTED_INDEXES[name] in step for step in steps))
     }
@@ -0,0 +1,100 @@
+import asyncio
+import csv
+
+import database as db
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+    pq = None
+
+FORMATS = ("csv", "parquet")
+PARQUET_BATCH = 10000          # строк в одной группе строк Parquet
+
+PARQUET_TYPES = {
+    "id": "int64",
+    "entry": "float64",
+    "stop": "float64",
+    "usdt_amount": "float64",
+    "fee_entry_percent": "float64",
+    "fee_exit_percent": "float64",
+    "close_price": "float64",
+    "pnl": "float64",
+    "profit_usdt": "float64",
+}
+
+
+def parquet_available() -> bool:
+    return pa is not None
+
+
+def _convert(value, arrow_type):
+    if value is None:
+        return None
+    if arrow_type == pa.string():
+        return str(value)
+    try:
+        return int(value) if arrow_type == pa.int64() else float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+# Запись в файл идёт порциями: в памяти не больше одной порции строк. Запись порции
+# выполняется в отдельном потоке, чтобы не держать цикл событий бота
+class CsvSink:
+    def __init__(self, path: str):
+        self._file = open(path, "w", newline="", encoding="utf-8")
+        self._writer = csv.writer(self._file)
+        self._writer.writerow(db.EXPORT_COLUMNS)
+
+    def write(self, rows: list):
+        self._writer.writerows(rows)
+
+    def close(self):
+        self._file.close()
+
+
+class ParquetSink:
+    def __init__(self, path: str):
+        self._schema = pa.schema([
+            (name, getattr(pa, PARQUET_TYPES.get(name, "string"))()) for name in db.EXPORT_COLUMNS
+        ])
+        self._writer = pq.ParquetWriter(path, self._schema)
+
+    def write(self, rows: list):
+        columns = list(zip(*rows))
+        # SQLite не следит за типами колонок (stop мог быть сохранён строкой) — приводим к типу схемы
+        arrays = [
+            pa.array([_convert(value, field.type) for value in column], type=field.type)
+            for field, column in zip(self._schema, columns)
+        ]
+        self._writer.write_table(pa.Table.from_arrays(arrays, schema=self._schema))
+
+    def close(self):
+        self._writer.close()
+
+
+# Выгрузка сделок пользователя в файл path. Возвращает число выгруженных строк
+async def export_trades(path: str, user_id: int, fmt: str = "csv", start_date: str = None,
+                        end_date: str = None, coin: str = None) -> int:
+    if fmt == "parquet":
+        if not parquet_available():
+            raise RuntimeError("Для выгрузки в Parquet нужен пакет pyarrow")
+        sink = ParquetSink(path)
+        batch_size = PARQUET_BATCH
+    elif fmt == "csv":
+        sink = CsvSink(path)
+        batch_size = db.EXPORT_BATCH
+    else:
+        raise ValueError(f"Неизвестный формат выгрузки: {fmt}")
+
+    exported = 0
+    try:
+        async for rows in db.iter_trades(user_id, start_date, end_date, coin, batch_size=batch_size):
+            await asyncio.to_thread(sink.write, [tuple(row) for row in rows])
+            exported += len(rows)
+    finally:
+        await asyncio.to_thread(sink.close)
+    return exported
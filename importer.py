@@ -0,0 +1,150 @@
+import asyncio
+import csv
+import time
+from datetime import datetime, timezone
+
+import database as db
+from trade_logic import STATUS_CLOSED, settle_trade, validate_trade_data
+
+IMPORT_CHUNK = 5000            # строк в одной транзакции
+PROGRESS_INTERVAL = 3.0        # не чаще чем раз в столько секунд сообщать о ходе импорта
+MAX_REPORTED_ERRORS = 20       # сколько ошибок строк показывать пользователю
+
+NUMERIC_FIELDS = ("entry", "usdt_amount", "fee_entry_percent", "stop", "close_price", "fee_exit")
+TEXT_FIELDS = ("coin", "timeframe", "targets", "reason", "status", "comment")
+DATE_FIELDS = ("created_at", "closed_at")
+
+# Упрощённые статусы из выгрузок приводятся к статусам формы сделки
+STATUS_ALIASES = {
+    "открыта": "В позиции",
+    "open": "В позиции",
+    "закрыта": "Закрыто вручную",
+    "closed": "Закрыто вручную",
+}
+
+IMPORT_HELP = (
+    "📥 Импорт истории сделок\n\n"
+    "Пришли файл .csv с заголовком. Колонки:\n"
+    "coin, entry, usdt_amount, fee_entry_percent, status — обязательны;\n"
+    "timeframe, targets, stop, reason, comment, close_price, fee_exit, created_at, closed_at — по желанию.\n\n"
+    "status: «В позиции», «Закрыто с прибылью» (нужна targets), «Закрыто по стопу» (нужен stop), "
+    "«Закрыто вручную» (нужны close_price и fee_exit); также понимаются «открыта» и «закрыта».\n"
+    "Даты: 2024-05-01 или 2024-05-01 14:30:00."
+)
+
+
+class ImportRowError(ValueError):
+    pass
+
+
+def _parse_date(value: str) -> str:
+    try:
+        parsed = datetime.fromisoformat(value)
+    except ValueError:
+        raise ImportRowError(f"неверная дата «{value}»")
+    if parsed.tzinfo is not None:
+        parsed = parsed.astimezone(timezone.utc).replace(tzinfo=None)
+    return parsed.strftime("%Y-%m-%d %H:%M:%S")
+
+
+def _parse_number(name: str, value: str) -> float:
+    try:
+        return float(value.replace(",", ".").replace(" ", ""))
+    except ValueError:
+        raise ImportRowError(f"{name}: не число «{value}»")
+
+
+# Строка CSV -> кортеж полей в порядке database.IMPORT_COLUMNS.
+# Проверка и расчёт PnL/профита — те же, что при сохранении сделки через форму
+def build_row(row: dict, user_id: int, chat_id: int, now: str) -> tuple:
+    data = {}
+    for name in TEXT_FIELDS:
+        value = (row.get(name) or "").strip()
+        data[name] = value or None
+    for name in NUMERIC_FIELDS:
+        value = (row.get(name) or "").strip()
+        data[name] = _parse_number(name, value) if value else None
+    for name in DATE_FIELDS:
+        value = (row.get(name) or "").strip()
+        data[name] = _parse_date(value) if value else None
+
+    if data["status"]:
+        data["status"] = STATUS_ALIASES.get(data["status"].lower(), data["status"])
+
+    is_valid, missing = validate_trade_data(data)
+    if data["status"] == "Закрыто вручную":
+        missing += [label for name, label in (("close_price", "цена закрытия"), ("fee_exit", "комиссия выхода"))
+                    if data[name] is None]
+    if not is_valid or missing:
+        raise ImportRowError("не хватает: " + ", ".join(missing))
+
+    try:
+        data.update(settle_trade(data))
+    except ZeroDivisionError:
+        raise ImportRowError("цена входа равна нулю")
+
+    created_at = data["created_at"] or now
+    closed_at = (data["closed_at"] or created_at) if data["status"] == STATUS_CLOSED else None
+    return (
+        user_id, chat_id, data["coin"], data["timeframe"], data["entry"], data["targets"], data["stop"],
+        data["usdt_amount"], data["fee_entry_percent"], data["reason"], data["status"],
+        data["close_price"], data["pnl"], data["profit_usdt"], data["fee_exit_percent"], data["comment"],
+        created_at, closed_at,
+    )
+
+
+# Разбор следующей порции строк (выполняется в отдельном потоке, чтобы не держать цикл событий)
+def _read_chunk(reader: csv.DictReader, size: int, user_id: int, chat_id: int) -> tuple[list, list, bool]:
+    now = datetime.now(timezone.utc).strftime("%Y-%m-%d %H:%M:%S")
+    rows = []
+    errors = []
+    for row in reader:
+        try:
+            rows.append(build_row(row, user_id, chat_id, now))
+        except (ValueError, TypeError, AttributeError) as e:
+            errors.append(f"строка {reader.line_num}: {e}")
+        if len(rows) >= size:
+            return rows, errors, False
+    return rows, errors, True
+
+
+def _open_reader(f) -> csv.DictReader:
+    sample = f.read(4096)
+    f.seek(0)
+    try:
+        dialect = csv.Sniffer().sniff(sample, delimiters=",;\t")
+    except csv.Error:
+        dialect = csv.excel
+    reader = csv.DictReader(f, dialect=dialect)
+    reader.fieldnames = [name.strip().lower() for name in reader.fieldnames or []]
+    return reader
+
+
+# Потоковый импорт CSV: в памяти не больше одной порции строк, каждая порция — одна
+# транзакция через очередь записи. progress(imported, skipped) вызывается не чаще
+# чем раз в progress_interval секунд
+async def import_csv(path: str, user_id: int, chat_id: int, progress=None, chunk_size: int = IMPORT_CHUNK,
+                     progress_interval: float = PROGRESS_INTERVAL) -> dict:
+    imported = 0
+    skipped = 0
+    errors = []
+    last_report = time.monotonic()
+
+    with open(path, newline="", encoding="utf-8-sig") as f:
+        reader = _open_reader(f)
+        if "coin" not in reader.fieldnames:
+            raise ImportRowError("в заголовке CSV нет колонки coin")
+
+        done = False
+        while not done:
+            rows, row_errors, done = await asyncio.to_thread(_read_chunk, reader, chunk_size, user_id, chat_id)
+            skipped += len(row_errors)
+            errors.extend(row_errors[:MAX_REPORTED_ERRORS - len(errors)])
+            if rows:
+                imported += await db.import_trades(user_id, rows)
+
+            if progress is not None and time.monotonic() - last_report >= progress_interval:
+                last_report = time.monotonic()
+                await progress(imported, skipped)
+
+    return {"imported": imported, "skipped": skipped, "errors": errors}
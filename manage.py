@@ -0,0 +1,119 @@
+import argparse
+import asyncio
+import sys
+
+import database as db
+import exporter
+import importer
+
+
+# Проверка планов горячих запросов: код возврата 1, если хоть один запрос ушёл в SCAN
+# или прошёл мимо ожидаемого индекса
+async def check_plans(args) -> int:
+    await db.init_db()
+    plans = await db.explain_hot_queries()
+    failed = await db.check_query_plans()
+
+    for name, steps in plans.items():
+        mark = "FAIL" if name in failed else "ok"
+        print(f"[{mark}] {name}")
+        for step in steps:
+            print(f"       {step}")
+
+    if failed:
+        print(f"\n❌ Полный проход таблицы или не тот индекс в запросах: {', '.join(failed)}")
+        return 1
+    print("\n✅ Все горячие запросы используют индексы")
+    return 0
+
+
+# Разовый пересчёт дневных итогов статистики по всем сделкам
+async def backfill_stats(args) -> int:
+    await db.init_db()
+    await db.rebuild_daily_stats()
+    print("✅ Дневные итоги статистики пересчитаны")
+    return 0
+
+
+# Перепаковка файла базы: возвращает место, освобождённое миграциями (например, после
+# перехода trades на id монет) и удалёнными строками
+async def vacuum(args) -> int:
+    await db.init_db()
+    async with db.pool.acquire() as conn:
+        await conn.execute("VACUUM")
+    print("✅ База перепакована")
+    return 0
+
+
+# Импорт истории сделок пользователя из CSV
+async def import_trades(args) -> int:
+    await db.init_db()
+
+    async def progress(imported: int, skipped: int):
+        print(f"  загружено {imported}, пропущено {skipped}")
+
+    result = await importer.import_csv(args.file, args.user, args.chat or args.user, progress=progress,
+                                       progress_interval=1.0)
+    for error in result["errors"]:
+        print(f"  {error}")
+    print(f"✅ Загружено {result['imported']}, пропущено {result['skipped']}")
+    return 0
+
+
+# Выгрузка сделок пользователя в CSV/Parquet
+async def export_trades(args) -> int:
+    if args.format == "parquet" and not exporter.parquet_available():
+        print("❌ Для выгрузки в Parquet нужен пакет pyarrow")
+        return 1
+    await db.init_db()
+    count = await exporter.export_trades(args.out, args.user, args.format, args.date_from, args.date_to,
+                                         db.normalize_coin(args.coin))
+    print(f"✅ Выгружено {count} сделок в {args.out}")
+    return 0
+
+
+COMMANDS = {
+    "check-plans": check_plans,
+    "backfill-stats": backfill_stats,
+    "vacuum": vacuum,
+    "import": import_trades,
+    "export": export_trades,
+}
+
+
+async def run(args) -> int:
+    await db.init_pool(path=args.db)
+    await db.start_writer()
+    try:
+        return await COMMANDS[args.command](args)
+    finally:
+        await db.stop_writer()
+        await db.close_pool()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Служебные команды трейд-журнала")
+    parser.add_argument("--db", default=db.DB_PATH, help="путь к файлу базы")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    subparsers.add_parser("check-plans", help="проверить EXPLAIN QUERY PLAN горячих запросов")
+    subparsers.add_parser("backfill-stats", help="пересчитать таблицу daily_stats из trades")
+    subparsers.add_parser("vacuum", help="перепаковать файл базы (VACUUM)")
+    import_parser = subparsers.add_parser("import", help="импортировать сделки из CSV")
+    import_parser.add_argument("file", help="CSV с заголовком (формат как у загрузки в бота)")
+    import_parser.add_argument("--user", type=int, required=True, help="Telegram id владельца сделок")
+    import_parser.add_argument("--chat", type=int, default=None, help="id чата (по умолчанию = --user)")
+    export_parser = subparsers.add_parser("export", help="выгрузить сделки в CSV или Parquet")
+    export_parser.add_argument("--user", type=int, required=True, help="Telegram id владельца сделок")
+    export_parser.add_argument("--out", required=True, help="путь к файлу выгрузки")
+    export_parser.add_argument("--format", choices=exporter.FORMATS, default="csv")
+    export_parser.add_argument("--coin", default=None, help="только сделки по монете")
+    export_parser.add_argument("--from", dest="date_from", default=None, help="начало периода YYYY-MM-DD")
+    export_parser.add_argument("--to", dest="date_to", default=None, help="конец периода YYYY-MM-DD")
+
+    args = parser.parse_args()
+    sys.exit(asyncio.run(run(args)))
+
+
+if __name__ == "__main__":
+    main()
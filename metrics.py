@@ -0,0 +1,233 @@
+import asyncio
+import logging
+import time
+from bisect import bisect_left
+from functools import wraps
+from typing import Any, Awaitable, Callable
+
+from aiogram import BaseMiddleware
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.types import CallbackQuery, Message, TelegramObject
+from aiohttp import web
+
+METRICS_HOST = "127.0.0.1"
+METRICS_PORT = 9100
+METRICS_LOG_INTERVAL = 60.0     # период строки-сводки в логе, секунд
+
+# Границы корзин гистограмм, секунды
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def _format_labels(names: tuple, values: tuple, extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(str(value))}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+# Гистограмма в духе Prometheus: счётчики по корзинам, сумма и количество на каждый набор меток
+class Histogram:
+    def __init__(self, name: str, documentation: str, labelnames: tuple = (), buckets: tuple = BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.buckets = buckets
+        self._series = {}   # значения меток -> [счётчики корзин (+inf последним), сумма, количество]
+
+    def observe(self, value: float, *labels):
+        series = self._series.get(labels)
+        if series is None:
+            series = self._series[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        series[0][bisect_left(self.buckets, value)] += 1
+        series[1] += value
+        series[2] += 1
+
+    @property
+    def count(self) -> int:
+        return sum(series[2] for series in self._series.values())
+
+    # Оценка квантиля по корзинам (верхняя граница корзины) для одного набора меток или для всех
+    def quantile(self, q: float, labels: tuple = None) -> float:
+        series = [self._series[labels]] if labels is not None else list(self._series.values())
+        counts = [sum(s[0][i] for s in series) for i in range(len(self.buckets) + 1)]
+        total = sum(counts)
+        if not total:
+            return 0.0
+        seen = 0
+        for i, count in enumerate(counts):
+            seen += count
+            if seen >= q * total:
+                return self.buckets[i] if i < len(self.buckets) else float("inf")
+        return float("inf")
+
+    # Набор меток с самым большим квантилем q (например, самый медленный хэндлер)
+    def slowest(self, q: float = 0.95) -> tuple[tuple, float] | None:
+        if not self._series:
+            return None
+        labels = max(self._series, key=lambda labels: (self.quantile(q, labels), self._series[labels][1]))
+        return labels, self.quantile(q, labels)
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        for labels, (counts, total, count) in sorted(self._series.items()):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += bucket_count
+                le = 'le="+Inf"' if bound == float("inf") else f'le="{bound}"'
+                lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, labels, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labelnames, labels)} {total}")
+            lines.append(f"{self.name}_count{_format_labels(self.labelnames, labels)} {count}")
+        return lines
+
+
+HANDLER_SECONDS = Histogram(
+    "bot_handler_seconds", "Время обработки апдейта хэндлером (вместе с фильтрами и FSM)", ("handler", "prefix")
+)
+DB_SECONDS = Histogram("bot_db_seconds", "Время вызова функции database.py", ("query",))
+API_SECONDS = Histogram("bot_api_seconds", "Время запроса к Bot API", ("method",))
+HISTOGRAMS = [HANDLER_SECONDS, DB_SECONDS, API_SECONDS]
+
+# Источники текущих значений (пул, очередь записи, кэш...): префикс -> функция, возвращающая dict
+_collectors = {}
+
+
+def register_collector(prefix: str, collect: Callable[[], dict]):
+    _collectors[prefix] = collect
+
+
+def render() -> str:
+    lines = []
+    for histogram in HISTOGRAMS:
+        lines.extend(histogram.render())
+    for prefix, collect in _collectors.items():
+        for key, value in collect().items():
+            if isinstance(value, (int, float)) and not isinstance(value, bool):
+                name = f"bot_{prefix}_{key}"
+                lines.append(f"# TYPE {name} gauge")
+                lines.append(f"{name} {value}")
+    return "\n".join(lines) + "\n"
+
+
+# Метка для апдейта: префикс callback_data до первого ":" (openinfo:, period:...) или "message"
+def event_prefix(event: TelegramObject) -> str:
+    if isinstance(event, CallbackQuery):
+        data = event.data or ""
+        head, sep, _ = data.partition(":")
+        return head + sep
+    if isinstance(event, Message):
+        return "message"
+    return type(event).__name__
+
+
+# Внешний middleware: замеряет весь путь апдейта через роутер. Имя сработавшего хэндлера
+# ему сообщает внутренний HandlerNameMiddleware через общий словарь в data
+class HandlerTimingMiddleware(BaseMiddleware):
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: dict[str, Any]
+    ) -> Any:
+        slot = data["metrics_slot"] = {}
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        finally:
+            HANDLER_SECONDS.observe(
+                time.perf_counter() - started, slot.get("handler", "unhandled"), event_prefix(event)
+            )
+
+
+class HandlerNameMiddleware(BaseMiddleware):
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: dict[str, Any]
+    ) -> Any:
+        slot = data.get("metrics_slot")
+        if slot is not None:
+            slot["handler"] = data["handler"].callback.__name__
+        return await handler(event, data)
+
+
+# Замер запросов к Bot API (подключается к сессии бота)
+class ApiTimingMiddleware(BaseRequestMiddleware):
+    async def __call__(self, make_request, bot, method):
+        started = time.perf_counter()
+        try:
+            return await make_request(bot, method)
+        finally:
+            API_SECONDS.observe(time.perf_counter() - started, type(method).__name__)
+
+
+# Декоратор для функций database.py
+def timed(func):
+    @wraps(func)
+    async def wrapper(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return await func(*args, **kwargs)
+        finally:
+            DB_SECONDS.observe(time.perf_counter() - started, func.__name__)
+
+    return wrapper
+
+
+# Подключение замеров к диспетчеру и боту
+def setup(dp, bot):
+    for observer in (dp.message, dp.callback_query):
+        observer.outer_middleware(HandlerTimingMiddleware())
+        observer.middleware(HandlerNameMiddleware())
+    bot.session.middleware(ApiTimingMiddleware())
+
+
+# Локальный HTTP-сервер с /metrics в текстовом формате Prometheus
+async def start_server(host: str = METRICS_HOST, port: int = METRICS_PORT) -> web.AppRunner:
+    async def handle(request: web.Request) -> web.Response:
+        return web.Response(text=render(), content_type="text/plain", charset="utf-8")
+
+    app = web.Application()
+    app.router.add_get("/metrics", handle)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    logging.info("Метрики: http://%s:%s/metrics", host, port)
+    return runner
+
+
+def _ms(seconds: float) -> str:
+    return "inf" if seconds == float("inf") else f"{seconds * 1000:.0f}ms"
+
+
+def summary_line() -> str:
+    parts = [
+        f"updates={HANDLER_SECONDS.count}",
+        f"handler_p95={_ms(HANDLER_SECONDS.quantile(0.95))}",
+        f"db_p95={_ms(DB_SECONDS.quantile(0.95))}",
+        f"api_p95={_ms(API_SECONDS.quantile(0.95))}",
+    ]
+    slowest = HANDLER_SECONDS.slowest()
+    if slowest:
+        (handler, prefix), p95 = slowest
+        parts.append(f"slowest={handler}[{prefix}]:{_ms(p95)}")
+    slowest = DB_SECONDS.slowest()
+    if slowest:
+        (query,), p95 = slowest
+        parts.append(f"slowest_query={query}:{_ms(p95)}")
+    for prefix, collect in _collectors.items():
+        values = collect()
+        for key in ("in_use", "waiting", "queue_depth", "queued", "hits", "misses", "resident"):
+            if key in values:
+                parts.append(f"{prefix}.{key}={values[key]}")
+    return " ".join(parts)
+
+
+async def log_summary(interval: float = METRICS_LOG_INTERVAL):
+    while True:
+        await asyncio.sleep(interval)
+        logging.info("metrics %s", summary_line())
@@ -0,0 +1,229 @@
+import asyncio
+import hashlib
+import logging
+import time
+from collections import OrderedDict, deque
+
+from aiogram import Bot
+from aiogram.exceptions import TelegramBadRequest, TelegramRetryAfter
+from aiogram.types import InlineKeyboardMarkup, Message
+
+GLOBAL_RATE = 30.0          # сообщений в секунду на весь бот
+GLOBAL_BURST = 30
+CHAT_RATE = 1.0             # сообщений в секунду в один чат
+CHAT_BURST = 3
+MAX_RETRIES = 3             # повторы после flood-wait (retry_after)
+LAST_SENT_LIMIT = 50000     # сколько последних отправленных версий сообщений помнить
+CHAT_BUCKETS_LIMIT = 10000  # после скольких лимитов чатов чистить восстановившиеся
+LATENCY_WINDOW = 1000       # по скольким последним отправкам считать перцентили
+
+
+# Ограничитель частоты: rate токенов в секунду, запас не больше burst
+class TokenBucket:
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def take(self):
+        while True:
+            self._refill()
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    # Пауза после flood-wait: токенов не будет, пока не истечёт retry_after
+    def block(self, seconds: float):
+        self._refill()
+        self.tokens = -seconds * self.rate
+
+
+# Одна исходящая операция. Для правок key = (chat_id, message_id), для отправок None
+class _Outgoing:
+    __slots__ = ("key", "call", "digest", "future", "enqueued")
+
+    def __init__(self, key, call, digest, future):
+        self.key = key
+        self.call = call
+        self.digest = digest
+        self.future = future
+        self.enqueued = time.monotonic()
+
+
+def render_digest(text: str, reply_markup: InlineKeyboardMarkup | None) -> str:
+    markup = reply_markup.model_dump_json(exclude_none=True) if reply_markup else ""
+    return hashlib.blake2b(f"{text}\0{markup}".encode(), digest_size=16).hexdigest()
+
+
+# Исходящий слой между хэндлерами и ботом:
+# - на каждое сообщение (chat, message) держится одна ожидающая правка, более старые отбрасываются;
+# - правка не отправляется, если текст и клавиатура совпадают с последней отправленной версией;
+# - соблюдаются общий лимит и лимит на чат, flood-wait (retry_after) пережидается
+class OutboundQueue:
+    def __init__(self, bot: Bot, global_rate: float = GLOBAL_RATE, chat_rate: float = CHAT_RATE,
+                 global_burst: int = GLOBAL_BURST, chat_burst: int = CHAT_BURST):
+        self.bot = bot
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self._global = TokenBucket(global_rate, global_burst)
+        self._chat_buckets = {}
+        self._queues = {}           # chat_id -> deque[_Outgoing]
+        self._pending = {}          # (chat_id, message_id) -> _Outgoing
+        self._workers = {}          # chat_id -> asyncio.Task
+        self._last_sent = OrderedDict()
+        self._latencies = deque(maxlen=LATENCY_WINDOW)
+        self.sent = 0
+        self.superseded = 0
+        self.unchanged = 0
+        self.retries = 0
+        self.failed = 0
+
+    # Общий лимит можно уменьшить на ходу: у каждого из нескольких процессов бота своя доля
+    def set_global_rate(self, rate: float, burst: int):
+        self._global.rate = rate
+        self._global.burst = burst
+        self._global.tokens = min(self._global.tokens, burst)
+
+    # Правка сообщения. Возвращает управление, когда правка отправлена, отброшена как
+    # устаревшая или пропущена как не изменившая сообщение
+    async def edit_text(self, message: Message, text: str, reply_markup: InlineKeyboardMarkup | None = None):
+        chat_id = message.chat.id
+        key = (chat_id, message.message_id)
+        digest = render_digest(text, reply_markup)
+
+        pending = self._pending.get(key)
+        if pending is None and self._last_sent.get(key) == digest:
+            self.unchanged += 1
+            return
+
+        def call():
+            return self.bot.edit_message_text(
+                text=text, chat_id=chat_id, message_id=message.message_id, reply_markup=reply_markup
+            )
+
+        future = asyncio.get_running_loop().create_future()
+        if pending is not None:
+            # Более новая правка занимает место ожидающей, старая считается выполненной
+            dropped = pending.future
+            pending.call, pending.digest, pending.future = call, digest, future
+            self.superseded += 1
+            if not dropped.done():
+                dropped.set_result(None)
+            return await future
+
+        outgoing = _Outgoing(key, call, digest, future)
+        self._pending[key] = outgoing
+        self._enqueue(chat_id, outgoing)
+        return await future
+
+    # Отправка нового сообщения через те же лимиты (без склейки)
+    async def send_message(self, chat_id: int, text: str, **kwargs):
+        future = asyncio.get_running_loop().create_future()
+        outgoing = _Outgoing(None, lambda: self.bot.send_message(chat_id, text, **kwargs), None, future)
+        self._enqueue(chat_id, outgoing)
+        return await future
+
+    def _enqueue(self, chat_id: int, outgoing: _Outgoing):
+        self._queues.setdefault(chat_id, deque()).append(outgoing)
+        if chat_id not in self._workers:
+            self._workers[chat_id] = asyncio.create_task(self._chat_worker(chat_id))
+
+    def _chat_bucket(self, chat_id: int) -> TokenBucket:
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            if len(self._chat_buckets) >= CHAT_BUCKETS_LIMIT:
+                self._prune_buckets()
+            bucket = self._chat_buckets[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+        return bucket
+
+    # Лимиты чатов, которые полностью восстановились, можно не хранить
+    def _prune_buckets(self):
+        for chat_id, bucket in list(self._chat_buckets.items()):
+            bucket._refill()
+            if chat_id not in self._workers and bucket.tokens >= bucket.burst:
+                del self._chat_buckets[chat_id]
+
+    # Разбор очереди одного чата; задача завершается, когда очередь пуста
+    async def _chat_worker(self, chat_id: int):
+        queue = self._queues[chat_id]
+        bucket = self._chat_bucket(chat_id)
+        try:
+            while queue:
+                await bucket.take()
+                await self._global.take()
+                outgoing = queue.popleft()
+                if outgoing.key is not None:
+                    self._pending.pop(outgoing.key, None)
+                await self._deliver(outgoing, bucket)
+        finally:
+            del self._workers[chat_id]
+            del self._queues[chat_id]
+
+    async def _deliver(self, outgoing: _Outgoing, bucket: TokenBucket):
+        result = None
+        error = None
+        for attempt in range(MAX_RETRIES + 1):
+            try:
+                result = await outgoing.call()
+                break
+            except TelegramRetryAfter as e:
+                if attempt == MAX_RETRIES:
+                    error = e
+                    break
+                self.retries += 1
+                bucket.block(e.retry_after)
+                self._global.block(e.retry_after)
+                await asyncio.sleep(e.retry_after)
+            except TelegramBadRequest as e:
+                if "message is not modified" not in e.message:
+                    error = e
+                break
+            except Exception as e:
+                error = e
+                break
+
+        self._latencies.append(time.monotonic() - outgoing.enqueued)
+        if error is not None:
+            self.failed += 1
+            logging.warning("Не удалось отправить сообщение: %s", error)
+            if not outgoing.future.done():
+                outgoing.future.set_exception(error)
+            return
+
+        self.sent += 1
+        if outgoing.key is not None:
+            self._remember(outgoing.key, outgoing.digest)
+        if not outgoing.future.done():
+            outgoing.future.set_result(result)
+
+    def _remember(self, key, digest: str):
+        self._last_sent[key] = digest
+        self._last_sent.move_to_end(key)
+        while len(self._last_sent) > LAST_SENT_LIMIT:
+            self._last_sent.popitem(last=False)
+
+    def metrics(self) -> dict:
+        latencies = sorted(self._latencies)
+
+        def percentile(p: float) -> float:
+            return latencies[min(len(latencies) - 1, int(p * len(latencies)))] if latencies else 0.0
+
+        return {
+            "queued": sum(len(queue) for queue in self._queues.values()),
+            "active_chats": len(self._workers),
+            "sent": self.sent,
+            "superseded": self.superseded,
+            "unchanged": self.unchanged,
+            "retries": self.retries,
+            "failed": self.failed,
+            "latency_p50": percentile(0.50),
+            "latency_p95": percentile(0.95),
+            "latency_max": latencies[-1] if latencies else 0.0,
+        }
@@ -0,0 +1,253 @@
+import argparse
+import asyncio
+import json
+import logging
+import time
+
+PRICE_TTL = 10.0               # сколько секунд цена считается свежей
+PRICE_REFRESH_INTERVAL = 10.0  # период фонового обновления цен монет с открытыми сделками
+PRICE_WAIT = 1.5               # сколько хэндлер ждёт цену, прежде чем показать последнюю известную
+FETCH_TIMEOUT = 5.0            # таймаут одного запроса к источнику
+BINANCE_URL = "https://api.binance.com/api/v3/ticker/price"
+
+log = logging.getLogger("prices")
+
+
+# Источник цен: по списку символов ("BTC/USDT") возвращает {символ: цена}.
+# Символы, которых у источника нет, просто отсутствуют в ответе
+class PriceSource:
+    async def fetch(self, symbols: list[str]) -> dict[str, float]:
+        raise NotImplementedError
+
+    async def close(self):
+        pass
+
+
+# Цены из JSON-файла {"BTC/USDT": 65000.0, ...}. Файл читается при каждом запросе,
+# поэтому его можно менять на ходу — замена биржи в тестах и нагрузочных прогонах
+class FilePriceSource(PriceSource):
+    def __init__(self, path: str):
+        self.path = path
+
+    def _read(self) -> dict:
+        with open(self.path, encoding="utf-8") as f:
+            return json.load(f)
+
+    async def fetch(self, symbols: list[str]) -> dict[str, float]:
+        prices = await asyncio.to_thread(self._read)
+        return {symbol: float(prices[symbol]) for symbol in symbols if symbol in prices}
+
+
+# Цены от локального сервера по TCP: запрос — символы через пробел и перевод строки,
+# ответ — одна строка JSON {символ: цена}. Сервер-заглушка: python prices.py serve
+class SocketPriceSource(PriceSource):
+    def __init__(self, host: str, port: int):
+        self.host = host
+        self.port = port
+
+    async def fetch(self, symbols: list[str]) -> dict[str, float]:
+        reader, writer = await asyncio.open_connection(self.host, self.port)
+        try:
+            writer.write((" ".join(symbols) + "\n").encode())
+            await writer.drain()
+            prices = json.loads(await reader.readline())
+        finally:
+            writer.close()
+            await writer.wait_closed()
+        return {symbol: float(price) for symbol, price in prices.items() if symbol in symbols}
+
+
+# Публичные цены Binance: все символы одним запросом. BTC/USDT на бирже называется BTCUSDT
+class BinancePriceSource(PriceSource):
+    def __init__(self, url: str = BINANCE_URL):
+        self.url = url
+        self._session = None
+
+    async def fetch(self, symbols: list[str]) -> dict[str, float]:
+        import aiohttp
+
+        if self._session is None:
+            self._session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=FETCH_TIMEOUT))
+        names = {symbol.replace("/", ""): symbol for symbol in symbols}
+        # Биржа отвечает ошибкой на весь запрос, если хотя бы одного символа нет,
+        # поэтому запрашиваем всю таблицу цен и выбираем нужные
+        async with self._session.get(self.url) as response:
+            response.raise_for_status()
+            tickers = await response.json()
+        return {names[t["symbol"]]: float(t["price"]) for t in tickers if t["symbol"] in names}
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+
+# Источник по строке настройки PRICE_SOURCE: "binance", "file:<путь>" или "tcp:<хост>:<порт>"
+def make_source(spec: str) -> PriceSource:
+    if spec == "binance":
+        return BinancePriceSource()
+    if spec.startswith("file:"):
+        return FilePriceSource(spec[len("file:"):])
+    if spec.startswith("tcp:"):
+        host, port = spec[len("tcp:"):].rsplit(":", 1)
+        return SocketPriceSource(host, int(port))
+    raise ValueError(f"Неизвестный источник цен: {spec}")
+
+
+# Общий для всех пользователей кэш цен по символу монеты с коротким TTL.
+# Одновременные запросы одной монеты ждут один запрос к источнику (single-flight),
+# все недостающие монеты запрашиваются у источника одной пачкой. Если источник
+# не ответил вовремя или с ошибкой, отдаётся последняя известная цена.
+# listeners — функции listener({символ: цена}), которые получают каждую пачку новых цен
+class PriceFeed:
+    def __init__(self, source: PriceSource, ttl: float = PRICE_TTL):
+        self.source = source
+        self.ttl = ttl
+        self._prices = {}           # символ -> (цена, time.monotonic() получения)
+        self._inflight = {}         # символ -> future текущего запроса к источнику
+        self._tasks = set()
+        self.listeners = []
+        self.fetches = 0
+        self.fetched_symbols = 0
+        self.errors = 0
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.fetch_time_total = 0.0
+
+    def _is_fresh(self, symbol: str, now: float) -> bool:
+        entry = self._prices.get(symbol)
+        return entry is not None and now - entry[1] < self.ttl
+
+    # Последняя известная цена без обращения к источнику
+    def peek(self, symbol: str) -> float | None:
+        entry = self._prices.get(symbol)
+        return entry[0] if entry else None
+
+    async def _fetch(self, symbols: list[str], future: asyncio.Future):
+        started = time.monotonic()
+        prices = None
+        try:
+            prices = await asyncio.wait_for(self.source.fetch(symbols), FETCH_TIMEOUT)
+            now = time.monotonic()
+            for symbol, price in prices.items():
+                self._prices[symbol] = (price, now)
+            self.fetched_symbols += len(prices)
+        except Exception as e:
+            self.errors += 1
+            log.warning("Не удалось получить цены %s: %r", ", ".join(symbols), e)
+        finally:
+            self.fetches += 1
+            self.fetch_time_total += time.monotonic() - started
+            for symbol in symbols:
+                if self._inflight.get(symbol) is future:
+                    del self._inflight[symbol]
+            # Ожидающим важен только факт завершения: ошибку они не видят, берут последнюю цену
+            future.set_result(None)
+        # Ошибка подписчика — не ошибка источника: цены уже сохранены
+        if prices:
+            for listener in self.listeners:
+                try:
+                    listener(prices)
+                except Exception:
+                    log.exception("Ошибка подписчика цен %r", listener)
+
+    # Запуск одного запроса к источнику за всеми монетами, которые ещё никто не запрашивает.
+    # Возвращает future всех запросов, от которых зависят эти монеты
+    def _request(self, symbols) -> set:
+        new = [symbol for symbol in symbols if symbol not in self._inflight]
+        self.coalesced += len(symbols) - len(new)
+        if new:
+            future = asyncio.get_running_loop().create_future()
+            for symbol in new:
+                self._inflight[symbol] = future
+            task = asyncio.create_task(self._fetch(new, future))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+        return {self._inflight[symbol] for symbol in symbols if symbol in self._inflight}
+
+    # Цены монет: свежие из кэша, остальные — одним запросом к источнику. Ждём не дольше
+    # timeout, после чего возвращаем последние известные (монеты без цены в ответ не попадают)
+    async def get_many(self, symbols, timeout: float = None) -> dict[str, float]:
+        symbols = {symbol for symbol in symbols if symbol}
+        now = time.monotonic()
+        missing = [symbol for symbol in symbols if not self._is_fresh(symbol, now)]
+        self.hits += len(symbols) - len(missing)
+        self.misses += len(missing)
+
+        if missing:
+            waiters = self._request(missing)
+            if waiters:
+                await asyncio.wait(waiters, timeout=timeout)
+
+        return {symbol: self._prices[symbol][0] for symbol in symbols if symbol in self._prices}
+
+    async def get(self, symbol: str, timeout: float = None) -> float | None:
+        return (await self.get_many((symbol,), timeout=timeout)).get(symbol)
+
+    # Фоновое обновление: раз в interval секунд одной пачкой обновляются цены всех монет,
+    # по которым есть открытые сделки, чтобы хэндлеры почти всегда попадали в кэш
+    async def run(self, symbols_provider, interval: float = PRICE_REFRESH_INTERVAL):
+        while True:
+            try:
+                symbols = await symbols_provider()
+                now = time.monotonic()
+                stale = [symbol for symbol in symbols if not self._is_fresh(symbol, now)]
+                if stale:
+                    await asyncio.wait(self._request(stale))
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                log.exception("Ошибка фонового обновления цен")
+            await asyncio.sleep(interval)
+
+    async def close(self):
+        for task in list(self._tasks):
+            task.cancel()
+        await self.source.close()
+
+    def metrics(self) -> dict:
+        return {
+            "symbols": len(self._prices),
+            "inflight": len(self._inflight),
+            "fetches": self.fetches,
+            "fetched_symbols": self.fetched_symbols,
+            "errors": self.errors,
+            "hits": self.hits,
+            "misses": self.misses,
+            "coalesced": self.coalesced,
+            "fetch_avg_ms": self.fetch_time_total / self.fetches * 1000 if self.fetches else 0.0,
+        }
+
+
+# Сервер-заглушка для SocketPriceSource: отдаёт цены из JSON-файла
+async def serve(path: str, host: str, port: int):
+    source = FilePriceSource(path)
+
+    async def handle(reader, writer):
+        try:
+            symbols = (await reader.readline()).decode().split()
+            writer.write((json.dumps(await source.fetch(symbols)) + "\n").encode())
+            await writer.drain()
+        finally:
+            writer.close()
+
+    server = await asyncio.start_server(handle, host, port)
+    print(f"Цены из {path} на {host}:{port}")
+    async with server:
+        await server.serve_forever()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Локальный сервер цен для проверки бота без биржи")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    serve_parser = subparsers.add_parser("serve", help="отдавать цены из JSON-файла по TCP")
+    serve_parser.add_argument("file", help='JSON вида {"BTC/USDT": 65000.0}')
+    serve_parser.add_argument("--host", default="127.0.0.1")
+    serve_parser.add_argument("--port", type=int, default=9200)
+    args = parser.parse_args()
+    asyncio.run(serve(args.file, args.host, args.port))
+
+
+if __name__ == "__main__":
+    main()
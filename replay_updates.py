@@ -0,0 +1,51 @@
+import argparse
+import asyncio
+import json
+import time
+
+from aiohttp import ClientSession
+
+from webhook import SECRET_HEADER, WEBHOOK_PATH, WEBAPP_PORT
+
+
+# Локальная замена Telegram: отправляет записанные апдейты (JSON по одному на строку)
+# POST-запросами на вебхук бота, как это делает сервер Telegram
+async def replay(path: str, url: str, secret: str | None, concurrency: int) -> int:
+    headers = {SECRET_HEADER: secret} if secret else {}
+    slots = asyncio.Semaphore(concurrency)
+    statuses = {}
+
+    async def post(session: ClientSession, update: dict):
+        async with slots:
+            async with session.post(url, json=update, headers=headers) as response:
+                statuses[response.status] = statuses.get(response.status, 0) + 1
+
+    started = time.perf_counter()
+    async with ClientSession() as session:
+        tasks = []
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                if line.strip():
+                    tasks.append(asyncio.create_task(post(session, json.loads(line))))
+        await asyncio.gather(*tasks)
+    elapsed = time.perf_counter() - started
+
+    total = sum(statuses.values())
+    print(f"Отправлено апдейтов: {total} за {elapsed:.2f} с ({total / elapsed if elapsed else 0:.1f}/с)")
+    for status, count in sorted(statuses.items()):
+        print(f"  HTTP {status}: {count}")
+    return 0 if set(statuses) <= {200} else 1
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Отправка записанных апдейтов на локальный вебхук")
+    parser.add_argument("updates", help="файл с апдейтами Telegram, по одному JSON на строку")
+    parser.add_argument("--url", default=f"http://127.0.0.1:{WEBAPP_PORT}{WEBHOOK_PATH}")
+    parser.add_argument("--secret", default=None, help="секрет вебхука (WEBHOOK_SECRET)")
+    parser.add_argument("--concurrency", type=int, default=8, help="сколько запросов отправлять одновременно")
+    args = parser.parse_args()
+    raise SystemExit(asyncio.run(replay(args.updates, args.url, args.secret, args.concurrency)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,206 @@
+import asyncio
+import json
+import logging
+import time
+from collections import OrderedDict
+from collections.abc import Mapping
+from typing import Any
+
+from aiogram.exceptions import DataNotDictLikeError
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, DefaultKeyBuilder, StateType, StorageKey
+
+import database as db
+
+FSM_TTL = 7 * 24 * 3600        # через сколько секунд без изменений черновик считается брошенным
+FSM_MAX_RESIDENT = 10000       # максимум записей FSM в памяти
+FSM_FLUSH_INTERVAL = 2.0       # период сброса изменений в базу, секунд
+FSM_SWEEP_INTERVAL = 600.0     # период удаления брошенных черновиков, секунд
+
+
+# Запись FSM одного пользователя в памяти
+class _Record:
+    __slots__ = ("state", "data", "updated_at", "dirty")
+
+    def __init__(self, state: str | None = None, data: dict | None = None, updated_at: float = 0.0):
+        self.state = state
+        self.data = data or {}
+        self.updated_at = updated_at
+        self.dirty = False
+
+    def mark_changed(self):
+        self.updated_at = time.time()
+        self.dirty = True
+
+    @property
+    def is_empty(self) -> bool:
+        return self.state is None and not self.data
+
+
+# Хранилище FSM в SQLite: горячие записи живут в памяти (не больше max_resident),
+# изменения пишутся в таблицу fsm_storage фоновым сбросом (write-behind),
+# черновики без изменений дольше ttl удаляются и из памяти, и из базы
+class SQLiteStorage(BaseStorage):
+    def __init__(
+        self,
+        ttl: float = FSM_TTL,
+        max_resident: int = FSM_MAX_RESIDENT,
+        flush_interval: float = FSM_FLUSH_INTERVAL,
+        sweep_interval: float = FSM_SWEEP_INTERVAL
+    ):
+        self.ttl = ttl
+        self.max_resident = max_resident
+        self.flush_interval = flush_interval
+        self.sweep_interval = sweep_interval
+        self.key_builder = DefaultKeyBuilder(with_bot_id=True, with_destiny=True, with_business_connection_id=True)
+        self._hot = OrderedDict()   # key -> _Record
+        self._evicted = {}          # вытесненные из памяти, но ещё не записанные в базу
+        self._task = None
+        self.loads = 0
+        self.evictions = 0
+        self.expired = 0
+
+    async def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._background())
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        record = await self._record(key)
+        record.state = state.state if isinstance(state, State) else state
+        record.mark_changed()
+
+    async def get_state(self, key: StorageKey) -> str | None:
+        return (await self._record(key)).state
+
+    async def set_data(self, key: StorageKey, data: Mapping[str, Any]) -> None:
+        if not isinstance(data, dict):
+            raise DataNotDictLikeError(f"Data must be a dict or dict-like object, got {type(data).__name__}")
+        record = await self._record(key)
+        record.data = data.copy()
+        record.mark_changed()
+
+    async def get_data(self, key: StorageKey) -> dict[str, Any]:
+        return (await self._record(key)).data.copy()
+
+    # Запись из памяти, а при промахе — из базы
+    async def _record(self, key: StorageKey) -> _Record:
+        storage_key = self.key_builder.build(key)
+
+        record = self._hot.get(storage_key)
+        if record is None:
+            record = self._evicted.pop(storage_key, None) or await self._load(storage_key)
+            # Пока шло чтение из базы, запись могла появиться в памяти из другого апдейта
+            record = self._hot.setdefault(storage_key, record)
+            self._shrink()
+        self._hot.move_to_end(storage_key)
+        return record
+
+    async def _load(self, storage_key: str) -> _Record:
+        now = time.time()
+        self.loads += 1
+        async with db.pool.acquire() as conn:
+            row = await db.fetch_one(
+                conn,
+                "SELECT state, data, updated_at FROM fsm_storage WHERE key = ?",
+                (storage_key,)
+            )
+
+        if not row or row["updated_at"] < now - self.ttl:
+            return _Record(updated_at=now)
+        return _Record(row["state"], json.loads(row["data"]), row["updated_at"])
+
+    # Вытеснение самых давно использованных записей сверх лимита
+    def _shrink(self):
+        while len(self._hot) > self.max_resident:
+            storage_key, record = self._hot.popitem(last=False)
+            if record.dirty:
+                self._evicted[storage_key] = record
+            self.evictions += 1
+
+    # Запись всех изменённых черновиков одной операцией очереди записи
+    async def flush(self):
+        evicted, self._evicted = self._evicted, {}
+        flushed = []
+        upserts = []
+        deletes = []
+
+        for storage_key, record in list(self._hot.items()) + list(evicted.items()):
+            if not record.dirty:
+                continue
+            record.dirty = False
+            flushed.append(record)
+            if record.is_empty:
+                deletes.append((storage_key,))
+            else:
+                upserts.append((storage_key, record.state, json.dumps(record.data, default=str), record.updated_at))
+
+        if not flushed:
+            return
+
+        async def operation(conn):
+            if upserts:
+                await db.traced_executemany(conn, '''
+                    INSERT INTO fsm_storage (key, state, data, updated_at)
+                    VALUES (?, ?, ?, ?)
+                    ON CONFLICT (key) DO UPDATE SET
+                        state = excluded.state,
+                        data = excluded.data,
+                        updated_at = excluded.updated_at
+                ''', upserts)
+            if deletes:
+                await db.traced_executemany(conn, "DELETE FROM fsm_storage WHERE key = ?", deletes)
+
+        try:
+            await db.writer.submit(operation)
+        except Exception:
+            # Не теряем изменения: они попадут в следующий сброс
+            for record in flushed:
+                record.dirty = True
+            for storage_key, record in evicted.items():
+                self._evicted.setdefault(storage_key, record)
+            raise
+
+    # Удаление брошенных черновиков из памяти и из базы
+    async def sweep(self):
+        deadline = time.time() - self.ttl
+        for storage_key, record in list(self._hot.items()):
+            if record.updated_at < deadline and not record.dirty:
+                del self._hot[storage_key]
+                self.expired += 1
+
+        async def operation(conn):
+            await db.traced_execute(conn, "DELETE FROM fsm_storage WHERE updated_at < ?", (deadline,))
+
+        await db.writer.submit(operation)
+
+    async def _background(self):
+        last_sweep = time.monotonic()
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+                if time.monotonic() - last_sweep >= self.sweep_interval:
+                    await self.sweep()
+                    last_sweep = time.monotonic()
+            except Exception:
+                logging.exception("Не удалось сохранить состояния FSM")
+
+    def metrics(self) -> dict:
+        return {
+            "resident": len(self._hot),
+            "pending_evicted": len(self._evicted),
+            "dirty": sum(1 for record in self._hot.values() if record.dirty),
+            "loads": self.loads,
+            "evictions": self.evictions,
+            "expired": self.expired,
+        }
@@ -0,0 +1,89 @@
+STATUS_OPEN = "открыта"
+STATUS_CLOSED = "закрыта"
+TARGET_STOP_EXIT_FEE = 0.18     # комиссия выхода (%) для сделок, закрытых по цели или стопу
+
+
+# Функция проверки заполненности полей
+def validate_trade_data(data: dict) -> tuple[bool, list[str]]:
+    missing_fields = []
+
+    # Обязательные поля для всех сделок
+    if not data.get('coin'):
+        missing_fields.append("монета")
+    if not data.get('entry'):
+        missing_fields.append("цена входа")
+    if not data.get('usdt_amount'):
+        missing_fields.append("сумма сделки (USDT)")
+    if not data.get('fee_entry_percent'):
+        missing_fields.append("комиссия на входе")
+    if not data.get('status'):
+        missing_fields.append("статус")
+
+    # Дополнительные условия по статусу
+    status = data.get('status')
+    if status == "Закрыто с прибылью" and not data.get('targets'):
+        missing_fields.append("цель")
+    if status == "Закрыто по стопу" and not data.get('stop'):
+        missing_fields.append("стоп")
+
+    return len(missing_fields) == 0, missing_fields
+
+
+# Результат закрытия: монеты покупаются за вычетом комиссии входа,
+# продаются по цене закрытия за вычетом комиссии выхода. Возвращает (профит USDT, PnL %)
+def close_result(entry: float, usdt_amount: float, entry_fee: float, close_price: float,
+                 exit_fee: float) -> tuple[float, float]:
+    coins = (usdt_amount / entry) * (1 - entry_fee / 100)
+    final_usdt = (coins * close_price) * (1 - exit_fee / 100)
+    profit = final_usdt - usdt_amount
+    pnl = (profit / usdt_amount) * 100
+    return profit, pnl
+
+
+# Поля сделки, которые определяются её статусом из формы: статус "открыта"/"закрыта",
+# цена и комиссия закрытия, PnL и профит. ZeroDivisionError при нулевой цене входа
+def settle_trade(data: dict) -> dict:
+    entry = data.get("entry")
+    usdt_amount = data.get("usdt_amount")
+    entry_fee = data.get("fee_entry_percent", 0.0)
+    status = data.get("status")
+
+    if not entry:
+        raise ZeroDivisionError("цена входа равна нулю")
+
+    close_price = None
+    exit_fee = 0.0
+    trade_status = STATUS_OPEN
+
+    if status == "Закрыто с прибылью":
+        close_price = float(data.get("targets").split("/")[0].strip())
+        exit_fee = TARGET_STOP_EXIT_FEE
+        trade_status = STATUS_CLOSED
+    elif status == "Закрыто по стопу":
+        close_price = float(data.get("stop"))
+        exit_fee = TARGET_STOP_EXIT_FEE
+        trade_status = STATUS_CLOSED
+    elif status.startswith("Закрыто вручную"):
+        close_price = float(data.get("close_price"))
+        exit_fee = float(data.get("fee_exit"))
+        trade_status = STATUS_CLOSED
+
+    if not close_price:
+        return {"status": trade_status, "close_price": None, "pnl": None, "profit_usdt": None,
+                "fee_exit_percent": None}
+
+    profit, pnl = close_result(entry, usdt_amount, entry_fee, close_price, exit_fee)
+    return {
+        "status": trade_status,
+        "close_price": close_price,
+        "pnl": round(pnl, 2),
+        "profit_usdt": round(profit, 2),
+        "fee_exit_percent": exit_fee,
+    }
+
+
+# Нереализованный результат открытой сделки: как если бы её закрыли сейчас по цене price
+# с комиссией выхода exit_fee (та же формула, что при закрытии). Возвращает (профит USDT, PnL %)
+def unrealized_result(entry: float, usdt_amount: float, entry_fee: float, price: float,
+                      exit_fee: float = TARGET_STOP_EXIT_FEE) -> tuple[float, float]:
+    return close_result(entry, usdt_amount, entry_fee or 0.0, price, exit_fee)
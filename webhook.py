@@ -0,0 +1,111 @@
+import asyncio
+import logging
+
+from aiogram import Bot, Dispatcher
+from aiogram.types import Update
+from aiohttp import web
+
+WEBHOOK_PATH = "/webhook"
+WEBAPP_HOST = "0.0.0.0"
+WEBAPP_PORT = 8080
+MAX_INFLIGHT = 64              # сколько апдейтов обрабатывается одновременно
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+
+# Приём апдейтов от Telegram по HTTP. Ответ 200 отдаётся сразу после постановки
+# апдейта в обработку; при исчерпании лимита одновременных апдейтов запрос ждёт
+# свободного места, и Telegram сам притормаживает отправку
+class WebhookServer:
+    def __init__(self, dp: Dispatcher, bot: Bot, path: str = WEBHOOK_PATH, secret: str | None = None,
+                 max_inflight: int = MAX_INFLIGHT):
+        self.dp = dp
+        self.bot = bot
+        self.path = path
+        self.secret = secret
+        self.max_inflight = max_inflight
+        self._slots = asyncio.Semaphore(max_inflight)
+        self._tasks = set()
+        self.received = 0
+        self.rejected = 0
+        self.failed = 0
+
+    @property
+    def inflight(self) -> int:
+        return len(self._tasks)
+
+    def make_app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post(self.path, self.handle)
+        return app
+
+    async def handle(self, request: web.Request) -> web.Response:
+        if self.secret and request.headers.get(SECRET_HEADER) != self.secret:
+            self.rejected += 1
+            return web.Response(status=401)
+
+        try:
+            update = Update.model_validate(await request.json(), context={"bot": self.bot})
+        except ValueError:
+            self.rejected += 1
+            return web.Response(status=400)
+
+        self.received += 1
+        await self._slots.acquire()
+        task = asyncio.create_task(self._process(update))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return web.Response()
+
+    async def _process(self, update: Update):
+        try:
+            await self.dp.feed_update(self.bot, update)
+        except Exception:
+            self.failed += 1
+            logging.exception("Ошибка обработки апдейта %s", update.update_id)
+        finally:
+            self._slots.release()
+
+    # Дожидается апдейтов, которые уже приняты в обработку
+    async def drain(self):
+        if self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    def metrics(self) -> dict:
+        return {
+            "inflight": self.inflight,
+            "max_inflight": self.max_inflight,
+            "received": self.received,
+            "rejected": self.rejected,
+            "failed": self.failed,
+        }
+
+
+# Запуск бота в режиме вебхука. Если url не задан, вебхук в Telegram не регистрируется
+# (удобно для локальной проверки через replay_updates.py). server — готовый сервер
+# вместо обычного (например, пересылающий апдейты воркерам)
+async def run_webhook(dp: Dispatcher, bot: Bot, url: str | None = None, path: str = WEBHOOK_PATH,
+                      secret: str | None = None, host: str = WEBAPP_HOST, port: int = WEBAPP_PORT,
+                      max_inflight: int = MAX_INFLIGHT, server: WebhookServer | None = None):
+    if server is None:
+        server = WebhookServer(dp, bot, path=path, secret=secret, max_inflight=max_inflight)
+    runner = web.AppRunner(server.make_app())
+    await runner.setup()
+    site = web.TCPSite(runner, host, port)
+
+    await dp.emit_startup(bot=bot, dispatcher=dp)
+    try:
+        await site.start()
+        if url:
+            await bot.set_webhook(
+                url.rstrip("/") + path,
+                secret_token=secret,
+                allowed_updates=dp.resolve_used_update_types(),
+                max_connections=min(max_inflight, 100)
+            )
+        logging.info("Вебхук слушает http://%s:%s%s", host, port, path)
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
+        await server.drain()
+        await dp.emit_shutdown(bot=bot, dispatcher=dp)
+        await bot.session.close()
@@ -0,0 +1,444 @@
+import asyncio
+import json
+import logging
+import os
+import sys
+import time
+from collections import deque
+
+from aiogram import Bot, Dispatcher
+from aiogram.types import Update
+from aiohttp import web
+
+import database as db
+from metrics import DB_SECONDS, HANDLER_SECONDS, METRICS_LOG_INTERVAL
+from cache import stats_cache, trade_cache
+from webhook import SECRET_HEADER, WebhookServer
+
+HEALTH_INTERVAL = 5.0          # период отчёта воркера о здоровье и нагрузке, секунд
+RESTART_DELAY = 1.0            # пауза перед перезапуском упавшего воркера, секунд
+DISPATCH_WAIT = 10.0           # сколько вебхук ждёт перезапускающийся воркер, прежде чем ответить 503
+WORKER_BACKLOG = 1000          # апдейтов, принятых воркером, но ещё не обработанных
+POLL_TIMEOUT = 30              # long polling getUpdates, секунд
+STOP_TIMEOUT = 30.0            # сколько ждать завершения воркера при остановке
+LINE_LIMIT = 16 * 1024 * 1024  # максимальная длина строки протокола (апдейт с большим текстом)
+PRIMARY = 0                    # воркер с фоновыми задачами: цены, уведомления, автозакрытие
+
+log = logging.getLogger("workers")
+
+# Супервизор и воркеры обмениваются строками JSON через stdin/stdout воркера:
+#   супервизор -> воркер: {"update": {...}} — апдейт Telegram;
+#                         {"event": "trade_opened" | "trade_closed", "args": [...]} — событие другого воркера;
+#   воркер -> супервизор: {"health": {...}} — отчёт о нагрузке;
+#                         {"event": ..., "args": [...]} — открытие или закрытие сделки у этого воркера.
+# События нужны, потому что кэши и движок уведомлений живут в памяти своего процесса:
+# открытия и закрытия доходят до PRIMARY, закрытия — ещё и до воркера владельца сделки
+
+
+def _encode(message: dict) -> bytes:
+    return (json.dumps(message, ensure_ascii=False, separators=(",", ":")) + "\n").encode()
+
+
+# Ключ разбиения апдейта: id автора (from), иначе id чата, иначе 0
+def route_key(update: dict) -> int:
+    for name, event in update.items():
+        if isinstance(event, dict):
+            sender = event.get("from") or event.get("user")
+            if isinstance(sender, dict) and "id" in sender:
+                return sender["id"]
+            chat = event.get("chat") or (event.get("message") or {}).get("chat")
+            if isinstance(chat, dict) and "id" in chat:
+                return chat["id"]
+    return 0
+
+
+# Воркер пользователя: id Telegram идут подряд, поэтому остаток от деления распределяет равномерно
+def worker_for(user_id: int, count: int) -> int:
+    return user_id % count
+
+
+# Процесс-воркер со стороны супервизора
+class _WorkerProcess:
+    def __init__(self, index: int):
+        self.index = index
+        self.process = None
+        self.ready = asyncio.Event()
+        self.health = {}
+        self.health_at = 0.0
+        self.restarts = 0
+        self.dispatched = 0
+
+
+# Супервизор: запускает count процессов-воркеров (command + номер воркера), раздаёт им
+# апдейты по id пользователя, пересылает события между ними, собирает отчёты о нагрузке
+# и перезапускает упавших. Апдейты одного пользователя всегда уходят в один воркер по
+# одному каналу, поэтому их порядок сохраняется; при падении воркера апдейты, которые он
+# уже принял, но не обработал, теряются
+class Supervisor:
+    def __init__(self, count: int, command: list[str], health_interval: float = HEALTH_INTERVAL):
+        self.count = count
+        self.command = command
+        self.health_interval = health_interval
+        self.workers = [_WorkerProcess(index) for index in range(count)]
+        self._tasks = set()
+        self._stopping = False
+        self.events = 0
+
+    async def start(self):
+        for worker in self.workers:
+            self._spawn(worker)
+
+    def _spawn(self, worker: _WorkerProcess):
+        task = asyncio.create_task(self._run_worker(worker))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _run_worker(self, worker: _WorkerProcess):
+        while not self._stopping:
+            worker.process = await asyncio.create_subprocess_exec(
+                *self.command, str(worker.index),
+                stdin=asyncio.subprocess.PIPE, stdout=asyncio.subprocess.PIPE, limit=LINE_LIMIT
+            )
+            worker.ready.set()
+            log.info("Воркер %d запущен, pid %d", worker.index, worker.process.pid)
+            try:
+                await self._read_output(worker)
+            finally:
+                worker.ready.clear()
+                code = await worker.process.wait()
+            if self._stopping:
+                break
+            worker.restarts += 1
+            log.error("Воркер %d завершился с кодом %s, перезапуск через %.0f с", worker.index, code, RESTART_DELAY)
+            await asyncio.sleep(RESTART_DELAY)
+
+    async def _read_output(self, worker: _WorkerProcess):
+        while True:
+            line = await worker.process.stdout.readline()
+            if not line:
+                return
+            try:
+                message = json.loads(line)
+            except ValueError:
+                log.warning("Воркер %d: непонятная строка %r", worker.index, line[:200])
+                continue
+            if "health" in message:
+                worker.health = message["health"]
+                worker.health_at = time.monotonic()
+            elif "event" in message:
+                await self._route_event(worker.index, message)
+
+    # Открытие сделки нужно только PRIMARY (движок уведомлений), закрытие — ещё и
+    # воркеру владельца сделки (сброс его кэша статистики после автозакрытия)
+    async def _route_event(self, origin: int, message: dict):
+        self.events += 1
+        targets = {PRIMARY}
+        if message["event"] == "trade_closed":
+            targets.add(worker_for(message["args"][1], self.count))
+        for index in targets - {origin}:
+            await self._send(self.workers[index], _encode(message), wait=None)
+
+    # Запись в канал воркера. wait — сколько ждать перезапускающийся воркер
+    # (None — не ждать: событие для остановленного воркера не нужно, он перечитает базу)
+    async def _send(self, worker: _WorkerProcess, line: bytes, wait: float | None) -> bool:
+        if not worker.ready.is_set():
+            if wait is None:
+                return False
+            try:
+                await asyncio.wait_for(worker.ready.wait(), wait)
+            except asyncio.TimeoutError:
+                return False
+        try:
+            worker.process.stdin.write(line)
+            await worker.process.stdin.drain()
+        except (ConnectionError, RuntimeError):
+            return False
+        return True
+
+    # Передача апдейта (dict в формате Bot API) воркеру его пользователя. False, если
+    # воркер не принял апдейт за wait секунд (Telegram повторит доставку вебхука)
+    async def dispatch(self, update: dict, wait: float = DISPATCH_WAIT) -> bool:
+        worker = self.workers[worker_for(route_key(update), self.count)]
+        if not await self._send(worker, _encode({"update": update}), wait):
+            return False
+        worker.dispatched += 1
+        return True
+
+    # Остановка: закрытый stdin — сигнал воркеру доработать принятое и выйти
+    async def stop(self):
+        self._stopping = True
+        for worker in self.workers:
+            if worker.process is not None and worker.process.returncode is None:
+                worker.process.stdin.close()
+        for worker in self.workers:
+            if worker.process is None:
+                continue
+            try:
+                await asyncio.wait_for(worker.process.wait(), STOP_TIMEOUT)
+            except asyncio.TimeoutError:
+                log.warning("Воркер %d не завершился за %.0f с, принудительная остановка", worker.index, STOP_TIMEOUT)
+                worker.process.kill()
+                await worker.process.wait()
+        for task in list(self._tasks):
+            task.cancel()
+
+    def _is_alive(self, worker: _WorkerProcess) -> bool:
+        return (worker.ready.is_set()
+                and time.monotonic() - worker.health_at < 3 * self.health_interval)
+
+    def metrics(self) -> dict:
+        values = {
+            "count": self.count,
+            "alive": sum(self._is_alive(worker) for worker in self.workers),
+            "restarts": sum(worker.restarts for worker in self.workers),
+            "dispatched": sum(worker.dispatched for worker in self.workers),
+            "events": self.events,
+        }
+        for worker in self.workers:
+            values[f"{worker.index}_alive"] = int(self._is_alive(worker))
+            values[f"{worker.index}_dispatched"] = worker.dispatched
+            values[f"{worker.index}_restarts"] = worker.restarts
+            for key, value in worker.health.items():
+                values[f"{worker.index}_{key}"] = value
+        return values
+
+    def summary_line(self) -> str:
+        parts = []
+        for worker in self.workers:
+            health = worker.health
+            state = "up" if self._is_alive(worker) else "down"
+            parts.append(
+                f"w{worker.index}={state} processed={health.get('processed', 0)} "
+                f"inflight={health.get('inflight', 0)} backlog={health.get('backlog', 0)} "
+                f"cpu={health.get('cpu_percent', 0):.0f}% lag={health.get('loop_lag_ms', 0):.0f}ms "
+                f"p95={health.get('handler_p95_ms', 0):.0f}ms"
+            )
+        return "; ".join(parts)
+
+    async def log_summary(self, interval: float = METRICS_LOG_INTERVAL):
+        while True:
+            await asyncio.sleep(interval)
+            log.info("workers %s", self.summary_line())
+
+
+# Вебхук супервизора: апдейт не разбирается целиком, а сразу уходит воркеру пользователя
+class ForwardingWebhookServer(WebhookServer):
+    def __init__(self, supervisor: Supervisor, dp: Dispatcher, bot: Bot, **kwargs):
+        super().__init__(dp, bot, **kwargs)
+        self.supervisor = supervisor
+
+    async def handle(self, request: web.Request) -> web.Response:
+        if self.secret and request.headers.get(SECRET_HEADER) != self.secret:
+            self.rejected += 1
+            return web.Response(status=401)
+
+        try:
+            update = await request.json()
+        except ValueError:
+            self.rejected += 1
+            return web.Response(status=400)
+        if not isinstance(update, dict):
+            self.rejected += 1
+            return web.Response(status=400)
+
+        self.received += 1
+        if not await self.supervisor.dispatch(update):
+            self.failed += 1
+            return web.Response(status=503)
+        return web.Response()
+
+
+# Long polling супервизора: апдейты забираются одним процессом и раздаются воркерам
+async def poll(supervisor: Supervisor, dp: Dispatcher, bot: Bot, timeout: int = POLL_TIMEOUT):
+    offset = None
+    allowed_updates = dp.resolve_used_update_types()
+    await bot.delete_webhook()
+    log.info("Long polling для %d воркеров", supervisor.count)
+    while True:
+        try:
+            updates = await bot.get_updates(offset=offset, timeout=timeout, allowed_updates=allowed_updates)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            log.exception("Ошибка getUpdates")
+            await asyncio.sleep(RESTART_DELAY)
+            continue
+        for update in updates:
+            raw = update.model_dump(mode="json", by_alias=True, exclude_none=True)
+            # offset не сдвигается, пока апдейт не передан: ждём перезапуска воркера сколько нужно
+            while not await supervisor.dispatch(raw):
+                pass
+            offset = update.update_id + 1
+
+
+# Пересылка открытий и закрытий сделок этого воркера супервизору (подписчик database.trade_listeners)
+class _Relay:
+    def __init__(self, worker: "Worker"):
+        self.worker = worker
+
+    def trade_opened(self, trade_id: int, chat_id: int, coin: str, stop, targets):
+        self.worker.send({"event": "trade_opened", "args": [trade_id, chat_id, coin, stop, targets]})
+
+    def trade_closed(self, trade_id: int, user_id: int, coin: str):
+        self.worker.send({"event": "trade_closed", "args": [trade_id, user_id, coin]})
+
+
+# Процесс-воркер: читает апдейты из stdin и передаёт их диспетчеру. Апдейты одного
+# пользователя обрабатываются строго по очереди, разных — параллельно (не больше
+# max_inflight одновременно). Конец stdin — сигнал доработать принятое и выйти
+class Worker:
+    def __init__(self, dp: Dispatcher, bot: Bot, index: int, max_inflight: int,
+                 health_interval: float = HEALTH_INTERVAL):
+        self.dp = dp
+        self.bot = bot
+        self.index = index
+        self.health_interval = health_interval
+        self._slots = asyncio.Semaphore(max_inflight)
+        self._backlog = asyncio.Semaphore(WORKER_BACKLOG)
+        self._queues = {}           # ключ пользователя -> deque[Update]
+        self._tasks = set()
+        self._relay = _Relay(self)
+        self.received = 0
+        self.processed = 0
+        self.failed = 0
+        self.inflight = 0
+        self.backlog = 0
+        self.loop_lag = 0.0
+
+    def send(self, message: dict):
+        sys.stdout.buffer.write(_encode(message))
+        sys.stdout.buffer.flush()
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        reader = asyncio.StreamReader(limit=LINE_LIMIT)
+        await loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader), sys.stdin)
+        db.trade_listeners.append(self._relay)
+        health_task = asyncio.create_task(self._report_health())
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                try:
+                    message = json.loads(line)
+                except ValueError:
+                    log.warning("Воркер %d: непонятная строка %r", self.index, line[:200])
+                    continue
+                if "update" in message:
+                    await self._accept(message["update"])
+                elif "event" in message:
+                    self._apply_event(message)
+            if self._tasks:
+                await asyncio.gather(*self._tasks, return_exceptions=True)
+        finally:
+            health_task.cancel()
+            db.trade_listeners.remove(self._relay)
+
+    async def _accept(self, raw: dict):
+        try:
+            key = route_key(raw)
+            update = Update.model_validate(raw, context={"bot": self.bot})
+        except (ValueError, AttributeError):
+            self.failed += 1
+            log.warning("Воркер %d: неверный апдейт %r", self.index, str(raw)[:200])
+            return
+        await self._backlog.acquire()
+        self.received += 1
+        self.backlog += 1
+        queue = self._queues.get(key)
+        if queue is not None:
+            queue.append(update)
+            return
+        self._queues[key] = deque([update])
+        task = asyncio.create_task(self._drain(key))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _drain(self, key: int):
+        queue = self._queues[key]
+        try:
+            while queue:
+                update = queue.popleft()
+                async with self._slots:
+                    await self._process(update)
+                self.backlog -= 1
+                self._backlog.release()
+        finally:
+            del self._queues[key]
+
+    async def _process(self, update: Update):
+        self.inflight += 1
+        try:
+            await self.dp.feed_update(self.bot, update)
+        except Exception:
+            self.failed += 1
+            logging.exception("Ошибка обработки апдейта %s", update.update_id)
+        finally:
+            self.inflight -= 1
+            self.processed += 1
+
+    # Событие другого воркера применяется к подписчикам этого процесса (кроме пересылки обратно).
+    # Ошибка одного события или подписчика пишется в лог и не останавливает воркер
+    def _apply_event(self, message: dict):
+        try:
+            event, args = message["event"], message["args"]
+            listeners = [listener for listener in db.trade_listeners if listener is not self._relay]
+            if event == "trade_opened":
+                calls = [(listener.trade_opened, args) for listener in listeners]
+            elif event == "trade_closed":
+                trade_id, user_id, coin = args
+                stats_cache.invalidate_user(user_id, coins=(coin,))
+                trade_cache.invalidate(trade_id)
+                calls = [(listener.trade_closed, args) for listener in listeners]
+            else:
+                log.warning("Воркер %d: неизвестное событие %r", self.index, event)
+                return
+        except (KeyError, TypeError, ValueError):
+            log.warning("Воркер %d: неверное событие %r", self.index, message)
+            return
+        for call, call_args in calls:
+            try:
+                call(*call_args)
+            except Exception:
+                log.exception("Воркер %d: ошибка подписчика на событие %s", self.index, event)
+
+    async def _report_health(self):
+        cpu_before = time.process_time()
+        wall_before = time.monotonic()
+        self.send({"health": {**self.metrics(), "cpu_percent": 0.0}})
+        while True:
+            started = time.monotonic()
+            await asyncio.sleep(self.health_interval)
+            now = time.monotonic()
+            # Задержка цикла событий: насколько позже положенного проснулся sleep
+            self.loop_lag = max(0.0, now - started - self.health_interval)
+            cpu = time.process_time()
+            cpu_percent = (cpu - cpu_before) / (now - wall_before) * 100 if now > wall_before else 0.0
+            cpu_before, wall_before = cpu, now
+            self.send({"health": {**self.metrics(), "cpu_percent": cpu_percent}})
+
+    def metrics(self) -> dict:
+        return {
+            "pid": os.getpid(),
+            "received": self.received,
+            "processed": self.processed,
+            "failed": self.failed,
+            "inflight": self.inflight,
+            "users": len(self._queues),
+            "backlog": self.backlog,
+            "loop_lag_ms": self.loop_lag * 1000,
+            "handler_p95_ms": HANDLER_SECONDS.quantile(0.95) * 1000,
+            "db_p95_ms": DB_SECONDS.quantile(0.95) * 1000,
+        }
+
+
+# Запуск процесса-воркера (бот уже настроен: база, писатель, хранилище FSM)
+async def run_worker(dp: Dispatcher, bot: Bot, index: int, max_inflight: int, health_interval: float = HEALTH_INTERVAL):
+    worker = Worker(dp, bot, index, max_inflight, health_interval=health_interval)
+    await dp.emit_startup(bot=bot, dispatcher=dp)
+    try:
+        await worker.run()
+    finally:
+        await dp.emit_shutdown(bot=bot, dispatcher=dp)
+        await bot.session.close()